@@ -1,33 +1,274 @@
+#!/usr/bin/env python3
+"""
+Клиент голосового WebSocket-сервера: smoke-тест и воспроизведение записанных сессий.
+
+    python3 test_ws.py                                   # config → ready
+    python3 test_ws.py --replay rec/local-1.vrec         # в запущенный сервер, 1x
+    python3 test_ws.py --replay rec/local-1.vrec --speed 4 --spawn-server --stub-llm --stub-tts
+
+Запись делает сам сервер при SESSION_RECORD_DIR (см. voice-backend/stt/session_recorder.py).
+Драйвер шлёт сообщения с исходными интервалами (/speed; 0 — без пауз), собирает
+ответы сервера и печатает решения endpointing, TTFT и задержку первого аудио
+по каждой реплике. Endpointing на сервере считается по реальному времени, поэтому
+при --speed > 1 паузы короче и решения могут отличаться от 1x.
+
+--spawn-server поднимает server_fixed.py на свободных портах (DISABLE_AUTH);
+--stub-llm — llm_stub_server в этом же процессе, --stub-tts — TTS_PROVIDER=stub.
+"""
+import argparse
 import asyncio
-import websockets
 import json
+import os
+import socket
+import struct
+import sys
+import time
+
+import websockets
+
+STT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "voice-backend", "stt")
+AUDIO_HEADER = struct.Struct("<4sIHI")  # magic, utterance_id, mime, len — как send_audio_binary
+ENDPOINT_EVENTS = ("asr_tentative_pause", "asr_confirmed_end", "final")
+
 
 async def test_websocket():
     try:
         uri = "ws://127.0.0.1:2700"
         print(f"🔌 Подключаемся к {uri}...")
-        
+
         async with websockets.connect(uri) as websocket:
             print("✅ WebSocket подключен!")
-            
+
             # Отправляем конфиг
             config = {"config": {"sample_rate": 16000, "words": False}}
             await websocket.send(json.dumps(config))
             print(f"📤 Отправлен конфиг: {config}")
-            
+
             # Ждем ответа
             try:
                 response = await asyncio.wait_for(websocket.recv(), timeout=5.0)
                 print(f"📥 Получен ответ: {response}")
             except asyncio.TimeoutError:
                 print("⏰ Таймаут ожидания ответа")
-            
+
             print("🔌 Закрываем соединение...")
-            
+
     except Exception as e:
         print(f"❌ Ошибка: {e}")
         import traceback
         traceback.print_exc()
 
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ReplayReport:
+    """Ответы сервера с временем от начала воспроизведения и сводка по репликам"""
+
+    def __init__(self):
+        self.events: list[tuple[float, dict]] = []          # JSON-события
+        self.first_audio: dict[int, float] = {}             # utterance_id → t первого аудио
+        self.audio_bytes = 0
+
+    def on_message(self, t: float, msg):
+        if isinstance(msg, bytes):
+            if len(msg) >= AUDIO_HEADER.size:
+                _, u_id, _, n = AUDIO_HEADER.unpack_from(msg)
+                self.first_audio.setdefault(u_id, t)
+                self.audio_bytes += n
+            return
+        try:
+            self.events.append((t, json.loads(msg)))
+        except json.JSONDecodeError:
+            pass
+
+    def turns(self) -> list[dict]:
+        """Реплика = llm_start; final и endpoint-события — последние перед ним"""
+        out = []
+        endpoint: list[tuple[float, dict]] = []
+        last_final_t = None
+        by_u: dict[int, dict] = {}
+        for t, ev in self.events:
+            kind = ev.get("type")
+            if kind in ENDPOINT_EVENTS:
+                endpoint.append((t, ev))
+                if kind == "final":
+                    last_final_t = t
+            elif kind == "llm_start":
+                turn = {
+                    "utterance_id": ev.get("utterance_id"),
+                    "text": ev.get("text", ""),
+                    "t_llm_start": t,
+                    "t_final": last_final_t,
+                    "endpoint": [
+                        {"t": round(et, 3), "type": e["type"], "silent_ms": e.get("silent_ms")} for et, e in endpoint
+                    ],
+                }
+                endpoint = []
+                by_u[turn["utterance_id"]] = turn
+                out.append(turn)
+            elif kind == "llm_delta":
+                turn = by_u.get(ev.get("utterance_id"))
+                if turn is not None:
+                    turn.setdefault("t_first_token", t)
+            elif kind == "metric" and "llm_first_token_ms" in ev:
+                turn = by_u.get(ev.get("utterance_id"))
+                if turn is not None:
+                    turn["server_ttft_ms"] = ev["llm_first_token_ms"]
+        for turn in out:
+            t0 = turn["t_llm_start"]
+            if "t_first_token" in turn:
+                turn["ttft_ms"] = round((turn["t_first_token"] - t0) * 1000.0, 1)
+            t_audio = self.first_audio.get(turn["utterance_id"])
+            if t_audio is not None:
+                base = turn["t_final"] if turn["t_final"] is not None else t0
+                turn["first_audio_ms"] = round((t_audio - base) * 1000.0, 1)
+        return out
+
+    def summary(self) -> dict:
+        from metrics import percentile   # STT_DIR в sys.path — см. run_replay
+
+        turns = self.turns()
+        out = {"turns": len(turns), "audio_bytes": self.audio_bytes}
+        for key in ("ttft_ms", "first_audio_ms"):
+            values = [t[key] for t in turns if key in t]
+            if values:
+                out[key] = {
+                    "n": len(values),
+                    "p50": percentile(values, 50),
+                    "p90": percentile(values, 90),
+                    "max": max(values),
+                }
+        return out
+
+
+async def replay(path: str, uri: str, speed: float, tail_s: float) -> ReplayReport:
+    from session_recorder import read_recording
+
+    header, records = read_recording(path)
+    print(f"▶️  {path}: session={header.get('session_id')} agent={header.get('agent_id')} → {uri} (speed={speed or 'max'})")
+    report = ReplayReport()
+
+    async with websockets.connect(uri, max_size=None, compression=None) as ws:
+        t0 = time.perf_counter()
+
+        async def receive():
+            try:
+                async for msg in ws:
+                    report.on_message(time.perf_counter() - t0, msg)
+            except websockets.ConnectionClosed:
+                pass
+
+        receiver = asyncio.create_task(receive())
+        sent = 0
+        for t_rec, msg in records:
+            if speed > 0:
+                delay = t_rec / speed - (time.perf_counter() - t0)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if isinstance(msg, str) and '"eof"' in msg:
+                break  # eof закрывает сессию — сначала дожидаемся ответов
+            try:
+                await ws.send(msg)
+            except websockets.ConnectionClosed:
+                print("⚠️  Сервер закрыл соединение во время воспроизведения")
+                break
+            sent += 1
+
+        # ждём хвост ответа, пока между событиями меньше tail_s
+        deadline = time.perf_counter() + tail_s
+        seen = len(report.events)
+        while time.perf_counter() < deadline and not receiver.done():
+            await asyncio.sleep(0.1)
+            if len(report.events) != seen:
+                seen = len(report.events)
+                deadline = time.perf_counter() + tail_s
+        print(f"📤 Отправлено сообщений: {sent}, получено событий: {len(report.events)}")
+        receiver.cancel()
+    return report
+
+
+def print_report(report: ReplayReport):
+    for turn in report.turns():
+        print(f"\n🗣  u={turn['utterance_id']} «{turn['text'][:60]}»")
+        for ep in turn["endpoint"]:
+            silent = f" silent_ms={ep['silent_ms']}" if ep["silent_ms"] is not None else ""
+            print(f"    {ep['t']:8.3f}s  {ep['type']}{silent}")
+        print(f"    TTFT: {turn.get('ttft_ms', '—')} мс (сервер: {turn.get('server_ttft_ms', '—')} мс)")
+        print(f"    first audio от final: {turn.get('first_audio_ms', '—')} мс")
+    print("\n📊 " + json.dumps(report.summary(), ensure_ascii=False))
+
+
+async def run_replay(args) -> int:
+    sys.path.insert(0, STT_DIR)
+    stub_srv = None
+    server = None
+    uri = args.uri
+    try:
+        if args.spawn_server:
+            env = dict(os.environ, DISABLE_AUTH="true", HOST="127.0.0.1")
+            port = _free_port()
+            env["PORT"] = str(port)
+            env["HEALTH_PORT"] = str(_free_port())
+            env.pop("SESSION_RECORD_DIR", None)
+            if args.stub_llm:
+                from llm_stub_server import StubConfig, start_stub_server
+                stub_port = _free_port()
+                stub_srv = await start_stub_server(
+                    StubConfig(ttft_ms=args.stub_ttft_ms, seed=0), host="127.0.0.1", port=stub_port)
+                env.update(LLM_BASE_URL=f"http://127.0.0.1:{stub_port}", LLM_API_KEY="stub")
+            if args.stub_tts:
+                env["TTS_PROVIDER"] = "stub"
+            server = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(STT_DIR, "server_fixed.py"), env=env, cwd=STT_DIR)
+            uri = f"ws://127.0.0.1:{port}"
+            for _ in range(600):  # загрузка модели Vosk — до минуты
+                if server.returncode is not None:
+                    print(f"❌ Сервер завершился с кодом {server.returncode}")
+                    return 1
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+        if args.token:
+            uri += ("&" if "?" in uri else "?") + f"token={args.token}"
+
+        report = await replay(args.replay, uri, args.speed, args.tail_s)
+        if args.json:
+            print(json.dumps({"turns": report.turns(), "summary": report.summary()}, ensure_ascii=False, indent=2))
+        else:
+            print_report(report)
+        return 0
+    finally:
+        if server is not None and server.returncode is None:
+            server.terminate()
+            await server.wait()
+        if stub_srv is not None:
+            stub_srv.close()
+            await stub_srv.wait_closed()
+
+
+def _parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--uri", default="ws://127.0.0.1:2700")
+    ap.add_argument("--replay", metavar="FILE", help="файл записи .vrec")
+    ap.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения; 0 — без пауз")
+    ap.add_argument("--tail-s", type=float, default=3.0, help="ожидание ответов после последнего сообщения")
+    ap.add_argument("--token", default=None, help="JWT для ?token= (если на сервере включена авторизация)")
+    ap.add_argument("--spawn-server", action="store_true", help="запустить server_fixed.py на свободном порту")
+    ap.add_argument("--stub-llm", action="store_true", help="с --spawn-server: LLM-заглушка llm_stub_server")
+    ap.add_argument("--stub-ttft-ms", type=float, default=300.0)
+    ap.add_argument("--stub-tts", action="store_true", help="с --spawn-server: TTS_PROVIDER=stub")
+    ap.add_argument("--json", action="store_true", help="отчёт в JSON")
+    return ap.parse_args()
+
+
 if __name__ == "__main__":
+    args = _parse_args()
+    if args.replay:
+        sys.exit(asyncio.run(run_replay(args)))
     asyncio.run(test_websocket())
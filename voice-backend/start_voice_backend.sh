@@ -83,6 +83,13 @@ TTS_PID=$!
 echo $TTS_PID > ../.tts.pid
 echo "✅ TTS HTTP Server started (PID: $TTS_PID)"
 
+# Start resident Silero daemon for generate_tts_cli.py (server.js direct fallback)
+echo "🔊 Starting TTS daemon (unix socket ${TTS_DAEMON_SOCKET:-/tmp/voice_tts_daemon.sock})..."
+python3 generate_tts_cli.py --daemon > ../logs/tts_daemon.log 2>&1 &
+TTS_DAEMON_PID=$!
+echo $TTS_DAEMON_PID > ../.tts_daemon.pid
+echo "✅ TTS daemon started (PID: $TTS_DAEMON_PID)"
+
 echo ""
 echo "🎉 Voice Backend is running!"
 echo ""
@@ -93,6 +100,7 @@ echo "   • Health API:   http://127.0.0.1:8081"
 echo ""
 echo "📝 Logs:"
 echo "   • TTS: $PROJECT_DIR/logs/tts.log"
+echo "   • TTS daemon: $PROJECT_DIR/logs/tts_daemon.log"
 echo "   • STT: $PROJECT_DIR/logs/stt.log"
 echo ""
 echo "🛑 To stop services:"
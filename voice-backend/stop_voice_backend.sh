@@ -28,6 +28,16 @@ if [ -f "$PROJECT_DIR/.tts.pid" ]; then
     rm "$PROJECT_DIR/.tts.pid"
 fi
 
+# Stop TTS daemon (removes its unix socket on SIGTERM)
+if [ -f "$PROJECT_DIR/.tts_daemon.pid" ]; then
+    TTS_DAEMON_PID=$(cat "$PROJECT_DIR/.tts_daemon.pid")
+    if ps -p $TTS_DAEMON_PID > /dev/null; then
+        kill $TTS_DAEMON_PID
+        echo "✅ TTS daemon stopped (PID: $TTS_DAEMON_PID)"
+    fi
+    rm "$PROJECT_DIR/.tts_daemon.pid"
+fi
+
 # Also kill by port just in case
 lsof -ti:2700 | xargs kill -9 2>/dev/null || true
 lsof -ti:8003 | xargs kill -9 2>/dev/null || true
@@ -0,0 +1,184 @@
+"""
+Контроль допуска новых сессий по измеренному бюджету CPU.
+
+Раз в ADMISSION_SAMPLE_MS монитор измеряет:
+  - лаг event loop (насколько позже запланированного проснулся sleep);
+  - загрузку CPU процессом (process_time всех потоков / wall) — в ядрах;
+  - RTF распознавания (время AcceptWaveform / длительность аудио) и RTF синтеза
+    (время synthesize_wav / длительность полученного WAV) за последний интервал.
+Стоимость сессии — EMA загрузки CPU на активную сессию (до первых замеров —
+ADMISSION_SESSION_CPU). Свободные слоты = (бюджет − загрузка) / стоимость сессии, где
+загрузка — не меньше active × стоимость: сессии, принятые после последнего замера,
+занимают бюджет сразу, и шторм переподключений не проходит целиком до пересчёта CPU.
+
+Узел перегружен, если слотов нет, лаг loop или RTF выше порогов либо достигнут
+ADMISSION_MAX_SESSIONS. Тогда handler закрывает новое соединение кодом 1013
+(Try Again Later) — клиент/балансировщик повторяет на другом узле, а уже идущие
+разговоры не деградируют. /health/capacity отдаёт слоты для весов балансировщика.
+"""
+import asyncio
+import os
+import time
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# бюджет в ядрах на процесс; по умолчанию 75% ядер, поделённых между воркерами
+ADMISSION_CPU_BUDGET = float(os.getenv("ADMISSION_CPU_BUDGET", "0") or 0) or round(
+    0.75 * (os.cpu_count() or 1) / max(1, int(os.getenv("WORKERS", "1"))), 2)
+ADMISSION_SESSION_CPU = float(os.getenv("ADMISSION_SESSION_CPU", "0.15"))   # ядер на сессию до замеров
+ADMISSION_MAX_SESSIONS = int(os.getenv("ADMISSION_MAX_SESSIONS", "0"))      # 0 — без жёсткого лимита
+ADMISSION_MAX_LOOP_LAG_MS = float(os.getenv("ADMISSION_MAX_LOOP_LAG_MS", "100"))
+ADMISSION_MAX_RTF = float(os.getenv("ADMISSION_MAX_RTF", "0.8"))
+ADMISSION_SAMPLE_MS = int(os.getenv("ADMISSION_SAMPLE_MS", "250"))
+
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        *,
+        cpu_budget: float = ADMISSION_CPU_BUDGET,
+        session_cpu: float = ADMISSION_SESSION_CPU,
+        max_sessions: int = ADMISSION_MAX_SESSIONS,
+        max_loop_lag_ms: float = ADMISSION_MAX_LOOP_LAG_MS,
+        max_rtf: float = ADMISSION_MAX_RTF,
+        sample_ms: int = ADMISSION_SAMPLE_MS,
+        enabled: bool = ADMISSION_ENABLED,
+    ):
+        self.enabled = enabled
+        self.cpu_budget = cpu_budget
+        self.max_sessions = max_sessions
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.max_rtf = max_rtf
+        self.sample_ms = sample_ms
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        # измерения
+        self.session_cpu = session_cpu   # EMA ядер на сессию
+        self.cpu_cores = 0.0             # загрузка процессом за последний интервал
+        self.loop_lag_ms = 0.0           # максимум лага за последнюю секунду
+        self.asr_rtf = 0.0
+        self.tts_rtf = 0.0
+        self._asr = [0.0, 0.0]           # [время декодирования, секунд аудио] с прошлого замера
+        self._tts = [0.0, 0.0]
+        self._lags: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    # --- измерения из конвейера -------------------------------------------------
+
+    def observe_asr(self, decode_s: float, audio_s: float):
+        self._asr[0] += decode_s
+        self._asr[1] += audio_s
+
+    def observe_tts(self, synth_s: float, audio_s: float):
+        if audio_s > 0:
+            self._tts[0] += synth_s
+            self._tts[1] += audio_s
+
+    # --- монитор ------------------------------------------------------------------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        interval = self.sample_ms / 1000.0
+        keep = max(1, int(1000 / self.sample_ms))
+        wall0, cpu0 = time.monotonic(), time.process_time()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._lags.append(max(0.0, (now - t0 - interval) * 1000.0))
+            del self._lags[:-keep]
+            self.loop_lag_ms = max(self._lags)
+            if now - wall0 < 1.0:
+                continue
+            cpu = time.process_time()
+            self.cpu_cores = (cpu - cpu0) / (now - wall0)
+            wall0, cpu0 = now, cpu
+            self.asr_rtf = self._rtf(self._asr, self.asr_rtf)
+            self.tts_rtf = self._rtf(self._tts, self.tts_rtf)
+            if self.active:
+                self.session_cpu = 0.8 * self.session_cpu + 0.2 * max(0.01, self.cpu_cores / self.active)
+
+    @staticmethod
+    def _rtf(acc: list[float], prev: float) -> float:
+        busy, audio = acc
+        acc[0] = acc[1] = 0.0
+        if audio <= 0:
+            return prev * 0.5   # нет нагрузки — показатель затухает
+        return busy / audio
+
+    # --- решение --------------------------------------------------------------------
+
+    def reserved_cores(self) -> float:
+        """Загрузка для решения: замер CPU отстаёт на секунду, принятые сессии — нет"""
+        return max(self.cpu_cores, self.active * self.session_cpu)
+
+    def slots(self) -> int:
+        free = (self.cpu_budget - self.reserved_cores()) / max(0.01, self.session_cpu)
+        slots = max(0, int(free))
+        if self.max_sessions:
+            slots = min(slots, max(0, self.max_sessions - self.active))
+        return slots
+
+    def saturation(self) -> str | None:
+        """Причина перегрузки или None"""
+        if self.max_sessions and self.active >= self.max_sessions:
+            return "max_sessions"
+        if self.loop_lag_ms > self.max_loop_lag_ms:
+            return "loop_lag"
+        if self.asr_rtf > self.max_rtf:
+            return "asr_rtf"
+        if self.tts_rtf > self.max_rtf:
+            return "tts_rtf"
+        if self.slots() <= 0:
+            return "cpu_budget"
+        return None
+
+    def try_admit(self) -> str | None:
+        """None — сессия принята (active уже увеличен), иначе причина отказа"""
+        if self.enabled:
+            reason = self.saturation()
+            if reason is not None:
+                self.rejected += 1
+                return reason
+        self.active += 1
+        self.admitted += 1
+        return None
+
+    def release(self):
+        self.active = max(0, self.active - 1)
+
+    def capacity(self) -> dict:
+        reason = self.saturation()
+        return {
+            "slots": 0 if reason else self.slots(),
+            "saturated": reason is not None,
+            "reason": reason,
+            "active": self.active,
+            "cpu_budget": self.cpu_budget,
+            "cpu_cores": round(self.cpu_cores, 3),
+            "reserved_cores": round(self.reserved_cores(), 3),
+            "session_cpu": round(self.session_cpu, 3),
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+            "asr_rtf": round(self.asr_rtf, 3),
+            "tts_rtf": round(self.tts_rtf, 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "enabled": self.enabled,
+        }
+
+
+ADMISSION = AdmissionController()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Офлайн-прогон каталога WAV через весь стек: ASR (Vosk) → LLM → TTS (Silero).
+
+Для QA и генерации голосовых промптов — без WebSocket и без реального времени:
+  - ASR: файл целиком подаётся в KaldiRecognizer кусками по ASR_CHUNK_S без пауз,
+    поэтому декодирование идёт быстрее реального времени; --asr-workers потоков
+    делят одну модель server_fixed.MODEL (AcceptWaveform отпускает GIL);
+  - LLM: openai_stream из server_fixed с промптом и параметрами агента, одновременно
+    не больше --llm-concurrency запросов;
+  - TTS: tts_silero.generate_audio_sync в пуле из --tts-procs процессов по
+    --tts-threads потоков torch — синтез не делит GIL с event loop и декодером.
+Файлы идут конвейером: пока один ждёт LLM, другой декодируется, третий озвучивается.
+
+Результат в --out (структура подкаталогов входа сохраняется):
+    <имя>.txt           транскрипт
+    <имя>.answer.txt    ответ LLM
+    <имя>.answer.wav    озвученный ответ
+    results.jsonl       строка на файл: тексты, тайминги стадий, ошибка
+    report.json         пропускная способность: файлов/мин, секунд аудио на секунду
+                        работы, RTF ASR и TTS, p50/p95 стадий
+
+    python3 batch_pipeline.py questions/ --out out/
+    python3 batch_pipeline.py questions/ --out out/ --llm-concurrency 16 --tts-procs 4
+    python3 batch_pipeline.py a.wav b.wav --out out/ --no-tts
+
+LLM, модель Vosk и голос берутся из тех же переменных окружения и пресета агента,
+что и у server_fixed.py.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from agents import AGENTS, DEFAULT_AGENT_ID
+from metrics import percentile
+from startup_profile import lazy_import
+from tts_chunker import wav_duration_ms
+
+# server_fixed тянет websockets/httpx/vosk и читает .env; процессам TTS-пула (spawn)
+# он не нужен, поэтому оба модуля импортируются при первом обращении
+srv = lazy_import("server_fixed")
+tts_silero = lazy_import("tts_silero")
+
+ASR_CHUNK_S = 2.0
+
+
+# ---------------------------------------------------------------------------
+# Стадии
+# ---------------------------------------------------------------------------
+
+def read_pcm16(path: str) -> tuple[bytes, int]:
+    """PCM16 mono и частота WAV; многоканальный сводится в моно"""
+    with wave.open(path, "rb") as w:
+        channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        raw = w.readframes(w.getnframes())
+    if width != 2:
+        raise ValueError(f"нужен 16-bit PCM, sampwidth={width}")
+    if channels > 1:
+        pcm = np.frombuffer(raw, dtype="<i2").reshape(-1, channels).mean(axis=1)
+        raw = pcm.astype("<i2").tobytes()
+    return raw, rate
+
+
+def transcribe(path: str) -> dict:
+    """Декодирование файла целиком, без VAD и endpointing (частота — как в файле)"""
+    pcm, rate = read_pcm16(path)
+    t0 = time.perf_counter()
+    rec = srv.build_recognizer(rate)
+    step = int(rate * ASR_CHUNK_S) * 2
+    parts = []
+    for i in range(0, len(pcm), step):
+        if rec.AcceptWaveform(pcm[i:i + step]):
+            parts.append(json.loads(rec.Result()).get("text", ""))
+    parts.append(json.loads(rec.FinalResult()).get("text", ""))
+    return {
+        "transcript": " ".join(p for p in parts if p).strip(),
+        "audio_s": round(len(pcm) / (2 * rate), 3),
+        "asr_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+    }
+
+
+async def answer(text: str, agent: dict, sem: asyncio.Semaphore) -> dict:
+    """Ответ LLM целиком; TTFT — от начала запроса (ожидание семафора не входит)"""
+    messages = [
+        {"role": "system", "content": agent.get("system_prompt", "Ты ассистент.")},
+        {"role": "user", "content": text},
+    ]
+    async with sem:
+        t0 = time.monotonic()
+        ttft = None
+        parts = []
+        async for delta in srv.openai_stream(
+            None,
+            messages=messages,
+            model=agent.get("model") or agent.get("llm_model"),
+            max_tokens=agent.get("max_tokens"),
+            temperature=agent.get("temperature"),
+        ):
+            if ttft is None:
+                ttft = time.monotonic() - t0
+            parts.append(delta)
+        total = time.monotonic() - t0
+    return {
+        "answer": "".join(parts).strip(),
+        "llm_ttft_ms": round(ttft * 1000.0, 1) if ttft is not None else None,
+        "llm_ms": round(total * 1000.0, 1),
+    }
+
+
+def tts_settings(agent: dict) -> dict:
+    """Голос агента — те же поля и умолчания, что у TTSSettings в serve_session"""
+    return {
+        "model": agent.get("tts_model", "silero_ru"),
+        "voice": agent.get("tts_voice", "eugene"),
+        "speed": agent.get("tts_speed", 1.05),
+        "emotion": agent.get("tts_emotion", "neutral"),
+        "pause": agent.get("tts_pause", 0.12),
+    }
+
+
+def _tts_worker_init(model_name: str, threads: int):
+    """Процесс TTS-пула: свой пул потоков torch и прогретая модель до первого задания"""
+    tts_silero.after_fork(threads)
+    tts_silero.warm([model_name])
+
+
+def _tts_synth(text: str, settings: dict) -> tuple[bytes, float]:
+    t0 = time.perf_counter()
+    wav, _ = tts_silero.generate_audio_sync(
+        text, settings["model"], settings["voice"], settings["speed"], settings["emotion"], settings["pause"])
+    return wav, time.perf_counter() - t0
+
+
+# ---------------------------------------------------------------------------
+# Конвейер
+# ---------------------------------------------------------------------------
+
+def collect_inputs(paths: list[str], out_dir: str) -> list[tuple[str, str]]:
+    """(wav, префикс выходных файлов); для каталогов — рекурсивно *.wav"""
+    items = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(".wav"):
+                        src = os.path.join(root, name)
+                        rel = os.path.splitext(os.path.relpath(src, path))[0]
+                        items.append((src, os.path.join(out_dir, rel)))
+        else:
+            items.append((path, os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])))
+    return sorted(items)
+
+
+def _write(path: str, data: str | bytes):
+    with open(path, "wb") as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+
+
+class Batch:
+    def __init__(self, args):
+        self.args = args
+        self.agent = AGENTS[args.agent]
+        self.tts = tts_settings(self.agent)
+        self.llm_sem = asyncio.Semaphore(args.llm_concurrency)
+        self.asr_pool = ThreadPoolExecutor(max_workers=args.asr_workers, thread_name_prefix="asr")
+        self.tts_pool = None
+        if not (args.no_llm or args.no_tts):
+            # spawn: OpenMP-пул torch и потоки ASR после fork в дочернем процессе не живут
+            self.tts_pool = ProcessPoolExecutor(
+                max_workers=args.tts_procs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_tts_worker_init,
+                initargs=(self.tts["model"], args.tts_threads),
+            )
+
+    def close(self):
+        self.asr_pool.shutdown(wait=False, cancel_futures=True)
+        if self.tts_pool is not None:
+            self.tts_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def process(self, src: str, prefix: str) -> dict:
+        loop = asyncio.get_running_loop()
+        row = {"file": src}
+        try:
+            os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+            row.update(await loop.run_in_executor(self.asr_pool, transcribe, src))
+            _write(prefix + ".txt", row["transcript"] + "\n")
+            if not row["transcript"] or self.args.no_llm:
+                return row
+
+            row.update(await answer(row["transcript"], self.agent, self.llm_sem))
+            _write(prefix + ".answer.txt", row["answer"] + "\n")
+            if not row["answer"] or self.tts_pool is None:
+                return row
+
+            wav, synth_s = await loop.run_in_executor(self.tts_pool, _tts_synth, row["answer"], self.tts)
+            _write(prefix + ".answer.wav", wav)
+            row["tts_ms"] = round(synth_s * 1000.0, 1)
+            row["answer_audio_s"] = round(wav_duration_ms(wav) / 1000.0, 3)
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        return row
+
+
+def _dist(rows: list[dict], key: str) -> dict:
+    values = [r[key] for r in rows if r.get(key) is not None]
+    return {"n": len(values), "p50": percentile(values, 50, 1), "p95": percentile(values, 95, 1)}
+
+
+def build_report(rows: list[dict], wall_s: float, args) -> dict:
+    errors = [r for r in rows if "error" in r]
+    audio_s = sum(r.get("audio_s", 0.0) for r in rows)
+    asr_s = sum(r.get("asr_ms", 0.0) for r in rows) / 1000.0
+    tts_s = sum(r.get("tts_ms", 0.0) for r in rows) / 1000.0
+    answer_audio_s = sum(r.get("answer_audio_s", 0.0) for r in rows)
+    return {
+        "files": len(rows),
+        "ok": len(rows) - len(errors),
+        "errors": len(errors),
+        "wall_s": round(wall_s, 1),
+        "files_per_min": round(len(rows) * 60.0 / wall_s, 1) if wall_s else None,
+        "audio_s": round(audio_s, 1),
+        "audio_s_per_wall_s": round(audio_s / wall_s, 2) if wall_s else None,
+        # RTF на один поток/процесс: время стадии / секунды аудио
+        "asr_rtf": round(asr_s / audio_s, 3) if audio_s else None,
+        "tts_rtf": round(tts_s / answer_audio_s, 3) if answer_audio_s else None,
+        "asr_ms": _dist(rows, "asr_ms"),
+        "llm_ttft_ms": _dist(rows, "llm_ttft_ms"),
+        "llm_ms": _dist(rows, "llm_ms"),
+        "tts_ms": _dist(rows, "tts_ms"),
+        "asr_workers": args.asr_workers,
+        "llm_concurrency": args.llm_concurrency,
+        "tts_procs": 0 if args.no_llm or args.no_tts else args.tts_procs,
+    }
+
+
+async def main_async(args) -> int:
+    items = collect_inputs(args.inputs, args.out)
+    if not items:
+        print("WAV-файлы не найдены", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    await asyncio.to_thread(srv.load_asr_model)
+
+    batch = Batch(args)
+    rows = []
+    t0 = time.monotonic()
+    try:
+        with open(os.path.join(args.out, "results.jsonl"), "w", encoding="utf-8") as results:
+            tasks = [asyncio.create_task(batch.process(src, prefix)) for src, prefix in items]
+            for done in asyncio.as_completed(tasks):
+                row = await done
+                rows.append(row)
+                results.write(json.dumps(row, ensure_ascii=False) + "\n")
+                results.flush()
+                status = row.get("error") or f"«{row.get('transcript', '')[:60]}»"
+                print(f"[{len(rows)}/{len(items)}] {row['file']}: {status}", file=sys.stderr, flush=True)
+    finally:
+        batch.close()
+        await srv.close_openai_http()
+        await srv.close_llm_hedge_http()
+
+    report = build_report(rows, time.monotonic() - t0, args)
+    _write(os.path.join(args.out, "report.json"), json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+    print(json.dumps(report, ensure_ascii=False), flush=True)
+    return 1 if report["errors"] else 0
+
+
+def _parse_args():
+    cpus = os.cpu_count() or 1
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("inputs", nargs="+", help="каталоги (рекурсивно *.wav) или WAV-файлы, 16-bit PCM")
+    ap.add_argument("--out", required=True, help="каталог результатов")
+    ap.add_argument("--agent", default=DEFAULT_AGENT_ID, choices=sorted(AGENTS), help="пресет агента")
+    ap.add_argument("--asr-workers", type=int, default=max(1, cpus // 2), help="потоков декодирования Vosk")
+    ap.add_argument("--llm-concurrency", type=int, default=8, help="одновременных запросов к LLM")
+    ap.add_argument("--tts-procs", type=int, default=max(1, cpus // 4), help="процессов Silero")
+    ap.add_argument("--tts-threads", type=int, default=2, help="потоков torch на процесс Silero")
+    ap.add_argument("--no-llm", action="store_true", help="только транскрипты")
+    ap.add_argument("--no-tts", action="store_true", help="транскрипты и ответы без озвучки")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main_async(_parse_args())))
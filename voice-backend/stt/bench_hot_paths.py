@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарки горячих функций голосового конвейера с сохранёнными baseline.
+
+    python3 bench_hot_paths.py run [-k split]            # замер, таблица ns/op
+    python3 bench_hot_paths.py save                      # записать bench_baselines.json
+    python3 bench_hot_paths.py compare [--threshold 0.15]  # exit 1, если что-то медленнее baseline
+
+Работает офлайн и без тяжёлых зависимостей: функции voice_pipeline.py и
+tts_silero.py (vosk, torch, httpx на уровне модуля) берутся
+из исходника через ast — исполняются только нужные def и константы, так что
+замеряется текущий код, а не копия. Цикл нарезки PCM на фреймы встроен в
+VoicePipeline.feed_pcm, поэтому здесь — его копия (frame_pcm_bytearray).
+
+Время — минимум из --repeat серий по ~--min-time секунд, в наносекундах на один
+вызов workload (набор входов, одинаковый между запусками). Baseline зависит от
+машины и версии Python: сравнивать имеет смысл только на той же машине,
+в файле записаны python/platform/cpu.
+"""
+import argparse
+import ast
+import io
+import json
+import os
+import platform
+import re
+import struct
+import sys
+import time
+import wave
+from array import array
+
+from llm_stub_server import CANNED_ANSWERS_RU, tokenize
+from tts_chunker import AdaptiveChunker, TokenAssembler, TTSLatencyModel
+from tts_lang import segment
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "bench_baselines.json")
+
+
+def load_from_source(path: str, names: set[str], preload: dict | None = None) -> dict:
+    """Исполняет только top-level def/присваивания с именами из names; остальной модуль не трогает"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in names:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(
+            isinstance(t, ast.Name) and t.id in names for t in node.targets
+        ):
+            body.append(node)
+    namespace = dict(preload or {})
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), namespace)
+    missing = names - namespace.keys()
+    if missing:
+        raise RuntimeError(f"{os.path.basename(path)}: не найдены {sorted(missing)}")
+    return namespace
+
+
+PIPELINE = load_from_source(
+    os.path.join(HERE, "voice_pipeline.py"),
+    {"should_restart_llm", "is_tail_jitter", "common_prefix_len",
+     "compute_adaptive_thresholds", "is_good_end", "BAD_ENDINGS"},
+)
+SILERO = load_from_source(
+    os.path.join(HERE, "tts_silero.py"), {"split_text_by_sentences"}, preload={"re": re, "List": list,
+                                                                            "Dict": dict, "Any": object},
+)
+
+
+# ---------------------------------------------------------------------------
+# Входные данные (детерминированные)
+# ---------------------------------------------------------------------------
+
+ANSWER = " ".join(CANNED_ANSWERS_RU)                       # ~700 символов прозы
+RUN_ON = ANSWER.replace(".", ",").replace("!", ",").replace("?", ",") * 2
+TOKENS = tokenize(" " + ANSWER) * 3
+TOKENS_DUP = [t for tok in tokenize(" " + ANSWER) for t in (tok, tok if tok.strip().isalpha() else "")]
+# пары (новый, старый) как в потоке partial/final ASR
+PARTIAL_PAIRS = [
+    ("какая погода завтра в москве", "какая погода завтра в моск"),
+    ("какая погода завтра в москве", "какая погода завтра в москве"),
+    ("расскажи мне про историю россии подробно", "расскажи мне про историю"),
+    ("а что если", "а что есть"),
+    ("включи музыку погромче пожалуйста", "включи музыку погромче пожалуйста"),
+    ("", "привет"),
+    ("привет как дела", ""),
+]
+ENDPOINT_TEXTS = [
+    "привет", "какая погода завтра в москве", "расскажи мне что", "я хотел спросить про то как",
+    "включи музыку погромче пожалуйста и", "сколько стоит билет до санкт петербурга на завтра",
+]
+# TTS-чанки: русская проза и вставки латиницей
+MIXED_CHUNKS = [c.strip() + "." for c in ANSWER.split(".") if c.strip()][:6] + [
+    "Купите iPhone 15 Pro сегодня со скидкой.", "Откройте настройки Wi-Fi и выберите сеть Home_5G.",
+    "Это работает в Chrome, Firefox и Safari.", "Привeт, как дела?",
+]
+PCM_CHUNK = bytes(range(256)) * 5 * 4          # 5120 байт = 160 мс PCM16 16 kHz, как AudioWorklet-пачка
+FRAME_BYTES = 640                               # 20 мс
+SAMPLES_1S = [((i * 7919) % 2000 - 1000) / 1000.0 for i in range(48000)]  # float [-1, 1), 1 с @ 48 kHz
+
+
+# ---------------------------------------------------------------------------
+# Workloads
+# ---------------------------------------------------------------------------
+
+def _chunker_split_workload():
+    """AdaptiveChunker.split на готовом тексте целиком (без обратной связи от синтеза)"""
+    chunker = AdaptiveChunker(TTSLatencyModel())
+
+    def w_chunker_split():
+        for text in (ANSWER, RUN_ON):
+            chunker.reset()
+            chunker.split(text, final=True)
+
+    return w_chunker_split
+
+
+def w_should_restart_llm():
+    f = PIPELINE["should_restart_llm"]
+    for new, old in PARTIAL_PAIRS:
+        f(new, old)
+
+
+def w_is_tail_jitter():
+    f = PIPELINE["is_tail_jitter"]
+    for new, old in PARTIAL_PAIRS:
+        f(new, old)
+
+
+def w_compute_adaptive_thresholds():
+    f = PIPELINE["compute_adaptive_thresholds"]
+    for text in ENDPOINT_TEXTS:
+        f(text, 2.2, 350.0)
+        f(text, 3.0, 500.0)
+
+
+def w_dup_filter():
+    """Фильтр подряд идущих дублей слов run_tts (TokenAssembler)"""
+    a = TokenAssembler()
+    for tok in TOKENS_DUP:
+        a.feed(tok)
+    a.flush()
+
+
+def w_token_to_chunks():
+    """Полный путь run_tts без синтеза: сборка токенов + AdaptiveChunker"""
+    assembler = TokenAssembler()
+    chunker = AdaptiveChunker(TTSLatencyModel())
+    buf = ""
+    for tok in TOKENS:
+        buf += assembler.feed(tok)
+        if assembler.take_boundary() or chunker.worth_splitting(len(buf)):
+            chunks, buf = chunker.split(buf)
+            for chunk in chunks:
+                chunker.on_audio_queued(len(chunk), 0.0, chunker.model.play_ms(len(chunk)))
+    buf += assembler.flush()
+    chunker.split(buf, final=True)
+
+
+def frame_pcm_bytearray(audio_buf: bytearray, pcm: bytes, fb: int) -> int:
+    """Копия цикла нарезки из VoicePipeline.feed_pcm: extend + срез + del по фрейму"""
+    audio_buf.extend(pcm)
+    n = 0
+    while len(audio_buf) >= fb:
+        frame = bytes(audio_buf[:fb])
+        del audio_buf[:fb]
+        n += len(frame)
+    return n
+
+
+def w_bytearray_framer():
+    buf = bytearray()
+    for _ in range(10):   # 1.6 с аудио
+        frame_pcm_bytearray(buf, PCM_CHUNK, FRAME_BYTES)
+
+
+def w_lang_segment():
+    """Разбиение чанков по письменности для TTS без кэша (tts_lang.segment)"""
+    f = segment.__wrapped__
+    for text in MIXED_CHUNKS:
+        f(text)
+
+
+def w_split_text_by_sentences():
+    SILERO["split_text_by_sentences"](ANSWER, 0.3)
+
+
+def w_wav_pack_wave():
+    """float → PCM16 + RIFF через stdlib (путь без numpy/soundfile)"""
+    pcm = array("h", [int(max(-1.0, min(1.0, s)) * 32767) for s in SAMPLES_1S])
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+
+def w_wav_pack_header():
+    """Только RIFF-заголовок struct.pack + склейка с готовым PCM (как TTS-заглушка)"""
+    data = PCM_CHUNK * 19
+    header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + len(data), b"WAVE", b"fmt ", 16, 1, 1,
+                         48000, 96000, 2, 16, b"data", len(data))
+    return header + data
+
+
+def _sf_workload():
+    """Путь tts_silero: numpy float32 → soundfile WAV PCM_16"""
+    try:
+        import numpy as np
+        import soundfile as sf
+    except ImportError:
+        return None
+    audio = np.asarray(SAMPLES_1S, dtype=np.float32)
+
+    def w_wav_pack_soundfile():
+        buf = io.BytesIO()
+        sf.write(buf, audio, 48000, format="WAV", subtype="PCM_16")
+        return buf.getvalue()
+
+    return w_wav_pack_soundfile
+
+
+def _g711_workload():
+    """Вход телефонии: 1 с μ-law 8 kHz фреймами по 20 мс → PCM16 16 kHz (таблица + полифазный FIR)"""
+    try:
+        from g711 import G711Decoder
+    except ImportError:
+        return None
+    decoder = G711Decoder("mulaw")
+    frames = [bytes((i * 37 + j) & 0xFF for j in range(160)) for i in range(50)]
+
+    def w_g711_ingest():
+        for frame in frames:
+            decoder.decode(frame)
+
+    return w_g711_ingest
+
+
+BENCHES = {
+    "chunker_split": _chunker_split_workload(),
+    "should_restart_llm": w_should_restart_llm,
+    "is_tail_jitter": w_is_tail_jitter,
+    "compute_adaptive_thresholds": w_compute_adaptive_thresholds,
+    "dup_filter": w_dup_filter,
+    "token_to_chunks": w_token_to_chunks,
+    "bytearray_framer": w_bytearray_framer,
+    "lang_segment": w_lang_segment,
+    "split_text_by_sentences": w_split_text_by_sentences,
+    "wav_pack_wave": w_wav_pack_wave,
+    "wav_pack_header": w_wav_pack_header,
+    "wav_pack_soundfile": _sf_workload(),   # None — soundfile/numpy не установлены
+    "g711_ingest": _g711_workload(),        # None — numpy не установлен
+}
+
+
+# ---------------------------------------------------------------------------
+# Замер
+# ---------------------------------------------------------------------------
+
+def measure(fn, min_time: float, repeat: int) -> float:
+    """ns на вызов: калибровка числа вызовов под min_time, затем минимум из repeat серий"""
+    number = 1
+    while True:
+        t0 = time.perf_counter_ns()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter_ns() - t0
+        if elapsed >= min_time * 1e9 or number >= 1 << 20:
+            break
+        number *= 2 if elapsed < min_time * 1e8 else max(2, int(min_time * 1e9 / max(1, elapsed)) + 1)
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter_ns()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter_ns() - t0) / number)
+    return best
+
+
+def run(select: str | None, min_time: float, repeat: int) -> dict[str, float]:
+    results = {}
+    for name, fn in BENCHES.items():
+        if select and select not in name:
+            continue
+        if fn is None:
+            print(f"  {name:<30} skipped (нет зависимостей)", file=sys.stderr)
+            continue
+        results[name] = round(measure(fn, min_time, repeat), 1)
+    return results
+
+
+def machine_info() -> dict:
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpu": cpu}
+
+
+def _fmt_ns(ns: float) -> str:
+    return f"{ns / 1000:.2f} µs" if ns < 1e6 else f"{ns / 1e6:.2f} ms"
+
+
+def cmd_run(args) -> int:
+    results = run(args.k, args.min_time, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    for name, ns in results.items():
+        print(f"{name:<30} {_fmt_ns(ns):>12}")
+    return 0
+
+
+def cmd_save(args) -> int:
+    results = run(args.k, args.min_time, args.repeat)
+    data = {"machine": machine_info(), "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"), "ns_per_op": results}
+    if args.k and os.path.exists(args.baseline):
+        # частичное обновление: остальные baseline сохраняем
+        with open(args.baseline, encoding="utf-8") as f:
+            old = json.load(f)
+        data["ns_per_op"] = {**old.get("ns_per_op", {}), **results}
+    with open(args.baseline, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(f"baseline → {args.baseline} ({len(results)} замеров)")
+    return 0
+
+
+def cmd_compare(args) -> int:
+    try:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"нет baseline {args.baseline}: сначала save", file=sys.stderr)
+        return 2
+    if baseline.get("machine") != machine_info():
+        print(f"⚠️  baseline снят на другой машине/Python: {baseline.get('machine')}", file=sys.stderr)
+
+    results = run(args.k, args.min_time, args.repeat)
+    base = baseline.get("ns_per_op", {})
+    # на общей машине шум бывает больше порога: подозрительные перемеряем и берём минимум
+    for _ in range(args.confirm):
+        suspects = [n for n, ns in results.items() if n in base and ns / base[n] - 1.0 > args.threshold]
+        for name in suspects:
+            results[name] = min(results[name], round(measure(BENCHES[name], args.min_time, args.repeat), 1))
+    slow = []
+    print(f"{'benchmark':<30} {'baseline':>12} {'now':>12} {'delta':>8}")
+    for name, ns in results.items():
+        old = base.get(name)
+        if old is None:
+            print(f"{name:<30} {'—':>12} {_fmt_ns(ns):>12} {'new':>8}")
+            continue
+        delta = ns / old - 1.0
+        mark = ""
+        if delta > args.threshold:
+            mark = "  SLOWER"
+            slow.append(name)
+        elif delta < -args.threshold:
+            mark = "  faster"
+        print(f"{name:<30} {_fmt_ns(old):>12} {_fmt_ns(ns):>12} {delta:>+7.1%}{mark}")
+    if slow:
+        print(f"\nмедленнее baseline более чем на {args.threshold:.0%}: {', '.join(slow)}")
+        return 1
+    return 0
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("command", choices=("run", "save", "compare"), nargs="?", default="run")
+    ap.add_argument("-k", default=None, help="только бенчмарки, содержащие подстроку")
+    ap.add_argument("--min-time", type=float, default=0.2, help="длительность серии, с")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--threshold", type=float, default=0.15, help="допустимое замедление (0.15 = 15%%)")
+    ap.add_argument("--confirm", type=int, default=2, help="compare: сколько раз перемерять замедлившиеся")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+    return {"run": cmd_run, "save": cmd_save, "compare": cmd_compare}[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
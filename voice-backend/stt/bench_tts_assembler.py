@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк сборки токенов LLM в чанки TTS: прежний код run_tts против TokenAssembler.
+
+Прежний вариант на каждом токене пересобирает buf + tok, режет весь буфер на слова
+для фильтра дублей, склеивает обратно и прогоняет split_for_tts: O(len(buf)) на токен,
+т.е. O(n²) по длине неотправленного текста (строки "filter" — фильтр без нарезки).
+Новый: TokenAssembler.feed() за O(len(token)) и AdaptiveChunker.split() только на границах.
+
+    python3 bench_tts_assembler.py [--tokens 100 1000 5000] [--repeat 5]
+"""
+import argparse
+import random
+import time
+
+from tts_chunker import AdaptiveChunker, TokenAssembler, TTSLatencyModel
+from llm_stub_server import CANNED_ANSWERS_RU, tokenize
+
+
+def legacy_split_for_tts(buf: str) -> tuple[list[str], str]:
+    """Копия split_for_tts из server_fixed на момент замены (эталон для сравнения)"""
+    N = 120
+    seps = [".", "!", "?", "\n"]
+    out = []
+    while True:
+        cut = -1
+        for s in seps:
+            idx = buf.find(s)
+            if idx != -1:
+                cut = idx if cut == -1 else min(cut, idx)
+        if cut != -1:
+            chunk = buf[:cut+1].strip()
+            buf = buf[cut+1:].lstrip()
+            if chunk:
+                out.append(chunk)
+            continue
+        if len(buf) >= N:
+            space_cut = buf.rfind(' ', 0, N)
+            comma_cut = buf.rfind(',', 0, N)
+            best_cut = max(space_cut, comma_cut)
+            if best_cut > 50:
+                chunk = buf[:best_cut+1].strip()
+                buf = buf[best_cut+1:].lstrip()
+            else:
+                chunk = buf[:N].strip()
+                buf = buf[N:].lstrip()
+            if chunk:
+                out.append(chunk)
+            continue
+        break
+    return out, buf
+
+
+def run_legacy(tokens: list[str]) -> list[str]:
+    """Прежний цикл run_tts (без синтеза): фильтр дублей по всему буферу на каждом токене"""
+    buf = ""
+    out = []
+    for tok in tokens:
+        test_buf = buf + tok
+        words = test_buf.split()
+        filtered_words = []
+        for word in words:
+            if len(filtered_words) == 0 or word != filtered_words[-1]:
+                filtered_words.append(word)
+            elif word == filtered_words[-1] and len(word) > 3:
+                continue
+        buf = ' '.join(filtered_words)
+        chunks, buf = legacy_split_for_tts(buf)
+        out.extend(chunks)
+    while buf.strip():
+        chunks, buf = legacy_split_for_tts(buf)
+        out.extend(chunks)
+        if buf.strip():
+            out.append(buf.strip())
+            buf = ""
+    return out
+
+
+def run_legacy_filter(tokens: list[str]) -> str:
+    """Только фильтр дублей прежнего кода: пересборка всего накопленного текста на каждом токене"""
+    buf = ""
+    for tok in tokens:
+        words = (buf + tok).split()
+        filtered_words = []
+        for word in words:
+            if len(filtered_words) == 0 or word != filtered_words[-1]:
+                filtered_words.append(word)
+        buf = ' '.join(filtered_words)
+    return buf
+
+
+def run_assembler_filter(tokens: list[str]) -> str:
+    """Только TokenAssembler"""
+    assembler = TokenAssembler()
+    parts = [assembler.feed(tok) for tok in tokens]
+    parts.append(assembler.flush())
+    return "".join(parts)
+
+
+def run_assembler(tokens: list[str]) -> list[str]:
+    """Новый цикл run_tts (синтез заменён отметкой об аудио расчётной длины)"""
+    assembler = TokenAssembler()
+    chunker = AdaptiveChunker(TTSLatencyModel())
+    buf = ""
+    out = []
+    for tok in tokens:
+        buf += assembler.feed(tok)
+        if not (assembler.take_boundary() or chunker.worth_splitting(len(buf))):
+            continue
+        chunks, buf = chunker.split(buf)
+        for chunk in chunks:
+            chunker.on_audio_queued(len(chunk), 0.0, chunker.model.play_ms(len(chunk)))
+        out.extend(chunks)
+    buf += assembler.flush()
+    chunks, _ = chunker.split(buf, final=True)
+    out.extend(chunks)
+    return out
+
+
+def make_tokens(n: int, rng: random.Random, punct: bool = True) -> list[str]:
+    """Ответ из n токенов; часть слов режется на подслова, как у BPE.
+    punct=False — сплошной текст без точек (перечисления, код): худший случай для прежнего варианта."""
+    tokens: list[str] = []
+    while len(tokens) < n:
+        sentence = rng.choice(CANNED_ANSWERS_RU)
+        if not punct:
+            sentence = sentence.rstrip(".!?")
+        for tok in tokenize(" " + sentence):
+            if len(tok) > 6 and rng.random() < 0.3:
+                mid = len(tok) // 2
+                tokens.extend((tok[:mid], tok[mid:]))
+            else:
+                tokens.append(tok)
+    return tokens[:n]
+
+
+def bench(fn, tokens: list[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(tokens)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--tokens", type=int, nargs="+", default=[100, 1000, 5000])
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'text':>7} {'tokens':>8} {'legacy ms':>10} {'new ms':>10} {'speedup':>8} {'us/token new':>13}  words_equal")
+    for punct in (True, False):
+        for n in args.tokens:
+            tokens = make_tokens(n, rng, punct)
+            t_old = bench(run_legacy, tokens, args.repeat)
+            t_new = bench(run_assembler, tokens, args.repeat)
+            same = " ".join(run_legacy(tokens)).split() == " ".join(run_assembler(tokens)).split()
+            kind = "prose" if punct else "run-on"
+            print(f"{kind:>7} {n:>8} {t_old * 1000:>10.2f} {t_new * 1000:>10.2f} {t_old / t_new:>7.1f}x "
+                  f"{t_new / n * 1e6:>13.2f}  {same}")
+
+    # Фильтр дублей отдельно от нарезки: в прежнем коде он O(len(buf)) на токен
+    for n in args.tokens:
+        tokens = make_tokens(n, rng, punct=True)
+        t_old = bench(run_legacy_filter, tokens, args.repeat)
+        t_new = bench(run_assembler_filter, tokens, args.repeat)
+        same = run_legacy_filter(tokens).split() == run_assembler_filter(tokens).split()
+        print(f"{'filter':>7} {n:>8} {t_old * 1000:>10.2f} {t_new * 1000:>10.2f} {t_old / t_new:>7.1f}x "
+              f"{t_new / n * 1e6:>13.2f}  {same}")
+
+
+if __name__ == "__main__":
+    main()
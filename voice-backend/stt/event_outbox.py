@@ -0,0 +1,172 @@
+"""
+Фоновая очередь отправки событий диалога в Voice Control.
+
+Realtime-путь (финал ASR, конец ответа TTS) только кладёт событие в
+ограниченную очередь и не ждёт сети. Отдельная задача выбирает события
+пачками, шлёт их через общий keep-alive клиент, повторяет при 5xx/429/сетевых
+ошибках с экспоненциальной задержкой и считает потери.
+
+Voice Control принимает по одному событию на POST
+(/v1/internal/voice/sessions/{id}/events). Если задан batch_path, события
+одной сессии из пачки уходят одним POST {"events": [...]} на
+/v1/internal/voice/sessions/{id}{batch_path}.
+"""
+import asyncio
+import random
+
+import httpx
+
+from voice_log import get_logger
+
+log = get_logger("VOICE_CONTROL")
+
+
+class VoiceControlOutbox:
+    """Ограниченная очередь событий с пакетной отправкой и повторами"""
+
+    def __init__(
+        self,
+        base_url: str,
+        internal_key: str,
+        *,
+        maxsize: int = 1000,
+        batch_max: int = 32,
+        flush_ms: int = 50,
+        max_retries: int = 3,
+        backoff_ms: int = 200,
+        timeout_s: float = 2.0,
+        batch_path: str = "",
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.internal_key = internal_key
+        self.batch_max = batch_max
+        self.flush_ms = flush_ms
+        self.max_retries = max_retries
+        self.backoff_ms = backoff_ms
+        self.timeout_s = timeout_s
+        self.batch_path = batch_path
+        self._queue: asyncio.Queue[tuple[str, dict]] = asyncio.Queue(maxsize=maxsize)
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+        # счётчики
+        self.enqueued = 0
+        self.sent = 0
+        self.retries = 0
+        self.dropped_full = 0      # очередь переполнена
+        self.dropped_rejected = 0  # Voice Control вернул 4xx
+        self.dropped_failed = 0    # исчерпаны повторы
+
+    def put(self, session_id: str, event: dict) -> bool:
+        """Неблокирующая постановка в очередь; при переполнении событие теряется"""
+        try:
+            self._queue.put_nowait((session_id, event))
+        except asyncio.QueueFull:
+            self.dropped_full += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout_s),
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+            headers={"X-Internal-Key": self.internal_key, "Content-Type": "application/json"},
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, drain_timeout_s: float = 2.0):
+        """Пытается дослать очередь за drain_timeout_s, затем останавливает отправку"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout_s)
+        except asyncio.TimeoutError:
+            log.warn("Shutdown: не отправлено %s событий", self._queue.qsize())
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "retries": self.retries,
+            "dropped_full": self.dropped_full,
+            "dropped_rejected": self.dropped_rejected,
+            "dropped_failed": self.dropped_failed,
+        }
+
+    async def _take_batch(self) -> list[tuple[str, dict]]:
+        """Ждёт первое событие, затем добирает остальные в пределах flush_ms"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_ms / 1000.0
+        while len(batch) < self.batch_max:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._take_batch()
+            try:
+                # порядок событий сохраняется внутри сессии, сессии шлём параллельно
+                by_session: dict[str, list[dict]] = {}
+                for session_id, event in batch:
+                    by_session.setdefault(session_id, []).append(event)
+                await asyncio.gather(
+                    *(self._send_session(sid, events) for sid, events in by_session.items()),
+                    return_exceptions=True,
+                )
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _send_session(self, session_id: str, events: list[dict]):
+        url = f"{self.base_url}/v1/internal/voice/sessions/{session_id}/events"
+        if self.batch_path:
+            await self._post(url + self.batch_path, {"events": events}, len(events))
+            return
+        for event in events:
+            await self._post(url, event, 1)
+
+    async def _post(self, url: str, body: dict, count: int):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                delay = self.backoff_ms * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+                await asyncio.sleep(delay / 1000.0)
+            try:
+                response = await self._client.post(url, json=body)
+            except httpx.HTTPError as e:
+                log.warn("Push error (attempt %s): %s", attempt + 1, e)
+                continue
+            status = response.status_code
+            if 200 <= status < 300:
+                self.sent += count
+                return
+            if 400 <= status < 500 and status != 429:
+                self.dropped_rejected += count
+                log.warn("Push rejected: HTTP %s", status)
+                return
+            log.warn("Push failed: HTTP %s (attempt %s)", status, attempt + 1)
+        self.dropped_failed += count
@@ -0,0 +1,277 @@
+"""
+Разбор SSE-потока OpenAI-совместимых /v1/chat/completions и склейка дельт.
+
+SSEParser работает с сырыми байтами: строки режутся инкрементально,
+JSON разбирается только для строк `data:` (orjson, если установлен).
+coalesce_deltas объединяет дельты, пришедшие в пределах короткого окна,
+чтобы на один фрагмент приходилась одна отправка llm_delta и один put в очередь TTS.
+hedged_stream дублирует запрос, если первый токен задерживается, и стримит
+ответ того, кто успел первым.
+"""
+import asyncio
+import json
+from typing import AsyncIterator, Callable, Optional
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads  # orjson не установлен, используем stdlib
+
+_DATA = b"data:"
+_DONE = b"[DONE]"
+
+
+def extract_delta(payload: bytes) -> str | None:
+    """Достаёт choices[0].delta.content из JSON-чанка (None для битых/пустых)"""
+    try:
+        chunk = _loads(payload)
+    except ValueError:
+        return None  # битый чанк, игнорируем
+    if not isinstance(chunk, dict):
+        return None
+    choices = chunk.get("choices")
+    if not choices:
+        return None
+    delta = choices[0].get("delta")
+    if not delta:
+        return None
+    return delta.get("content")
+
+
+class SSEParser:
+    """Инкрементальный парсер SSE: принимает куски байт, возвращает тексты дельт"""
+
+    __slots__ = ("_tail", "done")
+
+    def __init__(self):
+        self._tail = b""     # незавершённая строка с прошлого куска
+        self.done = False    # получен data: [DONE]
+
+    def feed(self, data: bytes) -> list[str]:
+        if self.done:
+            return []
+        buf = self._tail + data if self._tail else data
+        out: list[str] = []
+        start = 0
+        while True:
+            nl = buf.find(b"\n", start)
+            if nl == -1:
+                break
+            line = buf[start:nl]
+            start = nl + 1
+            # пустые строки, комментарии keep-alive (":"), event:/id: — пропускаем
+            if not line.startswith(_DATA):
+                continue
+            payload = line[5:].strip()
+            if payload == _DONE:
+                self.done = True
+                self._tail = b""
+                return out
+            text = extract_delta(payload)
+            if text:
+                out.append(text)
+        self._tail = buf[start:]
+        return out
+
+
+async def aiter_sse_deltas(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Отдаёт текст дельт по мере прихода байт; дельты одного сетевого куска склеены"""
+    parser = SSEParser()
+    async for data in chunks:
+        deltas = parser.feed(data)
+        if deltas:
+            yield deltas[0] if len(deltas) == 1 else "".join(deltas)
+        if parser.done:
+            break
+
+
+async def coalesce_deltas(
+    deltas: AsyncIterator[str],
+    window_ms: int = 25,
+    max_chars: int = 64,
+) -> AsyncIterator[str]:
+    """
+    Склеивает дельты, пришедшие в пределах window_ms, в один фрагмент.
+
+    Первая дельта отдаётся сразу (TTFT не ухудшается). Фрагмент сбрасывается
+    по истечении окна, даже если источник замолчал, или при накоплении max_chars.
+    """
+    if window_ms <= 0:
+        async for tok in deltas:
+            yield tok
+        return
+
+    loop = asyncio.get_running_loop()
+    window = window_ms / 1000.0
+    it = deltas.__aiter__()
+    nxt: asyncio.Future | None = None
+    pending: list[str] = []
+    pending_len = 0
+    deadline = 0.0
+    first = True
+
+    try:
+        while True:
+            if nxt is None:
+                nxt = asyncio.ensure_future(it.__anext__())
+
+            if pending and not nxt.done():
+                timeout = deadline - loop.time()
+                if timeout > 0:
+                    await asyncio.wait((nxt,), timeout=timeout)
+                if not nxt.done():
+                    # окно истекло, а новых дельт нет — отдаём накопленное
+                    text = "".join(pending)
+                    pending.clear()
+                    pending_len = 0
+                    yield text
+                    continue
+
+            try:
+                tok = await nxt
+            except StopAsyncIteration:
+                break
+            nxt = None
+
+            if first:
+                first = False
+                yield tok
+                continue
+
+            if not pending:
+                deadline = loop.time() + window
+            pending.append(tok)
+            pending_len += len(tok)
+            if pending_len >= max_chars:
+                text = "".join(pending)
+                pending.clear()
+                pending_len = 0
+                yield text
+
+        if pending:
+            yield "".join(pending)
+    finally:
+        if nxt is not None and not nxt.done():
+            nxt.cancel()
+
+
+class HedgeStats:
+    """Счётчики hedging'а LLM-запросов (на процесс)"""
+
+    __slots__ = ("requests", "hedged", "primary_wins", "hedge_wins", "failures")
+
+    def __init__(self):
+        self.requests = 0      # всего стримов через hedged_stream
+        self.hedged = 0        # сколько раз отправили дублирующий запрос
+        self.primary_wins = 0  # после hedge первым ответил основной запрос
+        self.hedge_wins = 0    # после hedge первым ответил дубль
+        self.failures = 0      # оба запроса завершились ошибкой
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+HEDGE_STATS = HedgeStats()
+
+# Фоновые задачи отмены проигравших стримов (держим ссылки, чтобы их не собрал GC)
+_discard_tasks: set[asyncio.Task] = set()
+
+
+async def _discard(first: asyncio.Future, gen: AsyncIterator[str]):
+    first.cancel()
+    try:
+        await first
+    except (asyncio.CancelledError, Exception):
+        pass
+    try:
+        await gen.aclose()
+    except Exception:
+        pass
+
+
+def _discard_later(first: asyncio.Future, gen: AsyncIterator[str]):
+    """Отменяет проигравший стрим, не задерживая победителя"""
+    task = asyncio.create_task(_discard(first, gen))
+    _discard_tasks.add(task)
+    task.add_done_callback(_discard_tasks.discard)
+
+
+def _failed(first: asyncio.Future) -> bool:
+    """Первый __anext__ завершился ошибкой (пустой стрим ошибкой не считается)"""
+    exc = first.exception()
+    return exc is not None and not isinstance(exc, StopAsyncIteration)
+
+
+async def hedged_stream(
+    primary: Callable[[], AsyncIterator[str]],
+    hedge: Optional[Callable[[], AsyncIterator[str]]],
+    delay_ms: int,
+    stats: HedgeStats = HEDGE_STATS,
+) -> AsyncIterator[str]:
+    """
+    Стримит primary(); если первый токен не пришёл за delay_ms (или primary упал
+    раньше), запускает hedge() и отдаёт поток того, кто первым прислал токен.
+    Проигравший запрос отменяется.
+    """
+    stats.requests += 1
+    p_gen = primary().__aiter__()
+
+    if hedge is None or delay_ms <= 0:
+        try:
+            async for text in p_gen:
+                yield text
+        finally:
+            await p_gen.aclose()
+        return
+
+    p_first = asyncio.ensure_future(p_gen.__anext__())
+    h_gen = None
+    h_first = None
+    winner_gen = None
+    winner_first = None
+
+    try:
+        await asyncio.wait((p_first,), timeout=delay_ms / 1000.0)
+
+        if p_first.done() and not _failed(p_first):
+            winner_gen, winner_first = p_gen, p_first
+        else:
+            stats.hedged += 1
+            h_gen = hedge().__aiter__()
+            h_first = asyncio.ensure_future(h_gen.__anext__())
+            pending = {h_first} if p_first.done() else {p_first, h_first}
+
+            while pending and winner_first is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for first, gen in ((p_first, p_gen), (h_first, h_gen)):
+                    if first in done and not _failed(first):
+                        winner_gen, winner_first = gen, first
+                        break
+
+            if winner_first is None:
+                stats.failures += 1
+                raise p_first.exception()
+
+            if winner_first is p_first:
+                stats.primary_wins += 1
+                _discard_later(h_first, h_gen)
+            else:
+                stats.hedge_wins += 1
+                _discard_later(p_first, p_gen)
+
+        try:
+            text = winner_first.result()
+        except StopAsyncIteration:
+            return
+        yield text
+        async for text in winner_gen:
+            yield text
+    finally:
+        if winner_gen is None:
+            # отмена/ошибка до выбора победителя — гасим оба запроса
+            _discard_later(p_first, p_gen)
+            if h_first is not None:
+                _discard_later(h_first, h_gen)
+        else:
+            await winner_gen.aclose()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка OpenAI-совместимого /v1/chat/completions для нагрузочных тестов.
+
+Отдаёт SSE в том же формате, что и DeepSeek/OpenAI (data: {...choices[0].delta...}
+и data: [DONE]), с настраиваемыми TTFT, скоростью токенов, распределением длины
+ответа и инъекцией ошибок. Ответы собираются из заготовленных русских фраз,
+так что конвейер ASR→LLM→TTS можно гонять без сети и без трат на токены.
+
+Запуск:
+    python3 llm_stub_server.py --port 8090 --ttft-ms 300 --tokens-per-sec 40
+    LLM_BASE_URL=http://127.0.0.1:8090 LLM_API_KEY=stub python3 server_fixed.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass
+
+CANNED_ANSWERS_RU = (
+    "Конечно, давайте разберёмся.",
+    "Это хороший вопрос, и ответ на него довольно простой.",
+    "Если коротко, всё зависит от ваших целей и бюджета.",
+    "Я бы начал с самого важного, а детали обсудили бы потом.",
+    "Москва является столицей России и крупнейшим городом страны.",
+    "Для начала стоит проверить настройки и перезапустить приложение.",
+    "По прогнозу завтра будет солнечно, без осадков.",
+    "Попробуйте разбить задачу на несколько небольших шагов.",
+    "Да, это возможно, но потребуется немного времени.",
+    "Нет, к сожалению, так сделать не получится.",
+    "Рекомендую обратить внимание на качество сна и режим дня.",
+    "Вот основная идея: меньше лишних действий, больше результата.",
+    "Спасибо за вопрос, я постараюсь ответить максимально точно.",
+    "Обычно это занимает от пяти до десяти минут.",
+)
+
+_TOKEN_RE = re.compile(r"\s*[^\s,.!?]+|[,.!?]")
+
+
+@dataclass
+class StubConfig:
+    ttft_ms: float = 300.0            # задержка до первого токена
+    ttft_jitter_ms: float = 100.0     # равномерный разброс TTFT ±
+    tokens_per_sec: float = 40.0      # скорость генерации после первого токена
+    length_mean: int = 40             # средняя длина ответа в токенах
+    length_sd: int = 15               # разброс длины (нормальное распределение)
+    error_rate: float = 0.0           # доля запросов с HTTP 500 до начала стрима
+    midstream_error_rate: float = 0.0 # доля стримов, обрываемых посередине
+    stall_rate: float = 0.0           # доля запросов с TTFT * stall_factor (хвост латентности)
+    stall_factor: float = 10.0
+    seed: int | None = None
+
+
+def tokenize(text: str) -> list[str]:
+    """Грубая токенизация под BPE: слово с ведущим пробелом, пунктуация отдельно"""
+    return _TOKEN_RE.findall(text)
+
+
+class StubLLM:
+    """Генератор ответов и задержек по StubConfig"""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.requests = 0
+        self.errors = 0
+
+    def answer_tokens(self, max_tokens: int | None) -> list[str]:
+        cfg = self.config
+        target = max(1, int(self.rng.gauss(cfg.length_mean, cfg.length_sd)))
+        if max_tokens:
+            target = min(target, max_tokens)
+        tokens: list[str] = []
+        while len(tokens) < target:
+            sentence = self.rng.choice(CANNED_ANSWERS_RU)
+            tokens.extend(tokenize((" " if tokens else "") + sentence))
+        return tokens[:target]
+
+    def ttft_s(self) -> float:
+        cfg = self.config
+        ttft = cfg.ttft_ms + self.rng.uniform(-cfg.ttft_jitter_ms, cfg.ttft_jitter_ms)
+        if cfg.stall_rate and self.rng.random() < cfg.stall_rate:
+            ttft *= cfg.stall_factor
+        return max(0.0, ttft) / 1000.0
+
+
+def _sse_chunk(completion_id: str, model: str, created: int, delta: dict, finish_reason: str | None = None) -> bytes:
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return b"data: " + json.dumps(body, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def _http_chunk(data: bytes) -> bytes:
+    """Кадр chunked transfer-encoding"""
+    return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+
+async def _write_response(writer, status: str, content_type: str, body: bytes):
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+async def _read_request(reader) -> tuple[str, str, bytes] | None:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split()
+    if len(parts) < 2:
+        return None
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip() or 0)
+    body = await reader.readexactly(length) if length else b""
+    return parts[0], parts[1], body
+
+
+async def _stream_completion(writer, stub: StubLLM, request: dict):
+    cfg = stub.config
+    model = request.get("model") or "stub"
+    tokens = stub.answer_tokens(request.get("max_tokens"))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    writer.write(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/event-stream\r\n"
+        b"Cache-Control: no-cache\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n"
+    )
+    writer.write(_http_chunk(b": stub keep-alive\n\n"))
+    await writer.drain()
+
+    await asyncio.sleep(stub.ttft_s())
+    writer.write(_http_chunk(_sse_chunk(completion_id, model, created, {"role": "assistant", "content": ""})))
+
+    break_at = -1
+    if cfg.midstream_error_rate and stub.rng.random() < cfg.midstream_error_rate:
+        break_at = stub.rng.randrange(len(tokens))
+
+    interval = 1.0 / cfg.tokens_per_sec if cfg.tokens_per_sec > 0 else 0.0
+    started = time.monotonic()
+    for i, tok in enumerate(tokens):
+        if i == break_at:
+            stub.errors += 1
+            writer.close()  # обрыв соединения посреди стрима
+            return False
+        if interval and i:
+            # держим темп относительно старта, а не суммой sleep'ов
+            delay = started + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        writer.write(_http_chunk(_sse_chunk(completion_id, model, created, {"content": tok})))
+        await writer.drain()
+
+    writer.write(_http_chunk(_sse_chunk(completion_id, model, created, {}, finish_reason="stop")))
+    writer.write(_http_chunk(b"data: [DONE]\n\n"))
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+    return True
+
+
+async def _full_completion(writer, stub: StubLLM, request: dict):
+    await asyncio.sleep(stub.ttft_s())
+    tokens = stub.answer_tokens(request.get("max_tokens"))
+    body = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model") or "stub",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(tokens).strip()},
+            "finish_reason": "stop",
+        }],
+        "usage": {"completion_tokens": len(tokens)},
+    }
+    await _write_response(writer, "200 OK", "application/json", json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+
+async def start_stub_server(config: StubConfig, host: str = "127.0.0.1", port: int = 8090) -> asyncio.AbstractServer:
+    """Запускает заглушку в текущем event loop (для тестов и бенчмарков в одном процессе)"""
+    stub = StubLLM(config)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    req = await _read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if req is None:
+                    return
+                method, path, body = req
+
+                if method == "GET" and path.startswith("/health"):
+                    await _write_response(writer, "200 OK", "text/plain", b"ok")
+                    continue
+
+                if method != "POST" or not path.startswith("/v1/chat/completions"):
+                    await _write_response(writer, "404 Not Found", "text/plain", b"not found")
+                    continue
+
+                stub.requests += 1
+                try:
+                    request = json.loads(body or b"{}")
+                except json.JSONDecodeError:
+                    await _write_response(writer, "400 Bad Request", "application/json", b'{"error":"bad json"}')
+                    continue
+
+                if config.error_rate and stub.rng.random() < config.error_rate:
+                    stub.errors += 1
+                    await _write_response(writer, "500 Internal Server Error", "application/json",
+                                          b'{"error":{"message":"stub injected error"}}')
+                    continue
+
+                if request.get("stream"):
+                    if not await _stream_completion(writer, stub, request):
+                        return
+                else:
+                    await _full_completion(writer, stub, request)
+        except Exception as e:
+            print(f"[STUB] Ошибка: {e}")
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    srv = await asyncio.start_server(handle, host, port)
+    srv.stub = stub
+    return srv
+
+
+def _parse_args() -> tuple[StubConfig, str, int]:
+    ap = argparse.ArgumentParser(description="OpenAI-compatible streaming stub")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--ttft-ms", type=float, default=StubConfig.ttft_ms)
+    ap.add_argument("--ttft-jitter-ms", type=float, default=StubConfig.ttft_jitter_ms)
+    ap.add_argument("--tokens-per-sec", type=float, default=StubConfig.tokens_per_sec)
+    ap.add_argument("--length-mean", type=int, default=StubConfig.length_mean)
+    ap.add_argument("--length-sd", type=int, default=StubConfig.length_sd)
+    ap.add_argument("--error-rate", type=float, default=StubConfig.error_rate)
+    ap.add_argument("--midstream-error-rate", type=float, default=StubConfig.midstream_error_rate)
+    ap.add_argument("--stall-rate", type=float, default=StubConfig.stall_rate)
+    ap.add_argument("--stall-factor", type=float, default=StubConfig.stall_factor)
+    ap.add_argument("--seed", type=int, default=None)
+    a = ap.parse_args()
+    cfg = StubConfig(
+        ttft_ms=a.ttft_ms,
+        ttft_jitter_ms=a.ttft_jitter_ms,
+        tokens_per_sec=a.tokens_per_sec,
+        length_mean=a.length_mean,
+        length_sd=a.length_sd,
+        error_rate=a.error_rate,
+        midstream_error_rate=a.midstream_error_rate,
+        stall_rate=a.stall_rate,
+        stall_factor=a.stall_factor,
+        seed=a.seed,
+    )
+    return cfg, a.host, a.port
+
+
+async def main():
+    cfg, host, port = _parse_args()
+    srv = await start_stub_server(cfg, host, port)
+    print(f"[STUB] OpenAI-compatible stub на http://{host}:{port} "
+          f"(ttft={cfg.ttft_ms}±{cfg.ttft_jitter_ms}ms, {cfg.tokens_per_sec} tok/s, "
+          f"len={cfg.length_mean}±{cfg.length_sd}, errors={cfg.error_rate}/{cfg.midstream_error_rate})")
+    async with srv:
+        await srv.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный генератор: N одновременных голосовых сессий против WS-сервера (порт 2700).
+
+Каждая сессия проходит протокол клиента: config → ждём {"event": "ready"} →
+PCM16 mono 16 kHz фреймами по 20 мс в реальном времени (по абсолютному
+расписанию, без накопления дрейфа) → тишина, чтобы сработал endpointing →
+ожидание ответа (tts_end). WAV-файлы раздаются сессиям по кругу.
+
+Метрики (от конца речи в WAV — последнего фрейма громче порога):
+    final_ms        конец речи → событие final
+    first_audio_ms  конец речи → первый бинарный аудио-фрейм ответа
+    gap_ms          интервалы между аудио-фреймами одного ответа
+    underrun_ms     насколько интервал превысил длительность предыдущего фрейма
+Плюс CPU% и RSS сервера из /proc (процессы с server_fixed.py в cmdline или --pid).
+
+    python3 load_gen.py --wav samples/*.wav --sessions 1 5 10 20 --turns 3
+    python3 load_gen.py --wav q.wav --sessions 50 --ramp-s 10 --json >> capacity.jsonl
+
+Для замера самого сервера без сети и затрат: LLM_BASE_URL на llm_stub_server.py и
+TTS_PROVIDER=stub.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+import wave
+
+import numpy as np
+import websockets
+
+from metrics import percentile
+
+SAMPLE_RATE = 16000
+FRAME_MS = 20
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+AUDIO_HEADER = struct.Struct("<4sIHI")  # как send_audio_binary в server_fixed
+
+
+# ---------------------------------------------------------------------------
+# Аудио
+# ---------------------------------------------------------------------------
+
+class Clip:
+    """WAV, приведённый к PCM16 mono 16 kHz и нарезанный на 20 мс фреймы"""
+
+    __slots__ = ("name", "frames", "speech_end_frame")
+
+    def __init__(self, path: str, silence_db: float = -40.0):
+        with wave.open(path, "rb") as w:
+            channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            raw = w.readframes(w.getnframes())
+        if width != 2:
+            raise ValueError(f"{path}: нужен 16-bit PCM, sampwidth={width}")
+        pcm = np.frombuffer(raw, dtype="<i2").astype(np.float32)
+        if channels > 1:
+            pcm = pcm.reshape(-1, channels).mean(axis=1)
+        if rate != SAMPLE_RATE:
+            n_out = int(len(pcm) * SAMPLE_RATE / rate)
+            pcm = np.interp(np.linspace(0, len(pcm) - 1, n_out), np.arange(len(pcm)), pcm)
+        n_frames = len(pcm) // FRAME_SAMPLES
+        pcm = np.clip(pcm[: n_frames * FRAME_SAMPLES], -32768, 32767).astype("<i2")
+        frames = pcm.reshape(n_frames, FRAME_SAMPLES)
+
+        # последний фрейм речи — по RMS относительно полной шкалы
+        rms = np.sqrt((frames.astype(np.float32) ** 2).mean(axis=1)) / 32768.0
+        loud = np.nonzero(20 * np.log10(rms + 1e-9) > silence_db)[0]
+        self.name = os.path.basename(path)
+        self.frames = [f.tobytes() for f in frames]
+        self.speech_end_frame = int(loud[-1]) if len(loud) else n_frames - 1
+
+
+SILENCE_FRAME = bytes(FRAME_SAMPLES * 2)
+
+
+def wav_duration_s(wav: bytes) -> float:
+    """Длительность WAV-чанка ответа по заголовку (RIFF с 44-байтным заголовком)"""
+    if len(wav) < 44 or wav[:4] != b"RIFF":
+        return 0.0
+    channels, rate = struct.unpack_from("<HI", wav, 22)
+    bits = struct.unpack_from("<H", wav, 34)[0]
+    bytes_per_sec = rate * channels * bits // 8
+    return (len(wav) - 44) / bytes_per_sec if bytes_per_sec else 0.0
+
+
+# ---------------------------------------------------------------------------
+# Сессия
+# ---------------------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.final_ms: list[float] = []
+        self.first_audio_ms: list[float] = []
+        self.gap_ms: list[float] = []
+        self.underrun_ms: list[float] = []
+        self.sessions_ok = 0
+        self.errors: dict[str, int] = {}
+        self.turns_no_final = 0
+        self.turns_no_audio = 0
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def run_session(idx: int, uri: str, clips: list[Clip], args, stats: Stats):
+    loop = asyncio.get_running_loop()
+    try:
+        ws = await asyncio.wait_for(websockets.connect(uri, max_size=None, compression=None), timeout=10)
+    except Exception as e:
+        stats.error(f"connect:{type(e).__name__}")
+        return
+
+    ready = asyncio.Event()
+    turn_state: dict = {}
+    turn_done = asyncio.Event()
+
+    async def receive():
+        try:
+            await _receive()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # соединение закрыто — не ждём ready/tts_end до таймаута
+            ready.set()
+            turn_done.set()
+
+    async def _receive():
+        last_audio_t = 0.0
+        last_audio_dur = 0.0
+        async for msg in ws:
+            now = loop.time()
+            if isinstance(msg, bytes):
+                if len(msg) < AUDIO_HEADER.size or "speech_end" not in turn_state:
+                    continue
+                wav = msg[AUDIO_HEADER.size:]
+                if "first_audio" not in turn_state:
+                    turn_state["first_audio"] = now
+                    stats.first_audio_ms.append((now - turn_state["speech_end"]) * 1000.0)
+                elif last_audio_t:
+                    gap = (now - last_audio_t) * 1000.0
+                    stats.gap_ms.append(gap)
+                    stats.underrun_ms.append(max(0.0, gap - last_audio_dur * 1000.0))
+                last_audio_t = now
+                last_audio_dur = wav_duration_s(wav)
+                continue
+            try:
+                ev = json.loads(msg)
+            except json.JSONDecodeError:
+                continue
+            if ev.get("event") == "ready":
+                ready.set()
+            kind = ev.get("type")
+            if kind == "final" and "speech_end" in turn_state and "final" not in turn_state:
+                turn_state["final"] = now
+                stats.final_ms.append((now - turn_state["speech_end"]) * 1000.0)
+            elif kind in ("tts_end", "llm_error", "tts_error") and "final" in turn_state:
+                last_audio_t = 0.0
+                turn_done.set()
+
+    receiver = asyncio.create_task(receive())
+    try:
+        await ws.send(json.dumps({"config": {"sample_rate": SAMPLE_RATE, "words": False}}))
+        try:
+            await asyncio.wait_for(ready.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            stats.error("no_ready")
+            return
+
+        for turn in range(args.turns):
+            clip = clips[(idx + turn) % len(clips)]
+            turn_state.clear()
+            turn_done.clear()
+            frames = clip.frames + [SILENCE_FRAME] * (args.trailing_silence_ms // FRAME_MS)
+            t0 = loop.time()
+            for i, frame in enumerate(frames):
+                delay = t0 + i * FRAME_MS / 1000.0 - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await ws.send(frame)
+                if i == clip.speech_end_frame:
+                    turn_state["speech_end"] = loop.time()
+            try:
+                await asyncio.wait_for(turn_done.wait(), timeout=args.turn_timeout_s)
+            except asyncio.TimeoutError:
+                pass
+            if "final" not in turn_state:
+                stats.turns_no_final += 1
+            elif "first_audio" not in turn_state:
+                stats.turns_no_audio += 1
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000.0)
+        stats.sessions_ok += 1
+    except websockets.ConnectionClosed as e:
+        stats.error(f"closed:{e.code}")
+    finally:
+        receiver.cancel()
+        await ws.close()
+
+
+# ---------------------------------------------------------------------------
+# Сервер: CPU / RSS из /proc
+# ---------------------------------------------------------------------------
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def find_server_pids(pattern: str) -> list[int]:
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode("utf-8", "replace")
+        except OSError:
+            continue
+        if pattern in cmdline:
+            pids.append(int(name))
+    return pids
+
+
+def _cpu_ticks(pid: int) -> int:
+    with open(f"/proc/{pid}/stat") as f:
+        # comm может содержать пробелы — поля считаем после ')'
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[11]) + int(fields[12])  # utime + stime
+
+
+def _rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+class ProcSampler:
+    """Суммарные CPU% и RSS процессов сервера раз в interval_s"""
+
+    def __init__(self, pids: list[int], interval_s: float = 1.0):
+        self.pids = pids
+        self.interval_s = interval_s
+        self.cpu_pct: list[float] = []
+        self.rss_mb: list[float] = []
+
+    async def run(self):
+        prev = None
+        while True:
+            t = time.monotonic()
+            ticks, rss = 0, 0.0
+            for pid in self.pids:
+                try:
+                    ticks += _cpu_ticks(pid)
+                    rss += _rss_mb(pid)
+                except (OSError, IndexError, ValueError):
+                    continue
+            if prev is not None:
+                dt = t - prev[0]
+                self.cpu_pct.append((ticks - prev[1]) / CLK_TCK / dt * 100.0 if dt > 0 else 0.0)
+            self.rss_mb.append(rss)
+            prev = (t, ticks)
+            await asyncio.sleep(self.interval_s)
+
+
+# ---------------------------------------------------------------------------
+# Прогон
+# ---------------------------------------------------------------------------
+
+def _dist(values: list[float]) -> dict:
+    return {"n": len(values), "p50": percentile(values, 50, 1), "p95": percentile(values, 95, 1),
+            "p99": percentile(values, 99, 1)}
+
+
+async def run_step(n: int, uri: str, clips: list[Clip], args, pids: list[int]) -> dict:
+    stats = Stats()
+    sampler = ProcSampler(pids, args.sample_s)
+    sampler_task = asyncio.create_task(sampler.run()) if pids else None
+    t0 = time.monotonic()
+
+    async def delayed(i: int):
+        if args.ramp_s and n > 1:
+            await asyncio.sleep(args.ramp_s * i / n)
+        await run_session(i, uri, clips, args, stats)
+
+    await asyncio.gather(*(delayed(i) for i in range(n)))
+    if sampler_task:
+        sampler_task.cancel()
+
+    cpu = sampler.cpu_pct
+    return {
+        "sessions": n,
+        "duration_s": round(time.monotonic() - t0, 1),
+        "sessions_ok": stats.sessions_ok,
+        "errors": stats.errors,
+        "turns_no_final": stats.turns_no_final,
+        "turns_no_audio": stats.turns_no_audio,
+        "final_ms": _dist(stats.final_ms),
+        "first_audio_ms": _dist(stats.first_audio_ms),
+        "gap_ms": _dist(stats.gap_ms),
+        "underrun_ms": _dist(stats.underrun_ms),
+        "server_cpu_pct": {"avg": round(sum(cpu) / len(cpu), 1) if cpu else None,
+                           "max": round(max(cpu), 1) if cpu else None},
+        "server_rss_mb_max": round(max(sampler.rss_mb), 1) if sampler.rss_mb else None,
+    }
+
+
+def print_row(r: dict):
+    def d(key):
+        v = r[key]
+        return f"{v['p50']}/{v['p95']}/{v['p99']}"
+
+    print(
+        f"N={r['sessions']:<4} ok={r['sessions_ok']:<4} "
+        f"final={d('final_ms'):<20} first_audio={d('first_audio_ms'):<20} "
+        f"gap={d('gap_ms'):<18} underrun={d('underrun_ms'):<16} "
+        f"cpu={r['server_cpu_pct']['avg']}%/{r['server_cpu_pct']['max']}% rss={r['server_rss_mb_max']}MB "
+        f"no_final={r['turns_no_final']} no_audio={r['turns_no_audio']} errors={r['errors'] or '-'}",
+        flush=True,
+    )
+
+
+async def main_async(args) -> int:
+    clips = [Clip(p, args.silence_db) for p in args.wav]
+    pids = args.pid or find_server_pids(args.server_pattern)
+    if not pids:
+        print(f"⚠️  процесс сервера ('{args.server_pattern}') не найден — CPU/RSS не собираются", file=sys.stderr)
+    uri = args.uri + (("&" if "?" in args.uri else "?") + f"token={args.token}" if args.token else "")
+
+    if not args.json:
+        print("# метрики — p50/p95/p99, мс", flush=True)
+    for n in args.sessions:
+        row = await run_step(n, uri, clips, args, pids)
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False), flush=True)
+        else:
+            print_row(row)
+        if args.pause_s:
+            await asyncio.sleep(args.pause_s)
+    return 0
+
+
+def _parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--uri", default="ws://127.0.0.1:2700")
+    ap.add_argument("--token", default=None, help="JWT для ?token=, если авторизация включена")
+    ap.add_argument("--wav", nargs="+", required=True, help="WAV-файлы с репликами (16-bit PCM)")
+    ap.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10], help="ступени числа сессий")
+    ap.add_argument("--turns", type=int, default=3, help="реплик на сессию")
+    ap.add_argument("--ramp-s", type=float, default=2.0, help="разнесение старта сессий")
+    ap.add_argument("--think-ms", type=int, default=500, help="пауза между репликами после ответа")
+    ap.add_argument("--trailing-silence-ms", type=int, default=2000, help="тишина после WAV для endpointing")
+    ap.add_argument("--turn-timeout-s", type=float, default=20.0)
+    ap.add_argument("--silence-db", type=float, default=-40.0, help="порог конца речи в WAV, dBFS")
+    ap.add_argument("--pause-s", type=float, default=2.0, help="пауза между ступенями")
+    ap.add_argument("--pid", type=int, nargs="*", default=None, help="PID сервера (иначе поиск по cmdline)")
+    ap.add_argument("--server-pattern", default="server_fixed.py")
+    ap.add_argument("--sample-s", type=float, default=1.0, help="период опроса /proc")
+    ap.add_argument("--json", action="store_true", help="строка JSON на ступень")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main_async(_parse_args())))
@@ -0,0 +1,163 @@
+"""
+Метрики в текстовом формате Prometheus для /metrics на health-порту.
+
+Без зависимостей: гистограммы с фиксированными бакетами (observe — bisect и два
+инкремента), счётчики и gauge'и. Gauge может вычисляться при каждом scrape
+через функцию (размеры очередей, число сессий, доля попаданий в кеш).
+
+percentile() — общий nearest-rank перцентиль для отчётов (трассы, load_gen,
+batch_pipeline, test_ws).
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# Бакеты задержек в миллисекундах: от единиц мс (WS send) до десятков секунд (LLM total)
+LATENCY_MS_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 750, 1000, 1500, 2500, 5000, 10000, 30000)
+# Скорость синтеза, мс на символ
+MS_PER_CHAR_BUCKETS = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 100)
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def percentile(values: Iterable[float], p: float, ndigits: int | None = None) -> float | None:
+    """Nearest-rank: наименьшее значение, не меньше которого p% выборки; None — выборка пуста"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    # p * n / 100 точно для целых p; допуск — от погрешности дробных p
+    rank = math.ceil(p * len(ordered) / 100.0 - 1e-9)
+    value = ordered[max(0, min(len(ordered), rank) - 1)]
+    return value if ndigits is None else round(value, ndigits)
+
+
+class Histogram:
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_MS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for le, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{_fmt(le)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_fmt(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Counter:
+    __slots__ = ("name", "help", "value", "fn")
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float] | None = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn   # счётчик, который уже ведётся в другом месте (HEDGE_STATS, outbox)
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+    def render(self) -> list[str]:
+        value = self.fn() if self.fn is not None else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {_fmt(value)}"]
+
+
+class Gauge:
+    __slots__ = ("name", "help", "value", "fn")
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float] | None = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+    def dec(self, n: float = 1):
+        self.value -= n
+
+    def render(self) -> list[str]:
+        value = self.fn() if self.fn is not None else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_fmt(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Histogram | Counter | Gauge] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_MS_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def counter(self, name: str, help: str, fn: Callable[[], float] | None = None) -> Counter:
+        return self._add(Counter(name, help, fn))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float] | None = None) -> Gauge:
+        return self._add(Gauge(name, help, fn))
+
+    def render(self) -> bytes:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # сломанный callback не должен ронять весь scrape
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+REGISTRY = Registry()
+
+# Задержки голосового конвейера (мс)
+ASR_FINAL_LAG_MS = REGISTRY.histogram(
+    "voice_asr_final_lag_ms", "Vosk FinalResult() decode time when an utterance is finalized")
+ENDPOINT_DECISION_MS = REGISTRY.histogram(
+    "voice_endpoint_decision_ms", "Silence after last voiced frame when endpointing decided final")
+LLM_TTFT_MS = REGISTRY.histogram(
+    "voice_llm_ttft_ms", "LLM request start to first streamed token")
+LLM_TOTAL_MS = REGISTRY.histogram(
+    "voice_llm_total_ms", "LLM request start to end of stream")
+TTS_SYNTH_MS_PER_CHAR = REGISTRY.histogram(
+    "voice_tts_synth_ms_per_char", "TTS synthesis time per input character", MS_PER_CHAR_BUCKETS)
+FIRST_AUDIO_MS = REGISTRY.histogram(
+    "voice_first_audio_ms", "LLM start (after final ASR) to first TTS audio frame sent")
+WS_SEND_MS = REGISTRY.histogram(
+    "voice_ws_send_ms", "WebSocket send time including send-lock wait")
+
+WS_CONNECTIONS = REGISTRY.gauge("voice_ws_connections", "Open WebSocket connections")
+
+# Кеш TTS-фраз (ACK и повторы)
+TTS_CACHE_HITS = REGISTRY.counter("voice_tts_cache_hits_total", "TTS synthesize_wav served from phrase cache")
+TTS_CACHE_MISSES = REGISTRY.counter("voice_tts_cache_misses_total", "TTS synthesize_wav that had to synthesize")
+REGISTRY.gauge(
+    "voice_tts_cache_hit_ratio", "TTS phrase cache hits / lookups since start",
+    lambda: TTS_CACHE_HITS.value / max(1, TTS_CACHE_HITS.value + TTS_CACHE_MISSES.value),
+)
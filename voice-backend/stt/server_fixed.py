@@ -1,30 +1,33 @@
+from __future__ import annotations
+
 import asyncio
 import base64
+import gc
+import ipaddress
 import json
 import logging
 import os
 import signal
 import struct
 import time
-from typing import Optional, List, Dict, AsyncIterator, Union
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from enum import Enum
 # from urllib.parse import urlparse, parse_qs  # REMOVED: no longer needed
-from pathlib import Path
+
+from startup_profile import STARTUP, lazy_import
 
 import websockets
 from websockets.server import WebSocketServerProtocol
 import httpx
 import webrtcvad
-from langdetect import detect
 from dotenv import load_dotenv
-import jwt
 
-# Voice Session States
-class VoiceState(Enum):
-    IDLE = "idle"              # Waiting for user input
-    USER_SPEAKING = "user"     # ASR active, user is speaking
-    ASSISTANT_TTS = "tts"      # Assistant is speaking via TTS
+# Тяжёлые модули (torch через tts_silero, vosk, jwt) импортируются
+# при первом обращении — до этого успевают открыться health/ready-порты
+jwt = lazy_import("jwt")
+vosk = lazy_import("vosk")
+tts_silero = lazy_import("tts_silero")
 
 # Import for JWT fallback
 from urllib.parse import urlparse, parse_qs
@@ -73,9 +76,8 @@ This contract MUST be maintained at all times. Violations are logged as PROTO VI
 Violations MUST be logged and fixed immediately.
 """
 
-from vosk import Model, KaldiRecognizer, SetLogLevel
 from agents import AGENTS
-import tts_silero
+from llm_stream import aiter_sse_deltas, hedged_stream, HEDGE_STATS
 
 # Загрузка переменных окружения из .env файла
 # Сначала пытаемся загрузить из корня проекта (../../.env), затем из текущей директории
@@ -86,10 +88,48 @@ if os.path.exists(os.path.join(PROJECT_ROOT, ".env")):
 else:
     load_dotenv()  # Fallback на текущую директорию
 
-# Настройка логирования
-logger = logging.getLogger("ws")
+# Модули, читающие конфиг из окружения при импорте, — после load_dotenv
+from voice_log import get_logger, ring_records
+from session_store import (
+    SessionState, SessionStore, SQLiteSessionBackend, SnapshotStore, SESSION_DB_PATH, SESSION_SNAPSHOT_PATH,
+)
+from event_outbox import VoiceControlOutbox
+from session_events import EVENT_BUS, TERMINAL_EVENTS, sse_frame
+from utterance_trace import TRACER
+from session_recorder import SessionRecorder
+from worker_supervisor import Supervisor
+from admission import ADMISSION, CLOSE_TRY_AGAIN_LATER
+from metrics import REGISTRY, WS_SEND_MS, WS_CONNECTIONS, TTS_CACHE_HITS, TTS_CACHE_MISSES
+from voice_pipeline import VoicePipeline, VAD_MODE, now_ms
+from tts_lang import LangRouter, concat_wav
+
+# Настройка логирования: stdlib logging — для библиотек (websockets, httpx),
+# собственные логи — через voice_log (уровни по подсистемам, ленивое форматирование)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+log_boot = get_logger("BOOT")
+log_shutdown = get_logger("SHUTDOWN")
+log_config = get_logger("CONFIG")
+log_http = get_logger("HTTP")
+log_auth = get_logger("AUTH")
+log_agent = get_logger("AGENT")
+log_handler = get_logger("HANDLER")
+log_handshake = get_logger("HANDSHAKE")
+log_proto = get_logger("PROTO")
+log_ws = get_logger("WS")
+log_audio = get_logger("AUDIO")
+log_vad = get_logger("VAD")
+log_asr = get_logger("ASR")
+log_endpoint = get_logger("ENDPOINT")
+log_state = get_logger("STATE")
+log_echo = get_logger("ECHO")
+log_session = get_logger("SESSION")
+log_llm = get_logger("LLM")
+log_chat = get_logger("CHAT")
+log_tts = get_logger("TTS")
+log_retry = get_logger("RETRY")
+log_voice_control = get_logger("VOICE_CONTROL")
+
 # Оптимизация event loop для Linux
 try:
     import uvloop
@@ -100,9 +140,9 @@ except ImportError:
 # Feature flag для отключения VoiceAsk (legacy)
 VOICE_API_MODE = os.getenv('VOICE_API_MODE', 'true').lower() == 'true'
 if VOICE_API_MODE:
-    logger.info("🎯 VOICE API MODE: ENABLED (только WS realtime)")
+    log_boot.info("🎯 VOICE API MODE: ENABLED (только WS realtime)")
 else:
-    logger.info("🔄 VOICE API MODE: DISABLED (legacy VoiceAsk активен)")
+    log_boot.info("🔄 VOICE API MODE: DISABLED (legacy VoiceAsk активен)")
 
 # Voice Control integration
 VOICE_CONTROL_URL = os.getenv("VOICE_CONTROL_URL", "http://localhost:8080")
@@ -130,31 +170,29 @@ def normalize_event(*, event_type: str, role: str, text: str | None, timestamp:
         "ts": int((timestamp or time.time()) * 1000),
     }
 
-async def push_event_to_voice_control(session_id: str, event_payload: dict):
-    """Отправить нормализованное событие диалога в Voice Control"""
+# Фоновая очередь событий в Voice Control (realtime-путь не ждёт сети)
+VOICE_CONTROL_OUTBOX = VoiceControlOutbox(
+    VOICE_CONTROL_URL,
+    VOICE_INTERNAL_KEY,
+    maxsize=int(os.getenv("VOICE_CONTROL_QUEUE_MAX", "1000")),
+    batch_max=int(os.getenv("VOICE_CONTROL_BATCH_MAX", "32")),
+    flush_ms=int(os.getenv("VOICE_CONTROL_FLUSH_MS", "50")),
+    max_retries=int(os.getenv("VOICE_CONTROL_MAX_RETRIES", "3")),
+    backoff_ms=int(os.getenv("VOICE_CONTROL_BACKOFF_MS", "200")),
+    batch_path=os.getenv("VOICE_CONTROL_BATCH_PATH", ""),  # напр. "/batch", если Voice Control его поддерживает
+)
+
+def push_event_to_voice_control(session_id: str, event_payload: dict):
+    """Поставить нормализованное событие диалога в очередь отправки в Voice Control"""
     if not VOICE_INTERNAL_KEY or not VOICE_CONTROL_URL:
         return
 
     if not event_payload:
-        print(f"[EVENT] Dropped invalid event for session {session_id}")
+        log_voice_control.warn("Dropped invalid event for session %s", session_id)
         return
 
-    url = f"{VOICE_CONTROL_URL}/v1/internal/voice/sessions/{session_id}/events"
-
-    try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(2.0)) as client:
-            response = await client.post(
-                url,
-                headers={"X-Internal-Key": VOICE_INTERNAL_KEY, "Content-Type": "application/json"},
-                json=event_payload,
-            )
-            if response.status_code == 200:
-                print(f"[VOICE_CONTROL] Event pushed: {event_payload.get('role')} ({len(event_payload.get('text', ''))} chars)")
-            else:
-                print(f"[VOICE_CONTROL] Push failed: HTTP {response.status_code}")
-    except Exception as e:
-        # Не блокируем realtime, просто логируем
-        print(f"[VOICE_CONTROL] Push error: {e}")
+    if not VOICE_CONTROL_OUTBOX.put(session_id, event_payload):
+        log_voice_control.warn("Outbox full, event dropped (%s total)", VOICE_CONTROL_OUTBOX.dropped_full)
 
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "2700"))
@@ -175,14 +213,21 @@ OPENAI_API_KEY = LLM_API_KEY  # Для совместимости с кодом
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
 OPENAI_MODEL = LLM_MODEL  # Для совместимости с кодом
 
+# Hedging: если первый токен не пришёл за LLM_HEDGE_DELAY_MS, шлём дубль запроса
+# (на LLM_HEDGE_BASE_URL или тот же LLM_BASE_URL) и стримим того, кто ответит первым
+LLM_HEDGE_DELAY_MS = int(os.getenv("LLM_HEDGE_DELAY_MS", "0"))  # 0 = hedging выключен
+LLM_HEDGE_BASE_URL = os.getenv("LLM_HEDGE_BASE_URL", "")
+LLM_HEDGE_API_KEY = os.getenv("LLM_HEDGE_API_KEY") or LLM_API_KEY
+
 # Log LLM configuration for debugging
-logger.info(f"🔧 LLM Configuration: provider={LLM_PROVIDER}, base_url={LLM_BASE_URL}, model={LLM_MODEL}, api_key={'*' * 10 if LLM_API_KEY else 'NOT SET'}")
+log_boot.info("🔧 LLM Configuration: provider=%s, base_url=%s, model=%s, api_key=%s",
+              LLM_PROVIDER, LLM_BASE_URL, LLM_MODEL, '*' * 10 if LLM_API_KEY else 'NOT SET')
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "160"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.3"))
 
 # TTS настройки
-TTS_PROVIDER = os.getenv("TTS_PROVIDER", "local")  # local (silero) or openai
-TTS_BASE_URL = os.getenv("TTS_BASE_URL", "http://127.0.0.1:8002")
+TTS_PROVIDER = os.getenv("TTS_PROVIDER", "local")  # local (silero), remote (tts_server.py), openai или stub (тишина, для replay/нагрузки)
+TTS_BASE_URL = os.getenv("TTS_BASE_URL", "http://127.0.0.1:8003")  # tts_server.py: TTS_PROVIDER=remote и fallback local
 TTS_API_KEY = os.getenv("TTS_API_KEY")  # для внешних API
 TTS_MODEL = os.getenv("TTS_MODEL", "silero_ru")
 TTS_VOICE = os.getenv("TTS_VOICE", "eugene")
@@ -190,6 +235,9 @@ TTS_SPEED = float(os.getenv("TTS_SPEED", "0.93"))
 TTS_EMOTION = os.getenv("TTS_EMOTION", "neutral")
 TTS_PAUSE = float(os.getenv("TTS_PAUSE", "0.12"))
 TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "10"))
+# TTS_PROVIDER=stub: имитация синтеза — задержка на символ и длительность тишины
+TTS_STUB_MS_PER_CHAR = float(os.getenv("TTS_STUB_MS_PER_CHAR", "2"))
+TTS_STUB_CHARS_PER_SEC = float(os.getenv("TTS_STUB_CHARS_PER_SEC", "15"))
 
 # JWT Configuration для проверки токенов
 VOICE_JWT_SECRET = os.getenv("VOICE_JWT_SECRET", "super-secret-voice-2026")
@@ -209,56 +257,13 @@ class TTSSettings:
     pause: float
     timeout: float
 
-# Бинарный протокол аудио
-MIME_WAV = 1
-AUDIO_MAGIC = b"AUD0"
-
-# Фиксированная политика sample rate
-ALLOWED_SAMPLE_RATE = 16000
-
-def normalize_sample_rate(requested: int | None) -> int:
-    """Нормализует sample_rate: сервер поддерживает только 16000 Hz PCM16 mono"""
-    if requested != ALLOWED_SAMPLE_RATE:
-        print(f"[CONFIG] Client requested sample_rate={requested}, forcing to {ALLOWED_SAMPLE_RATE}")
-        return ALLOWED_SAMPLE_RATE
-    return requested
-
-# Структуры для хранения истории диалога
-from dataclasses import dataclass, field
-
-@dataclass
-class Turn:
-    role: str            # "user" | "assistant"
-    text: str
-    ts: int = field(default_factory=lambda: int(time.time() * 1000))
-    utterance_id: int | None = None
-
-@dataclass
-class SessionState:
-    session_id: str
-    agent_id: str
-    turns: list[Turn] = field(default_factory=list)
-    llm_buffers: dict[int, str] = field(default_factory=dict)
-    summary: str = ""
-    ended: bool = False
-    ended_at_ms: int | None = None
-
-    def add_turn(self, role: str, text: str, utterance_id: int | None = None):
-        text = (text or "").strip()
-        if not text:
-            return
-        self.turns.append(Turn(role=role, text=text, utterance_id=utterance_id))
-        print(f"[SESSION:{self.session_id}] Added {role} turn: '{text[:50]}...'")
-
-    def build_llm_messages(self, system_prompt: str, max_turns: int = 12):
-        history = self.turns[-max_turns:]
-        messages = [{"role": "system", "content": system_prompt}]
-        for t in history:
-            messages.append({"role": "user" if t.role == "user" else "assistant", "content": t.text})
-        return messages
 
-# Глобальный реестр сессий
-SESSIONS: dict[str, SessionState] = {}
+# Глобальный реестр сессий: idle-TTL, лимит реплик, опционально SQLite write-behind
+# и общие для воркеров снимки (переподключение может попасть в другой процесс)
+SESSIONS = SessionStore(
+    backend=SQLiteSessionBackend(SESSION_DB_PATH) if SESSION_DB_PATH else None,
+    snapshots=SnapshotStore(SESSION_SNAPSHOT_PATH) if SESSION_SNAPSHOT_PATH else None,
+)
 
 def build_session_summary(session: SessionState) -> str:
     """Формирует резюме сессии на основе истории диалога"""
@@ -291,20 +296,25 @@ def build_session_summary(session: SessionState) -> str:
 # Health check настройки
 HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8081"))
 
-# VAD и endpointing параметры
-FRAME_MS = int(os.getenv("FRAME_MS", "20"))          # 10/20/30 ms
-VAD_MODE = int(os.getenv("VAD_MODE", "2"))           # 0..3 (0 мягкий, 3 агрессивный)
-EARLY_PAUSE_MS = int(os.getenv("EARLY_PAUSE_MS", "300"))   # Уменьшено: быстрее старт
-FINAL_PAUSE_MS = int(os.getenv("FINAL_PAUSE_MS", "800"))   # Уменьшено: быстрее финал
-STABLE_MS = int(os.getenv("STABLE_MS", "250"))
-PARTIAL_RATE_LIMIT_MS = int(os.getenv("PARTIAL_RATE_LIMIT_MS", "150"))
-MIN_WORDS_EARLY = int(os.getenv("MIN_WORDS_EARLY", "1"))   # Было 3: теперь реагирует на 1 слово
-MIN_CHARS_EARLY = int(os.getenv("MIN_CHARS_EARLY", "3"))   # Было 12: теперь реагирует на "Да", "Нет"
+# WORKERS > 1: супервизор на HEALTH_PORT и N воркеров на PORT (SO_REUSEPORT),
+# у воркера i свой health/API порт HEALTH_PORT + 1 + i
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_CHECK_S = float(os.getenv("WORKER_CHECK_S", "2"))
+WORKER_SHUTDOWN_TIMEOUT_S = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT_S", "15"))
+# Загрузить и прогреть Vosk/Silero в супервизоре до fork: страницы моделей общие (copy-on-write)
+WORKER_PRELOAD = os.getenv("WORKER_PRELOAD", "1") == "1"
+
+# Запись входящих сообщений сессий для replay (test_ws.py --replay); пусто — выключено
+SESSION_RECORD_DIR = os.getenv("SESSION_RECORD_DIR", "")
+
 RESTART_DEBOUNCE_MS = int(os.getenv("RESTART_DEBOUNCE_MS", "200")) # Было 1200! Теперь мгновенно.
 
 # Глобальный HTTP клиент для DeepSeek (keep-alive)
 _deepseek_http: httpx.AsyncClient | None = None
 
+# HTTP клиент для резервного LLM endpoint (hedging), если он отличается от основного
+_llm_hedge_http: httpx.AsyncClient | None = None
+
 # Глобальный HTTP клиент для TTS (keep-alive)
 _tts_http: httpx.AsyncClient | None = None
 
@@ -313,12 +323,72 @@ ALLOWED_ORIGINS = set(
     o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()
 )
 
-# Чтобы event loop не “умирал” на CPU-bound декодинге, гоняем декод в thread pool
-DECODE_IN_THREAD = os.getenv("DECODE_IN_THREAD", "1") == "1"
 
-print(f"[boot] loading model: {MODEL_PATH}")
-MODEL = Model(MODEL_PATH)
-print("[boot] model loaded")
+# Vosk-модель: загружается load_models() после открытия health-порта; WS-порт
+# начинает слушать только когда она готова
+MODEL = None
+
+STARTUP.require("asr", "ws")
+if TTS_PROVIDER == "local":
+    STARTUP.require("tts")
+
+
+def load_asr_model():
+    """Загрузка Vosk и прогон полсекунды тишины (первый decode инициализирует графы)"""
+    global MODEL
+    if STARTUP.is_ready("asr"):
+        return
+    with STARTUP.phase("vosk_load"):
+        log_boot.info("loading model: %s", MODEL_PATH)
+        model = vosk.Model(MODEL_PATH)
+    with STARTUP.phase("vosk_warm"):
+        rec = vosk.KaldiRecognizer(model, DEFAULT_SAMPLE_RATE)
+        rec.AcceptWaveform(bytes(DEFAULT_SAMPLE_RATE))
+        rec.FinalResult()
+    MODEL = model
+    STARTUP.set_ready("asr")
+    log_boot.info("model loaded")
+
+
+def tts_preload_models() -> list[str]:
+    """
+    Модели Silero, которые может выбрать синтез: TTS_MODEL и модели агентов (по
+    умолчанию silero_ru, см. serve_session). LangRouter отправляет латиницу в silero_en,
+    кириллицу в silero_ru, поэтому при любой из них грузится и прогревается вся пара —
+    иначе первое английское слово в ответе ждёт холодный torch.hub.load в каждом воркере.
+    """
+    models = [TTS_MODEL] + [agent.get("tts_model", "silero_ru") for agent in AGENTS.values()]
+    if any(m in ("silero_ru", "silero_en") for m in models):
+        models += ["silero_ru", "silero_en"]
+    return [m for m in dict.fromkeys(models) if m in tts_silero.MODEL_CONFIGS]
+
+
+def load_tts_models(preload: bool = False) -> int | None:
+    """
+    Загрузка и прогрев Silero (TTS_PROVIDER=local). preload=True — вариант до fork
+    воркеров (см. tts_silero.preload): возвращает прежнее число потоков torch.
+    """
+    if TTS_PROVIDER != "local" or STARTUP.is_ready("tts"):
+        return None
+    threads = None
+    try:
+        with STARTUP.phase("silero_load_warm"):
+            models = tts_preload_models()
+            if preload:
+                threads = tts_silero.preload(models)
+            else:
+                tts_silero.warm(models)
+    except Exception as e:
+        # synthesize_wav в этом случае уходит в HTTP fallback на tts_server
+        log_boot.error("Silero не загружен (%s) — TTS пойдёт через HTTP fallback", e)
+    STARTUP.set_ready("tts")
+    return threads
+
+
+async def load_models():
+    """Vosk и Silero грузятся параллельно: обе загрузки — в основном C/IO и отпускают GIL"""
+    with STARTUP.phase("load_models"):
+        await asyncio.gather(asyncio.to_thread(load_asr_model), asyncio.to_thread(load_tts_models))
 
 
 def verify_ws_token(token: str) -> dict:
@@ -371,6 +441,32 @@ async def close_openai_http():
         await _deepseek_http.aclose()
         _deepseek_http = None
 
+async def init_llm_hedge_http():
+    """Инициализирует HTTP клиент для резервного LLM endpoint (только если задан LLM_HEDGE_BASE_URL)"""
+    global _llm_hedge_http
+    if _llm_hedge_http is None and LLM_HEDGE_BASE_URL:
+        _llm_hedge_http = httpx.AsyncClient(
+            base_url=LLM_HEDGE_BASE_URL,
+            headers={
+                "Authorization": f"Bearer {LLM_HEDGE_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=60.0,
+            ),
+        )
+
+async def close_llm_hedge_http():
+    """Закрывает HTTP клиент резервного LLM endpoint"""
+    global _llm_hedge_http
+    if _llm_hedge_http is not None:
+        await _llm_hedge_http.aclose()
+        _llm_hedge_http = None
+
 # TTS HTTP клиент для внешних API
 _tts_api_http: httpx.AsyncClient | None = None
 
@@ -416,101 +512,237 @@ async def close_tts_http():
         await _tts_http.aclose()
         _tts_http = None
 
-async def health_server():
-    async def handle(reader, writer):
-        try:
-            data = await reader.read(4096)
-            if not data:
-                writer.close()
-                return
+# Очереди LLM→TTS активных соединений (для gauge'ей глубины)
+LLM_TO_TTS_QUEUES: set[asyncio.Queue] = set()
+
+REGISTRY.gauge("voice_sessions", "Sessions held in memory", lambda: len(SESSIONS))
+REGISTRY.gauge("voice_sessions_attached", "Sessions with an open WebSocket",
+               lambda: sum(1 for _, s in SESSIONS.items() if s.attached))
+REGISTRY.gauge("voice_llm_to_tts_queue_depth", "Items queued LLM→TTS, summed over connections",
+               lambda: sum(q.qsize() for q in LLM_TO_TTS_QUEUES))
+REGISTRY.gauge("voice_llm_to_tts_queue_depth_max", "Deepest LLM→TTS queue among connections",
+               lambda: max((q.qsize() for q in LLM_TO_TTS_QUEUES), default=0))
+REGISTRY.gauge("voice_control_outbox_depth", "Voice Control events waiting to be sent",
+               lambda: VOICE_CONTROL_OUTBOX.stats()["queued"])
+REGISTRY.counter("voice_control_dropped_total", "Voice Control events dropped (full, rejected, failed)",
+                 lambda: VOICE_CONTROL_OUTBOX.dropped_full + VOICE_CONTROL_OUTBOX.dropped_rejected
+                 + VOICE_CONTROL_OUTBOX.dropped_failed)
+REGISTRY.gauge("voice_sse_subscribers", "Open SSE /events streams", EVENT_BUS.subscribers)
+REGISTRY.counter("voice_sse_dropped_total", "SSE events dropped for slow subscribers", lambda: EVENT_BUS.dropped)
+REGISTRY.counter("voice_llm_hedged_total", "LLM requests that sent a hedge request", lambda: HEDGE_STATS.hedged)
+REGISTRY.counter("voice_llm_hedge_wins_total", "Hedged LLM requests won by the hedge", lambda: HEDGE_STATS.hedge_wins)
+REGISTRY.gauge("voice_admission_slots", "Sessions this process can still admit within its CPU budget",
+               lambda: ADMISSION.capacity()["slots"])
+REGISTRY.counter("voice_admission_rejected_total", "Sessions closed with 1013 by admission control",
+                 lambda: ADMISSION.rejected)
+REGISTRY.gauge("voice_event_loop_lag_ms", "Max event loop lag over the last second", lambda: ADMISSION.loop_lag_ms)
+REGISTRY.gauge("voice_asr_rtf", "ASR decode time / audio time over the last sample", lambda: ADMISSION.asr_rtf)
+REGISTRY.gauge("voice_tts_rtf", "TTS synthesis time / audio time over the last sample", lambda: ADMISSION.tts_rtf)
+
+# Keep-alive соединения health/API сервера закрываются после простоя
+HEALTH_KEEPALIVE_S = float(os.getenv("HEALTH_KEEPALIVE_S", "30"))
+# Комментарий-пинг в SSE, чтобы прокси не рвали тихий поток и мы замечали ушедших клиентов
+SSE_PING_S = float(os.getenv("SSE_PING_S", "15"))
+# /debug/* отдают логи и трассы с текстами реплик, а health-порт слушает 0.0.0.0:
+# local — только с loopback (по умолчанию), 1 — с любого адреса, 0 — выключены
+DEBUG_ENDPOINTS = os.getenv("DEBUG_ENDPOINTS", "local").lower()
+
+def _debug_allowed(writer: asyncio.StreamWriter) -> bool:
+    if DEBUG_ENDPOINTS in ("1", "true"):
+        return True
+    if DEBUG_ENDPOINTS != "local":
+        return False
+    peer = writer.get_extra_info("peername")
+    try:
+        return ipaddress.ip_address(peer[0]).is_loopback
+    except (TypeError, IndexError, ValueError):
+        return False
 
-            # parse first line: METHOD PATH HTTP/1.1
-            line0 = data.split(b"\r\n", 1)[0].decode("utf-8", "ignore")
-            parts = line0.split()
-            method = parts[0] if len(parts) > 0 else ""
-            path = parts[1] if len(parts) > 1 else ""
-
-            # --- /health ---
-            if method == "GET" and path.startswith("/health"):
-                body = b"ok"
-                writer.write(
-                    b"HTTP/1.1 200 OK\r\n"
-                    b"Content-Type: text/plain\r\n"
-                    b"Content-Length: 2\r\n\r\n" + body
-                )
-                await writer.drain()
-                writer.close()
-                return
+# Маршруты health/API тело не читают: большой Content-Length — 413 и закрытие, а
+# заголовки длиннее лимита StreamReader — LimitOverrunError (соединение закрывается)
+HTTP_MAX_HEADER_BYTES = 8192
+HTTP_MAX_BODY_BYTES = 4096
 
-            # --- /v1/voice/sessions/{id}/summary ---
-            if method == "GET" and path.startswith("/v1/voice/sessions/") and path.endswith("/summary"):
-                session_id = path.split("/v1/voice/sessions/", 1)[1].rsplit("/summary", 1)[0]
-                sess = SESSIONS.get(session_id)
-                if not sess:
-                    body = json.dumps({"ok": False, "error": "unknown_session"}).encode()
-                    writer.write(
-                        b"HTTP/1.1 404 Not Found\r\n"
-                        b"Content-Type: application/json\r\n"
-                        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
-                    )
-                    await writer.drain()
-                    writer.close()
-                    return
+async def _read_http_request(reader: asyncio.StreamReader):
+    """
+    Читает один HTTP/1.x запрос: (method, path, version, headers, body) или None.
+    body=None — тело больше HTTP_MAX_BODY_BYTES (не читается).
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split()
+    if len(parts) < 3:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        return None
+    if length < 0:
+        return None
+    if length > HTTP_MAX_BODY_BYTES:
+        return parts[0], parts[1], parts[2], headers, None
+    body = await reader.readexactly(length) if length else b""
+    return parts[0], parts[1], parts[2], headers, body
 
-                body = json.dumps({"ok": True, "session_id": session_id, "summary": sess.summary}).encode("utf-8")
-                writer.write(
-                    b"HTTP/1.1 200 OK\r\n"
-                    b"Content-Type: application/json\r\n"
-                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
-                )
+def _http_response(status: str, content_type: str, body: bytes, keep_alive: bool) -> bytes:
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    ).encode() + body
+
+async def _stream_session_events(writer: asyncio.StreamWriter, session_id: str):
+    """SSE: события сессии по мере отправки клиенту, до session_end/session_detached или отключения"""
+    q = EVENT_BUS.subscribe(session_id)
+    try:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+            b": subscribed\n\n"
+        )
+        await writer.drain()
+        while True:
+            try:
+                event_type, data = await asyncio.wait_for(q.get(), timeout=SSE_PING_S)
+            except asyncio.TimeoutError:
+                writer.write(b": ping\n\n")
                 await writer.drain()
-                writer.close()
+                continue
+            writer.write(sse_frame(event_type, data))
+            # пачка накопившихся событий — одним drain
+            while not q.empty() and event_type not in TERMINAL_EVENTS:
+                event_type, data = q.get_nowait()
+                writer.write(sse_frame(event_type, data))
+            await writer.drain()
+            if event_type in TERMINAL_EVENTS:
                 return
+    except ConnectionError:
+        pass
+    finally:
+        EVENT_BUS.unsubscribe(session_id, q)
 
-            # --- /v1/voice/sessions/{id}/end ---
-            if method == "POST" and path.startswith("/v1/voice/sessions/") and path.endswith("/end"):
-                session_id = path.split("/v1/voice/sessions/", 1)[1].rsplit("/end", 1)[0]
-                sess = SESSIONS.get(session_id)
-                if not sess:
-                    body = json.dumps({"ok": False, "error": "unknown_session"}).encode()
-                    writer.write(
-                        b"HTTP/1.1 404 Not Found\r\n"
-                        b"Content-Type: application/json\r\n"
-                        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
-                    )
+async def health_server():
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    req = await asyncio.wait_for(_read_http_request(reader), timeout=HEALTH_KEEPALIVE_S)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                if req is None:
+                    return
+                method, raw_path, version, headers, _body = req
+                if _body is None:
+                    writer.write(_http_response("413 Payload Too Large", "text/plain", b"payload too large", False))
                     await writer.drain()
-                    writer.close()
                     return
+                path = raw_path.split("?", 1)[0]
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                def respond(status: str, content_type: str, body: bytes):
+                    writer.write(_http_response(status, content_type, body, keep_alive))
 
-                if not sess.summary and sess.turns:
+                def respond_json(status: str, obj: dict):
+                    respond(status, "application/json", json.dumps(obj).encode("utf-8"))
+
+                # --- /health/capacity — свободные слоты для весов балансировщика (503 при перегрузке) ---
+                if method == "GET" and path.startswith("/health/capacity"):
+                    cap = ADMISSION.capacity()
+                    respond_json("200 OK" if cap["slots"] else "503 Service Unavailable", cap)
+
+                # --- /health — живость процесса (отвечает и во время загрузки моделей) ---
+                elif method == "GET" and path.startswith("/health"):
+                    respond("200 OK", "text/plain", b"ok")
+
+                # --- /ready — модели прогреты и WS-порт слушает; профиль старта (503 до готовности) ---
+                elif method == "GET" and path.startswith("/ready"):
+                    report = STARTUP.report()
+                    respond_json("200 OK" if report["ready"] else "503 Service Unavailable", report)
+
+                # --- /metrics (Prometheus text format) ---
+                elif method == "GET" and path.startswith("/metrics"):
+                    respond("200 OK", "text/plain; version=0.0.4; charset=utf-8", REGISTRY.render())
+
+                # --- /debug/* — только при DEBUG_ENDPOINTS (по умолчанию с loopback) ---
+                elif path.startswith("/debug/") and not _debug_allowed(writer):
+                    respond("404 Not Found", "text/plain", b"not found")
+
+                # --- /debug/log?n=500 — кольцевой буфер логов (JSON, при LOG_RING_SIZE>0) ---
+                elif method == "GET" and path.startswith("/debug/log"):
+                    query = parse_qs(urlparse(raw_path).query)
                     try:
-                        sess.summary = build_session_summary(sess)
-                    except Exception as e:
-                        sess.summary = f"summary_error: {e}"
+                        limit = int(query.get("n", ["500"])[0])
+                    except ValueError:
+                        limit = 500
+                    body = json.dumps(ring_records(limit), ensure_ascii=False, default=str).encode("utf-8")
+                    respond("200 OK", "application/json", body)
+
+                # --- /debug/trace?session=&n= — Chrome trace-event JSON (chrome://tracing, Perfetto) ---
+                # --- /debug/trace/stats?session= — перцентили по стадиям, мс ---
+                elif method == "GET" and path.startswith("/debug/trace"):
+                    query = parse_qs(urlparse(raw_path).query)
+                    trace_session = query.get("session", [None])[0]
+                    if path.rstrip("/").endswith("/stats"):
+                        respond_json("200 OK", TRACER.stage_percentiles(trace_session))
+                    else:
+                        try:
+                            limit = int(query.get("n", ["50"])[0])
+                        except ValueError:
+                            limit = 50
+                        respond_json("200 OK", TRACER.chrome_trace(trace_session, limit))
+
+                # --- /v1/voice/sessions/{id}/events (SSE) ---
+                elif method == "GET" and path.startswith("/v1/voice/sessions/") and path.endswith("/events"):
+                    session_id = path.split("/v1/voice/sessions/", 1)[1].rsplit("/events", 1)[0]
+                    if not await SESSIONS.aget(session_id):
+                        respond_json("404 Not Found", {"ok": False, "error": "unknown_session"})
+                    else:
+                        await _stream_session_events(writer, session_id)
+                        return
 
-                sess.ended = True
-                sess.ended_at_ms = now_ms()
+                # --- /v1/voice/sessions/{id}/summary ---
+                elif method == "GET" and path.startswith("/v1/voice/sessions/") and path.endswith("/summary"):
+                    session_id = path.split("/v1/voice/sessions/", 1)[1].rsplit("/summary", 1)[0]
+                    sess = await SESSIONS.aget(session_id)
+                    if not sess:
+                        respond_json("404 Not Found", {"ok": False, "error": "unknown_session"})
+                    else:
+                        respond_json("200 OK", {"ok": True, "session_id": session_id, "summary": sess.summary})
+
+                # --- /v1/voice/sessions/{id}/end ---
+                elif method == "POST" and path.startswith("/v1/voice/sessions/") and path.endswith("/end"):
+                    session_id = path.split("/v1/voice/sessions/", 1)[1].rsplit("/end", 1)[0]
+                    sess = await SESSIONS.aget(session_id)
+                    if not sess:
+                        respond_json("404 Not Found", {"ok": False, "error": "unknown_session"})
+                    else:
+                        if not sess.summary and sess.turns:
+                            try:
+                                sess.summary = build_session_summary(sess)
+                            except Exception as e:
+                                sess.summary = f"summary_error: {e}"
 
-                body = json.dumps({"ok": True, "session_id": session_id, "summary": sess.summary}).encode("utf-8")
-                writer.write(
-                    b"HTTP/1.1 200 OK\r\n"
-                    b"Content-Type: application/json\r\n"
-                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
-                )
-                await writer.drain()
-                writer.close()
-                return
+                        SESSIONS.mark_ended(session_id)
+                        respond_json("200 OK", {"ok": True, "session_id": session_id, "summary": sess.summary})
 
-            # default 404
-            body = b"not found"
-            writer.write(
-                    b"HTTP/1.1 404 Not Found\r\n"
-                    b"Content-Type: text/plain\r\n"
-                b"Content-Length: 9\r\n\r\n" + body
-                )
-            await writer.drain()
+                # default 404
+                else:
+                    respond("404 Not Found", "text/plain", b"not found")
+
+                await writer.drain()
+                if not keep_alive:
+                    return
         except Exception as e:
-            print(f"[HEALTH] Ошибка: {e}")
+            log_http.error("Ошибка: %s", e)
         finally:
             try:
                 writer.close()
@@ -518,11 +750,11 @@ async def health_server():
                 pass
 
     try:
-        srv = await asyncio.start_server(handle, "0.0.0.0", HEALTH_PORT)
-        print(f"[HTTP] Health/API сервер запущен на порту {HEALTH_PORT}")
+        srv = await asyncio.start_server(handle, "0.0.0.0", HEALTH_PORT, limit=HTTP_MAX_HEADER_BYTES)
+        log_http.info("Health/API сервер запущен на порту %s", HEALTH_PORT)
         return srv
     except Exception as e:
-        print(f"[HTTP] Не удалось запустить health/api сервер: {e}")
+        log_http.error("Не удалось запустить health/api сервер: %s", e)
         return None
 
 async def openai_stream(
@@ -536,7 +768,8 @@ async def openai_stream(
 ):
     """
     Streaming генератор для OpenAI API.
-    Yield'ит токены по мере генерации для минимального TTFT.
+    Yield'ит текст дельт по мере прихода байт (без логирования на каждый токен)
+    для минимального TTFT. Дельты одного сетевого куска склеены.
 
     - Если передали messages -> используем их
     - Иначе собираем messages из system_prompt + question (legacy)
@@ -560,7 +793,7 @@ async def openai_stream(
             {"role": "user", "content": question},
         ]
 
-    print(f"[OPENAI] Начинаем streaming для: {len(messages)} messages")
+    log_llm.debug("Начинаем streaming для: %s messages", len(messages))
     await init_openai_http()
     assert _deepseek_http is not None
 
@@ -571,144 +804,54 @@ async def openai_stream(
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
-    print(f"[OPENAI] Payload ready, streaming...")
+    log_llm.debug("Payload ready, streaming...")
 
-    try:
-        async with _deepseek_http.stream("POST", "/v1/chat/completions", json=payload) as r:
-            print(f"[OPENAI] Response status: {r.status_code}")
-            r.raise_for_status()
+    hedge = None
+    if LLM_HEDGE_DELAY_MS > 0:
+        await init_llm_hedge_http()
+        hedge_client = _llm_hedge_http or _deepseek_http
+        hedge = lambda: _stream_completion(hedge_client, payload, tag="HEDGE")
 
-            async for line in r.aiter_lines():
-                if not line:
-                    continue
-                if line.startswith(":"):
-                    # keep-alive comment, игнорируем
-                    continue
-                if not line.startswith("data:"):
-                    continue
+    async for text in hedged_stream(
+        lambda: _stream_completion(_deepseek_http, payload, tag="OPENAI"),
+        hedge,
+        LLM_HEDGE_DELAY_MS,
+        HEDGE_STATS,
+    ):
+        yield text
 
-                data = line[len("data:"):].strip()
-                if data == "[DONE]":
-                    print("[OPENAI] Streaming completed")
-                    break
 
-                try:
-                    chunk = json.loads(data)
-                    choices = chunk.get("choices") or []
-                    if not choices:
-                        continue
-
-                    delta = (choices[0].get("delta") or {})
-                    text = delta.get("content")
-                    if text:
-                        print(f"[OPENAI] Yielding token: '{text}'")
-                        yield text
-                except json.JSONDecodeError:
-                    continue  # игнорируем битые чанки
+async def _stream_completion(client: httpx.AsyncClient, payload: dict, *, tag: str):
+    """Один streaming запрос /v1/chat/completions: yield'ит текст дельт"""
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=payload) as r:
+            log_llm.debug("Response status: %s", r.status_code, endpoint=tag)
+            r.raise_for_status()
+
+            async for text in aiter_sse_deltas(r.aiter_bytes()):
+                yield text
+            log_llm.debug("Streaming completed", endpoint=tag)
     except Exception as e:
-        print(f"[OPENAI] Error in streaming: {e}")
+        log_llm.error("Error in streaming: %s", e, endpoint=tag)
         raise
 
 
-def build_recognizer(sample_rate: int, phrase_list: Optional[list] = None, words: bool = False) -> KaldiRecognizer:
+def build_recognizer(sample_rate: int, phrase_list: Optional[list] = None, words: bool = False) -> vosk.KaldiRecognizer:
     if phrase_list:
         # grammar / phrase list: ограничивает словарь, ускоряет/улучшает в узких доменах
-        rec = KaldiRecognizer(MODEL, sample_rate, json.dumps(phrase_list, ensure_ascii=False))
+        rec = vosk.KaldiRecognizer(MODEL, sample_rate, json.dumps(phrase_list, ensure_ascii=False))
     else:
-        rec = KaldiRecognizer(MODEL, sample_rate)
+        rec = vosk.KaldiRecognizer(MODEL, sample_rate)
     rec.SetWords(bool(words))
     return rec
 
-def now_ms() -> int:
-    """Текущее время в миллисекундах"""
-    return int(time.time() * 1000)
-
-def frame_bytes(sample_rate: int, frame_ms: int) -> int:
-    """Размер фрейма в байтах для mono PCM16"""
-    return int(sample_rate * frame_ms / 1000) * 2
-
-def word_count(text: str) -> int:
-    """Количество слов в тексте"""
-    return len([w for w in text.strip().split() if w])
-
-def is_meaningful(text: str) -> bool:
-    """Проверяет, имеет ли текст достаточный смысл для запуска ответа"""
-    t = (text or "").strip()
-    return (len(t) >= MIN_CHARS_EARLY) and (word_count(t) >= MIN_WORDS_EARLY)
-
-async def call_with_retry(fn, retries=1, backoff=0.2):
-    """Простой retry для сетевых вызовов"""
-    for attempt in range(retries + 1):
-        try:
-            return await fn()
-        except (httpx.ConnectError, httpx.TimeoutException) as e:
-            if attempt == retries:
-                raise
-            print(f"[RETRY] Попытка {attempt + 1} не удалась: {e}, ждем {backoff}s")
-            await asyncio.sleep(backoff)
-            backoff *= 2
-        except httpx.HTTPStatusError as e:
-            # Не ретраим 4xx ошибки
-            if e.response.status_code < 500:
-                raise
-            if attempt == retries:
-                raise
-            print(f"[RETRY] Попытка {attempt + 1} не удалась: {e}, ждем {backoff}s")
-            await asyncio.sleep(backoff)
-            backoff *= 2
-
-def split_for_tts(buf: str) -> tuple[list[str], str]:
-    """
-    Разбивает буфер текста на чанки для TTS.
-    Возвращает (готовые_чанки, остаток_буфера).
-    """
-    N = 120  # Максимальная длина чанка в символах
-    seps = [".", "!", "?", "\n"]
-
-    out = []
-    while True:
-        cut = -1
-        # Ищем ближайший разделитель предложений
-        for s in seps:
-            idx = buf.find(s)
-            if idx != -1:
-                cut = idx if cut == -1 else min(cut, idx)
-
-        if cut != -1:
-            # Нашли разделитель - отрезаем предложение
-            chunk = buf[:cut+1].strip()
-            buf = buf[cut+1:].lstrip()
-            if chunk:
-                out.append(chunk)
-            continue
-
-        if len(buf) >= N:
-            # Ищем последнюю запятую или пробел перед лимитом для более естественного разбиения
-            space_cut = buf.rfind(' ', 0, N)
-            comma_cut = buf.rfind(',', 0, N)
-            best_cut = max(space_cut, comma_cut)
-            
-            if best_cut > 50:  # Если нашли хорошую точку разбиения
-                chunk = buf[:best_cut+1].strip()
-                buf = buf[best_cut+1:].lstrip()
-            else:
-                # Разбиваем по лимиту
-                chunk = buf[:N].strip()
-                buf = buf[N:].lstrip()
-            
-            if chunk:
-                out.append(chunk)
-            continue
-
-        break
-
-    return out, buf
 
 class TTSBackend:
     """Backend для работы с TTS API"""
 
     def __init__(self):
         self.cache: dict[str, bytes] = {}
+        self.lang_router = LangRouter()
 
     async def warmup_ack(self):
         """Прогреваем и кешируем ACK фразы для быстрого ответа"""
@@ -721,12 +864,22 @@ class TTSBackend:
             "Прорабатываю детали.", "Вникаю в контекст.", "Уясняю задачу.",
             "Принимаю запрос.", "Анализирую ситуацию."
         )
+        if TTS_PROVIDER == "remote":
+            # все фразы одним запросом вместо двадцати
+            try:
+                for txt, wav in zip(self.ack_texts, await self.synthesize_batch(list(self.ack_texts))):
+                    if wav:
+                        self.cache[txt] = wav
+                log_tts.debug("ACK кеширован пакетом: %s из %s", len(self.cache), len(self.ack_texts))
+                return
+            except Exception as e:
+                log_tts.error("Пакетный прогрев ACK не удался: %s — по одной фразе", e)
         for txt in self.ack_texts:
             try:
                 self.cache[txt] = await self.synthesize_wav(txt)
-                print(f"[TTS] ACK кеширован: '{txt}' ({len(self.cache[txt])} bytes)")
+                log_tts.debug("ACK кеширован: '%s' (%s bytes)", txt, len(self.cache[txt]))
             except Exception as e:
-                print(f"[TTS] Не удалось прогреть ACK '{txt}': {e}")
+                log_tts.error("Не удалось прогреть ACK '%s': %s", txt, e)
 
     def get_random_ack_text(self):
         """Возвращает случайную ACK фразу"""
@@ -784,18 +937,23 @@ class TTSBackend:
                 headers=headers
             )
             response.raise_for_status()
-            print(f"[TTS] OpenAI TTS synthesized: '{text[:50]}...' ({len(response.content)} bytes)")
+            log_tts.debug("OpenAI TTS synthesized: '%s...' (%s bytes)", text[:50], len(response.content))
             return response.content
         except Exception as e:
-            print(f"[TTS] OpenAI TTS failed: {e}")
+            log_tts.warn("OpenAI TTS failed: %s", e)
             # Fallback to local TTS if available
             if TTS_PROVIDER == "openai":
                 raise
-            print("[TTS] Falling back to local TTS")
+            log_tts.warn("Falling back to local TTS")
             return await self._synthesize_local_tts(text, lang)
 
-    async def synthesize_wav(self, text: str, lang: Optional[str] = None, settings: Optional[TTSSettings] = None) -> bytes:
-        """Синтезирует WAV из текста с автоопределением языка"""
+    async def synthesize_wav(self, text: str, lang: Optional[str] = None, settings: Optional[TTSSettings] = None,
+                             utterance_id: Optional[int] = None) -> bytes:
+        """
+        Синтезирует WAV из текста. Без lang чанк делится на отрезки по письменности
+        (tts_lang): кириллица — silero_ru, латиница — silero_en, WAV отрезков склеиваются;
+        utterance_id — язык отрезков без букв липкий в пределах реплики.
+        """
         # Если settings не переданы, используем глобальные дефолты
         if settings is None:
             settings = TTSSettings(
@@ -809,26 +967,114 @@ class TTSBackend:
         
         # Проверяем кеш
         if text in self.cache:
+            TTS_CACHE_HITS.inc()
             return self.cache[text]
+        TTS_CACHE_MISSES.inc()
 
         # Выбор провайдера TTS
+        if TTS_PROVIDER == "stub":
+            return await self._synthesize_stub_tts(text)
         if TTS_PROVIDER == "openai":
             return await self._synthesize_openai_tts(text, lang, settings)
         else:
-            # Локальный TTS (Silero)
+            # Silero: локально или в tts_server.py (remote)
             await init_tts_http()
             assert _tts_http is not None
 
-        # Автоопределение языка если не указан
-        if lang is None:
-            try:
-                lang = detect(text.strip())
-                print(f"[TTS] Detected language: {lang} for text: '{text[:50]}...'")
-            except Exception as e:
-                print(f"[TTS] Language detection failed: {e}, using 'ru' as default")
-                lang = "ru"
+        synthesize = self._synthesize_remote_tts if TTS_PROVIDER == "remote" else self._synthesize_local_tts
+        if lang is not None:
+            return await synthesize(text, lang, settings)
 
-        return await self._synthesize_local_tts(text, lang, settings)
+        runs = self.lang_router.route(text, utterance_id, default="en" if settings.model == "silero_en" else "ru")
+        if len(runs) == 1:
+            return await synthesize(runs[0][1], runs[0][0], settings)
+        log_tts.debug("Mixed-language chunk: %s", " | ".join(f"{l}:{t!r}" for l, t in runs))
+        wavs = await asyncio.gather(*(synthesize(part, run_lang, settings) for run_lang, part in runs))
+        return concat_wav(wavs)
+
+    async def synthesize_batch(self, texts: list[str], settings: Optional[TTSSettings] = None) -> list[Optional[bytes]]:
+        """
+        Пакетный синтез одним запросом POST /tts_batch к tts_server.py (TTS_PROVIDER=remote);
+        None — текст, который сервер синтезировать не смог. Язык не определяется: голос из settings.
+        """
+        if settings is None:
+            settings = TTSSettings(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                speed=TTS_SPEED,
+                emotion=TTS_EMOTION,
+                pause=TTS_PAUSE,
+                timeout=TTS_TIMEOUT,
+            )
+
+        await init_tts_http()
+        assert _tts_http is not None
+        r = await _tts_http.post("/tts_batch", json={
+            "texts": texts,
+            "model": settings.model,
+            "voice": settings.voice,
+            "speed": settings.speed,
+            "emotion": settings.emotion,
+            "pause_between_sentences": settings.pause,
+        }, timeout=settings.timeout * max(1, len(texts)))
+        r.raise_for_status()
+        results = r.json()["results"]
+        return [base64.b64decode(res["wav_b64"]) if "wav_b64" in res else None for res in results]
+
+    async def _synthesize_stub_tts(self, text: str) -> bytes:
+        """Заглушка TTS: тишина PCM16 mono 24 kHz, длительность и задержка по длине текста"""
+        await asyncio.sleep(len(text) * TTS_STUB_MS_PER_CHAR / 1000.0)
+        sr = 24000
+        data_len = int(sr * len(text) / max(1.0, TTS_STUB_CHARS_PER_SEC)) * 2
+        header = struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + data_len, b"WAVE", b"fmt ", 16, 1, 1, sr, sr * 2, 2, 16, b"data", data_len,
+        )
+        return header + bytes(data_len)
+
+    @staticmethod
+    def _silero_voice(lang: Optional[str], settings: TTSSettings) -> tuple[str, str]:
+        """Модель и голос Silero под язык текста"""
+        model_to_use = settings.model
+        voice_to_use = settings.voice
+
+        if lang and lang.startswith('en'):
+            if settings.model == "silero_ru":
+                model_to_use = "silero_en"
+                voice_to_use = "en_0"  # Английский голос по умолчанию
+            elif settings.model == "silero_en":
+                voice_to_use = settings.voice if settings.voice.startswith('en_') else "en_0"
+        elif lang and lang.startswith('ru'):
+            if settings.model == "silero_en":
+                model_to_use = "silero_ru"
+                voice_to_use = "eugene"  # Русский голос по умолчанию
+            elif settings.model == "silero_ru":
+                voice_to_use = settings.voice if settings.voice in ["eugene", "aidar", "xenia", "baya", "kseniya"] else "eugene"
+        return model_to_use, voice_to_use
+
+    async def _post_tts_wav(self, text: str, model: str, voice: str, settings: TTSSettings, timeout: float) -> bytes:
+        """POST /tts_wav в tts_server.py через общий keep-alive пул _tts_http"""
+        await init_tts_http()
+        if _tts_http is None:
+            raise RuntimeError("TTS HTTP client not initialized")
+        r = await _tts_http.post("/tts_wav", json={
+            "text": text,
+            "model": model,
+            "voice": voice,
+            "speed": settings.speed,
+            "emotion": settings.emotion,
+            "pause_between_sentences": settings.pause,
+        }, timeout=timeout)
+        r.raise_for_status()
+        return r.content
+
+    async def _synthesize_remote_tts(self, text: str, lang: Optional[str], settings: TTSSettings) -> bytes:
+        """Удалённый TTS-уровень: Silero в tts_server.py (TTS_PROVIDER=remote)"""
+        model_to_use, voice_to_use = self._silero_voice(lang, settings)
+        log_tts.debug("Using remote Silero: model=%s, voice=%s, lang=%s", model_to_use, voice_to_use, lang)
+        wav_bytes = await self._post_tts_wav(text, model_to_use, voice_to_use, settings, settings.timeout)
+        log_tts.debug("Synthesized %s bytes remotely", len(wav_bytes))
+        return wav_bytes
 
     async def _synthesize_local_tts(self, text: str, lang: Optional[str] = None, settings: Optional[TTSSettings] = None) -> bytes:
         """Локальный TTS через Silero (прямой вызов без HTTP)"""
@@ -843,25 +1089,10 @@ class TTSBackend:
                 timeout=TTS_TIMEOUT,
             )
         
+        # Выбор модели и голоса на основе языка
+        model_to_use, voice_to_use = self._silero_voice(lang, settings)
         try:
-            # Выбор модели и голоса на основе языка
-            model_to_use = settings.model
-            voice_to_use = settings.voice
-
-            if lang and lang.startswith('en'):
-                if settings.model == "silero_ru":
-                    model_to_use = "silero_en"
-                    voice_to_use = "en_0"  # Английский голос по умолчанию
-                elif settings.model == "silero_en":
-                    voice_to_use = settings.voice if settings.voice.startswith('en_') else "en_0"
-            elif lang and lang.startswith('ru'):
-                if settings.model == "silero_en":
-                    model_to_use = "silero_ru"
-                    voice_to_use = "eugene"  # Русский голос по умолчанию
-                elif settings.model == "silero_ru":
-                    voice_to_use = settings.voice if settings.voice in ["eugene", "aidar", "xenia", "baya", "kseniya"] else "eugene"
-
-            print(f"[TTS] Using direct Silero: model={model_to_use}, voice={voice_to_use}, lang={lang}")
+            log_tts.debug("Using direct Silero: model=%s, voice=%s, lang=%s", model_to_use, voice_to_use, lang)
             
             # Прямой вызов tts_silero без HTTP
             wav_bytes = await tts_silero.synthesize_wav(
@@ -873,37 +1104,20 @@ class TTSBackend:
                 pause=settings.pause
             )
             
-            print(f"[TTS] Synthesized {len(wav_bytes)} bytes directly")
+            log_tts.debug("Synthesized %s bytes directly", len(wav_bytes))
             return wav_bytes
             
         except Exception as e:
-            print(f"[TTS] Direct synthesis failed: {e}")
+            log_tts.error("Direct synthesis failed: %s", e)
             # Fallback: попробуем через HTTP, если доступен
             try:
-                await init_tts_http()
-                if _tts_http is not None:
-                    print(f"[TTS] Trying HTTP fallback...")
-            r = await _tts_http.post("/tts_wav", json={
-                "text": text,
-                "model": model_to_use,
-                "voice": voice_to_use,
-                "speed": settings.speed,
-                "emotion": settings.emotion,
-                "pause_between_sentences": settings.pause,
-                    }, timeout=5.0)
-            r.raise_for_status()
-            return r.content
-                else:
-                    raise RuntimeError("TTS HTTP client not initialized")
+                log_tts.warn("Trying HTTP fallback...")
+                return await self._post_tts_wav(text, model_to_use, voice_to_use, settings, timeout=5.0)
             except Exception as http_e:
-                print(f"[TTS] HTTP fallback also failed: {http_e}")
+                log_tts.error("HTTP fallback also failed: %s", http_e)
                 raise RuntimeError(f"TTS synthesis failed (direct: {e}, HTTP: {http_e})")
 
 
-async def decode_accept(rec: KaldiRecognizer, chunk: bytes) -> bool:
-    if DECODE_IN_THREAD:
-        return await asyncio.to_thread(rec.AcceptWaveform, chunk)
-    return rec.AcceptWaveform(chunk)
 
 
 async def call_tts_api(text: str) -> str:
@@ -934,195 +1148,42 @@ async def call_tts_api(text: str) -> str:
         return f"Ошибка TTS API: {str(e)}"
 
 
-def should_restart_llm(new_text: str, old_text: str) -> bool:
-    """Эвристика: нужно ли перезапускать LLM при изменении текста"""
-    new_text = (new_text or "").strip()
-    old_text = (old_text or "").strip()
-    if not old_text:
-        return True
-    if new_text == old_text:
-        return False
 
-    # 1) существенный рост длины (>30%)
-    if len(new_text) > int(len(old_text) * 1.3):
-        return True
-
-    # 2) если новая строка сильно "перестроилась"
-    # общий префикс меньше половины старого текста
-    common = 0
-    for a, b in zip(new_text, old_text):
-        if a == b:
-            common += 1
-        else:
-            break
-    if common < max(1, len(old_text) // 2):
-        return True
-
-    return False
-
-# ---------- Интеллектуальный endpointing: функции ----------
-
-def clamp(v: float, lo: float, hi: float) -> float:
-    return lo if v < lo else hi if v > hi else v
-
-def update_pause_ema(pause_ema_ms: float, pause_ms: float, alpha: float) -> float:
-    # учитываем только "внутренние" паузы (запинки), не финальные
-    if pause_ms <= 800:
-        return pause_ema_ms * (1 - alpha) + pause_ms * alpha
-    return pause_ema_ms
-
-def compute_adaptive_thresholds(text: str, wps: float, pause_ema: float) -> tuple[int, int, int]:
-    """Расчет адаптивных порогов для FSM endpointing"""
-    wc = len(text.strip().split())
-
-    # Базовые пороги от типичной внутрипредложенческой паузы
-    tent = max(int(pause_ema * 1.2), 300)
-    confirm = max(int(pause_ema * 2.5), 900)
-    final = confirm + 500
-
-    # Коррекция по длине фразы
-    if wc < 4:
-        confirm += 200
-        final += 300
-
-    # Коррекция по качеству концовки
-    if not is_good_end(text):
-        confirm += 300
-
-    # Коррекция по скорости речи
-    if wps > 2.5:
-        confirm += 100
-
-    return tent, confirm, final
-
-def compute_thresholds(pause_ema_ms: float, tentative_min: int, confirm_min: int, confirm_max: int) -> tuple[int, int]:
-    """Устаревшая версия для совместимости"""
-    tentative = int(clamp(pause_ema_ms * 1.3, tentative_min, 650))
-    confirm = int(clamp(pause_ema_ms * 3.0, confirm_min, confirm_max))
-    return tentative, confirm
-
-CONTINUE_WORDS = {
-    "что","который","которая","которые","чтобы","потому","потому что",
-    "если","когда","почему","зачем","как","где","куда","откуда",
-    "и","а","но","или","ли","то","это","вот"
-}
-FILLERS = {"э","эм","ну","типа","короче","значит","мм"}
-
-# Расширенные словари для continuation penalty
-# Эвристики для определения плохих концовок фраз
-BAD_ENDINGS = {
-    "и", "а", "но", "или", "что", "если", "то", "который", "которая", "которые",
-    "чтобы", "потому", "также", "либо", "вот", "это", "так", "как", "где", "куда",
-    "откуда", "зачем", "почему", "когда", "тогда", "здесь", "там", "тут"
-}
-
-def is_good_end(text: str) -> bool:
-    """Проверяет, является ли конец фразы хорошим для завершения"""
-    words = text.strip().lower().split()
-    if len(words) < 3:
-        return False
-    return words[-1] not in BAD_ENDINGS
-
-def common_prefix_len(a: str, b: str) -> int:
-    """Длина общего префикса двух строк"""
-    n = 0
-    for x, y in zip(a, b):
-        if x == y:
-            n += 1
-        else:
-            break
-    return n
-
-def is_tail_jitter(new: str, old: str, max_tail: int = 3) -> bool:
-    """Проверяет, является ли изменение только jitter'ом на хвосте"""
-    new = (new or "").strip()
-    old = (old or "").strip()
-    if not old or not new or new == old:
-        return False
-    cp = common_prefix_len(new, old)
-    tail_new = len(new) - cp
-    tail_old = len(old) - cp
-    return max(tail_new, tail_old) <= max_tail
-
-def update_wps_ema(wps_ema: float, prev_words: int, new_words: int, dt_ms: int, alpha: float = 0.2) -> float:
-    """Обновляет EMA скорости речи (слов/сек)"""
-    if dt_ms <= 0:
-        return wps_ema
-    dw = max(0, new_words - prev_words)
-    inst = (dw * 1000.0) / dt_ms
-    if inst <= 0:
-        return wps_ema
-    return wps_ema * (1 - alpha) + inst * alpha
-
-def continuation_penalty_ms(text: str) -> int:
-    """Штраф на продолжение по лексическому контексту"""
-    w = last_word(text)
-    if not w:
-        return 0
-    # жёсткий штраф за явное продолжение
-    if w in CONJ or w in PREPOSITIONS:
-        return 450
-    if w in PARTICLES or w in FILLERS:
-        return 300
-    # короткие служебные слова на конце
-    if len(w) <= 2:
-        return 250
-    # обрыв на цифре/сокращении часто не конец
-    if w.isdigit():
-        return 300
-    return 0
-
-def last_word(text: str) -> str:
-    t = (text or "").strip().lower()
-    if not t:
-        return ""
-    parts = t.split()
-    return parts[-1] if parts else ""
-
-def need_stricter_confirm(text: str) -> bool:
-    w = last_word(text)
-    return (w in CONTINUE_WORDS) or (w in FILLERS)
 
 async def handler(ws: WebSocketServerProtocol):
-    print("[HANDLER] Новое WebSocket соединение")
+    """Контроль допуска: при перегрузке новая сессия закрывается с 1013 до любой работы"""
+    reject = ADMISSION.try_admit()
+    if reject is not None:
+        log_handler.warn("Сессия отклонена: перегрузка (%s)", reject)
+        await ws.close(code=CLOSE_TRY_AGAIN_LATER, reason=f"overloaded: {reject}")
+        return
+    try:
+        await serve_session(ws)
+    finally:
+        ADMISSION.release()
+
+async def serve_session(ws: WebSocketServerProtocol):
+    log_handler.info("Новое WebSocket соединение")
 
     # Состояние WebSocket и очередности сообщений
     ws_send_lock = asyncio.Lock()
-    tts_sending = False  # Флаг активной отправки TTS сессии (окно между tts_start и tts_end)
-
-    # Voice Protocol State Machine
-    voice_state = VoiceState.IDLE
-    handshake_done = False  # Флаг завершения handshake (получен config)
+    events_session_id: str | None = None  # после auth: дублируем JSON-события в SSE /events
 
     async def ws_send(message: Union[str, bytes]):
         """Единый метод отправки для гарантии порядка"""
+        t0 = time.perf_counter()
         async with ws_send_lock:
             await ws.send(message)
+        WS_SEND_MS.observe((time.perf_counter() - t0) * 1000.0)
 
     async def safe_send_locked(payload: dict):
         """Потокобезопасная отправка WebSocket сообщений (JSON)"""
         msg_type = payload.get('type') or payload.get('event') or 'unknown'
-        print(f"[WS] → JSON {msg_type}")
+        log_ws.trace("→ JSON %s", msg_type)
         data = json.dumps(payload, ensure_ascii=False)
         await ws_send(data)
-
-    def proto_violation(msg: str):
-        """Log protocol violation for debugging"""
-        print(f"[PROTO VIOLATION] {msg}")
-
-    async def send_audio_binary(u_id: int, wav_bytes: bytes):
-        """Отправка аудио бинарным фреймом вместо base64"""
-        if voice_state != VoiceState.ASSISTANT_TTS:
-            proto_violation(f"Audio chunk sent while not in ASSISTANT_TTS state (u_id={u_id})")
-            return
-
-        if not tts_sending:
-            proto_violation(f"Audio chunk sent outside tts window (u_id={u_id})")
-            return
-
-        print(f"[WS] → BIN audio {len(wav_bytes)} bytes")
-        header = struct.pack("<4sIHI", AUDIO_MAGIC, u_id, MIME_WAV, len(wav_bytes))
-        await ws_send(header + wav_bytes)
+        if events_session_id:
+            EVENT_BUS.publish(events_session_id, msg_type, data)
 
     # Origin check (опционально)
     if ALLOWED_ORIGINS:
@@ -1158,38 +1219,38 @@ async def handler(ws: WebSocketServerProtocol):
             qs = parse_qs(parsed.query)
             token = (qs.get("token") or qs.get("access_token") or qs.get("jwt") or [None])[0]
         except Exception as e:
-            print(f"[AUTH] Error parsing query: {e}")
+            log_auth.error("Error parsing query: %s", e)
             token = None
 
     # Локальный режим: пропускаем аутентификацию
     if DISABLE_AUTH or LOCAL_MODE:
-        print("[AUTH] 🔓 Local mode: authentication disabled")
+        log_auth.info("🔓 Local mode: authentication disabled")
         agent_id = "assistant"  # Используем дефолтный агент
         session_id = f"local-{int(time.time() * 1000)}"
         payload = {"agent": agent_id, "sub": session_id}
     else:
         # Production режим: требуется токен
         if not token:
-            print("[AUTH] Missing token (Authorization/query), closing connection")
+            log_auth.warn("Missing token (Authorization/query), closing connection")
             try:
                 ws_path = ws.path if hasattr(ws, 'path') else (ws.request.path if hasattr(ws, 'request') else '/unknown')
-                print(f"[AUTH] Debug: ws.path = {ws_path}")
+                log_auth.debug("ws.path = %s", ws_path)
             except Exception as e:
-                print(f"[AUTH] Debug: Cannot access path: {e}")
-            print(f"[AUTH] Debug: Authorization header = {auth_header}")
+                log_auth.debug("Cannot access path: %s", e)
+            log_auth.debug("Authorization header = %s", auth_header)
             await ws.close(code=4001, reason="Missing token")
             return
 
         try:
             payload = verify_ws_token(token)
         except Exception as e:
-            print(f"[AUTH] Invalid token: {e}")
+            log_auth.error("Invalid token: %s", e)
             await ws.close(code=4001, reason="Invalid token")
             return
 
         agent_id = payload.get("agent")
         if not agent_id or agent_id not in AGENTS:
-            print(f"[AUTH] Unknown agent: {agent_id}")
+            log_auth.warn("Unknown agent: %s", agent_id)
             await ws.close(code=1008, reason="Unknown agent")
             return
 
@@ -1197,25 +1258,18 @@ async def handler(ws: WebSocketServerProtocol):
 
     agent = AGENTS[agent_id]
 
-    print(f"[AUTH] ✅ Authenticated: session={session_id}, agent={agent_id}")
-
-    # State transition: authenticated, ready for user input
-    voice_state = VoiceState.USER_SPEAKING
+    log_auth.info("✅ Authenticated: session=%s, agent=%s", session_id, agent_id)
+    events_session_id = session_id
+    recorder = SessionRecorder.open(SESSION_RECORD_DIR, session_id, agent_id) if SESSION_RECORD_DIR else None
 
     # ИНИЦИАЛИЗАЦИЯ СЕССИИ ДЛЯ ХРАНЕНИЯ КОНТЕКСТА
-    session = SESSIONS.get(session_id)
+    session = await SESSIONS.aresume(session_id)
     if not session:
         session = SessionState(session_id=session_id, agent_id=agent_id)
-        SESSIONS[session_id] = session
-        print(f"[SESSION:{session_id}] Created new session with agent {agent_id}")
+        SESSIONS.put(session)
+        log_session.info("Created new session with agent %s", agent_id, session=session_id)
     else:
-        print(f"[SESSION:{session_id}] Resumed existing session with {len(session.turns)} turns")
-
-    # Настройки LLM для этой сессии
-    llm_model = agent.get("model") or agent.get("llm_model", "deepseek-chat")
-    llm_temp = agent.get("temperature", 0.4)
-    llm_max_tokens = agent.get("max_tokens", 220)
-    system_prompt = agent.get("system_prompt", "Ты ассистент.")
+        log_session.info("Resumed existing session with %s turns", len(session.turns), session=session_id)
 
     # Настройки TTS для этой сессии
     tts_settings = TTSSettings(
@@ -1227,1326 +1281,108 @@ async def handler(ws: WebSocketServerProtocol):
         timeout=TTS_TIMEOUT,
     )
 
-    print(f"[AGENT] Profile: model={llm_model}, temp={llm_temp}, max_tokens={llm_max_tokens}")
-    print(f"[AGENT] TTS: model={tts_settings.model}, voice={tts_settings.voice}, speed={tts_settings.speed}")
-
-    # HELPER FUNCTIONS ДЛЯ ОБРАБОТКИ FINAL TEXT И ЗАЩИТЫ ОТ ЭХА
-    def _norm(s: str) -> str:
-        return " ".join((s or "").lower().strip().split())
-
-    def _is_echo_like(text: str, session: SessionState) -> bool:
-        # простая защита: если final слишком похож на последний assistant
-        u = _norm(text)
-        if len(u) < 8:
-            return False
-        last_a = ""
-        for t in reversed(session.turns):
-            if t.role == "assistant" and t.text:
-                last_a = _norm(t.text)
-                break
-        if not last_a:
-            return False
-        # грубый similarity: совпадение по префиксу/подстроке
-        return (u in last_a) or (last_a in u) or (u[:40] == last_a[:40])
-
-    async def handle_final_text(final_text: str, reason: str):
-        nonlocal ack_sent_for_turn, llm_started, current_llm_input, active_output_u, tts_allowed_u
-
-        final_text = (final_text or "").strip()
-        if not final_text:
-            return
-
-        session = SESSIONS.get(session_id)
-        if session:
-            # 1) анти-эхо: если сейчас шёл TTS или очень близко к последнему чанку — не принимаем final как user
-            if tts_playing or (now_ms() - last_tts_chunk_ms) < BARGE_IN_IGNORE_AFTER_TTS_MS:
-                print(f"[ECHO] drop final during/after tts: '{final_text[:80]}...'")
-                return
-
-            # 2) анти-эхо по содержанию
-            if _is_echo_like(final_text, session):
-                print(f"[ECHO] drop echo-like final: '{final_text[:80]}...'")
-                return
-
-            # 3) сохраняем user turn (ВАЖНО: делать именно тут)
-            session.add_turn("user", final_text)
-
-            # Отправляем нормализованное событие в Voice Control
-            event = normalize_event(
-                event_type="final",
-                role="user",
-                text=final_text,
-            )
-            if event:
-                await push_event_to_voice_control(session_id, event)
-                print(f"[SESSION:{session_id}] Added user turn, total turns: {len(session.turns)}")
-            else:
-                print(f"[EVENT] Dropped invalid user event: text='{final_text[:50]}...'")
-
-        # 4) запуск/рестарт LLM
-        print(f"[TTS] enqueue: '{final_text[:50]}...'")
-        if not llm_started:
-            play_ack = not ack_sent_for_turn
-            await start_or_restart_llm(final_text, reason=reason, play_ack=play_ack, allow_tts=True)
-            if play_ack:
-                ack_sent_for_turn = True
-        elif should_restart_llm(final_text, current_llm_input):
-            await start_or_restart_llm(final_text, reason=f"{reason}_restart", play_ack=False, allow_tts=True)
+    def on_turn(role: str, text: str):
+        """Реплика попала в историю — нормализованное событие в Voice Control"""
+        event = normalize_event(event_type="final", role=role, text=text)
+        if event:
+            push_event_to_voice_control(session_id, event)
         else:
-            # LLM уже идёт, просто разрешаем озвучку
-            if tts_allowed_u == 0 and active_output_u != 0:
-                tts_allowed_u = active_output_u
-
-    sample_rate = DEFAULT_SAMPLE_RATE
-    phrase_list = None
-    words = False
-
-    rec = build_recognizer(sample_rate, phrase_list=phrase_list, words=words)
-
-    # Инициализация VAD
-    vad = webrtcvad.Vad(VAD_MODE)
-
-    # Добавляем soft_reset метод для плавной реинициализации
-    def vad_soft_reset():
-        """
-        Мягкий сброс VAD: сохраняет историю, но сбрасывает временные счетчики.
-        Не требует новой длинной тишины для старта детекта речи.
-        """
-        # webrtcvad не имеет публичного API для soft reset
-        # поэтому просто ничего не делаем - VAD продолжит работу с текущим состоянием
-        pass
+            log_voice_control.warn("Dropped invalid %s event: text='%s...'", role, text[:50])
+
+    async def close_ws(code: int, reason: str):
+        await ws.close(code=code, reason=reason)
+
+    pipeline = VoicePipeline(
+        session,
+        agent,
+        tts=TTSBackend(),
+        tts_settings=tts_settings,
+        recognizer_factory=build_recognizer,
+        vad=webrtcvad.Vad(VAD_MODE),
+        stream_llm=openai_stream,
+        send_json=safe_send_locked,
+        send_binary=ws_send,
+        close=close_ws,
+        on_turn=on_turn,
+        sample_rate=DEFAULT_SAMPLE_RATE,
+    )
+    log_agent.info("Profile: model=%s, temp=%s, max_tokens=%s", pipeline.llm_model, pipeline.llm_temp, pipeline.llm_max_tokens)
+    log_agent.info("TTS: model=%s, voice=%s, speed=%s", tts_settings.model, tts_settings.voice, tts_settings.speed)
 
-    vad.soft_reset = vad_soft_reset
-
-    fb = frame_bytes(sample_rate, FRAME_MS)
-    audio_buf = bytearray()
-
-    # Состояние для VAD и endpointing
-    last_voice_ms = now_ms()
-    last_partial = ""
-    last_partial_change_ms = now_ms()
-    last_partial_sent_ms = 0
-    early_endpoint_fired = False
-
-    # Состояние для управления turn и ACK
-    turn_id = 0
-    ack_sent_for_turn = False
-    pause_gate_open = True  # gate для триггера старта/рестарта по паузе
-    last_restart_ms = 0
-
-    # ASR mute во время TTS
-    asr_enabled = True
-    asr_warming_up = False
-    ASR_WARMUP_MS = 200  # 200ms оптимально для turn-taking
-    asr_warmup_deadline = 0.0
-
-    # Состояние LLM конвейера
-    utterance_id = 0
-    current_llm_task: asyncio.Task | None = None
-    llm_started = False
-    current_llm_input = ""
-    llm_started_at_ms = 0
-    llm_first_token_at_ms = 0
-
-    # TTS конвейер
-    tts = TTSBackend()
-    print("[INIT] Начинаем warmup ACK фраз...")
-    await tts.warmup_ack()  # Прогреваем ACK
-    print("[INIT] Warmup ACK завершен")
-
-    # Очередь от LLM к TTS
-    llm_to_tts_q: asyncio.Queue[tuple[int, str]] = asyncio.Queue(maxsize=5000)
-    # tuple: (utterance_id, token_or_marker)
-    # пустая строка "" - сигнал завершения
-
-    tts_task: asyncio.Task | None = None
-
-    # --- Barge-in config ---
-    BARGE_IN_ENABLED = os.getenv("BARGE_IN_ENABLED", "1") == "1"
-    BARGE_IN_MIN_VOICE_MS = int(os.getenv("BARGE_IN_MIN_VOICE_MS", "1000"))   # Увеличено до 1 сек для теста
-    BARGE_IN_COOLDOWN_MS = int(os.getenv("BARGE_IN_COOLDOWN_MS", "2000"))    # Увеличен cooldown
-    BARGE_IN_IGNORE_AFTER_TTS_MS = int(os.getenv("BARGE_IN_IGNORE_AFTER_TTS_MS", "500"))  # Увеличено
-    BARGE_IN_ARM_SILENCE_MS = int(os.getenv("BARGE_IN_ARM_SILENCE_MS", "1000"))  # Увеличено до 1 сек
-
-    # Endpointing интеллектуальные настройки
-    TENTATIVE_PAUSE_MIN_MS = int(os.getenv("TENTATIVE_PAUSE_MIN_MS", "350"))
-    CONFIRM_PAUSE_MIN_MS = int(os.getenv("CONFIRM_PAUSE_MIN_MS", "1100"))
-    CONFIRM_PAUSE_MAX_MS = int(os.getenv("CONFIRM_PAUSE_MAX_MS", "1700"))
-
-    PAUSE_EMA_ALPHA = float(os.getenv("PAUSE_EMA_ALPHA", "0.15"))  # сглаживание
-
-    # --- Output state ---
-    active_output_u = 0          # utterance_id, который сейчас озвучивается/генерится
-    output_active = False        # идёт ответ (LLM/TTS)
-    tts_epoch = 0                # версия потока TTS, чтобы мгновенно "обесценивать" отправки после abort
-
-    # --- Barge-in runtime ---
-    voice_run_ms = 0
-    last_barge_in_ms = 0
-    last_tts_chunk_ms = 0        # когда последний раз отправили аудио (ACK/чанк)
-
-    # --- Barge-in arming state ---
-    tts_playing = False          # сервер считает, что сейчас идёт озвучка
-    barge_armed = False          # barge-in разрешён только после тишины
-    silent_run_ms = 0            # сколько подряд тишины во время output_active
-
-    # --- Intelligent endpointing state ---
-    pause_ema_ms = 350.0         # адаптивная оценка "типичной внутрипредложенческой паузы"
-    silence_start_ms = 0         # когда началась последняя тишина
-    was_voice_prev = False       # предыдущее состояние голоса
-
-    # Скорость речи (WPS - words per second) для динамических порогов
-    wps_ema = 2.2  # начальная оценка ~2.2 слов/сек
-    prev_wc = 0     # предыдущее количество слов
-    prev_wc_ts_ms = 0  # timestamp предыдущего измерения
-
-    # FSM для endpointing (определения окончания фразы)
-    endpoint_state = "listening"  # listening | tentative | confirmed | final
-    endpoint_tentative_start_ms = 0  # когда вошли в tentative
-    endpoint_confirmed_start_ms = 0  # когда вошли в confirmed
-
-    # --- TTS gating: нельзя говорить, пока нет подтверждения конца ---
-    tts_allowed_u = 0            # utterance_id, которому разрешено озвучивание
-
-    async def run_llm(u_id: int, prompt_text: str):
-        """Запуск LLM streaming для конкретного utterance_id"""
-        print(f"[LLM] run_llm started for utterance {u_id}: '{prompt_text}'")
-        nonlocal llm_first_token_at_ms
+    LLM_TO_TTS_QUEUES.add(pipeline.llm_to_tts_q)
+    SESSIONS.attach(session)
+    WS_CONNECTIONS.inc()
+    try:
+        await pipeline.start()
 
-        try:
-            await safe_send_locked({"type": "nlu_start", "utterance_id": u_id, "text": prompt_text})
-        except Exception as e:
-            print(f"[LLM] Failed to send nlu_start (connection may be closed): {e}")
-            return  # Прерываем выполнение, если соединение закрыто
-
-        session = SESSIONS.get(session_id)
-        if session:
-            messages = session.build_llm_messages(system_prompt, max_turns=12)
-            print(f"[SESSION:{session_id}] Building messages: {len(messages)} messages, turns: {len(session.turns)}")
-            # гарантируем буфер
-            session.llm_buffers[u_id] = ""
-        else:
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt_text}
-            ]
+        async for msg in ws:
+            if recorder is not None:
+                recorder.write(msg)
 
-        print(f"[LLM-PAYLOAD] session_id={session_id}, len(messages)={len(messages)}")
+            # === ОБРАБОТКА БИНАРНЫХ СООБЩЕНИЙ (PCM) ===
+            if not isinstance(msg, str):
+                await pipeline.feed_pcm(msg)
+                continue
 
-        first = True
-        try:
-            async for tok in openai_stream(
-                None,
-                messages=messages,  # <-- ключевой момент
-                model=llm_model,
-                system_prompt=system_prompt,
-                max_tokens=llm_max_tokens,
-                temperature=llm_temp,
-            ):
-                if first:
-                    llm_first_token_at_ms = now_ms()
-                    first = False
-                    await safe_send_locked({
-                        "type": "metric",
-                        "utterance_id": u_id,
-                        "llm_first_token_ms": llm_first_token_at_ms - llm_started_at_ms
-                    })
-
-                # копим ассистента
-                if session:
-                    session.llm_buffers[u_id] += tok
+            # === ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ (JSON) ===
+            log_ws.debug("Получено текстовое сообщение: %.100s", msg)
+            try:
+                data = json.loads(msg)
+                log_ws.debug("Распарсено JSON: %s", data)
+            except json.JSONDecodeError as e:
+                log_ws.error("Ошибка парсинга JSON: %s", e)
+                continue
 
-                await safe_send_locked({"type": "llm_delta", "utterance_id": u_id, "delta": tok})
+            # ОБРАБОТКА КОМАНДЫ ЗАВЕРШЕНИЯ СЕССИИ
+            if data.get("type") == "end_session":
+                log_session.info("Received end_session command for session %s", session_id)
+                session = await SESSIONS.aget(session_id)
+                summary = ""
 
-                # Кладём токен в очередь для TTS (только если TTS разрешен для этого utterance)
-                if tts_allowed_u == u_id:
+                if session and session.turns:
+                    log_session.info("Building summary for session %s with %s turns", session_id, len(session.turns))
                     try:
-                        await llm_to_tts_q.put((u_id, tok))
-                        print(f"[LLM] Токен '{tok}' добавлен в очередь TTS (size={llm_to_tts_q.qsize()}, allowed_u={tts_allowed_u})")
-                    except asyncio.QueueFull:
-                        print(f"[LLM] ⚠️ Очередь TTS переполнена, пропускаем токен '{tok}'")
+                        summary = build_session_summary(session)
+                        log_session.info("Summary generated: %s chars", len(summary))
+                    except Exception as e:
+                        log_session.error("Error generating summary: %s", e)
+                        summary = f"Ошибка генерации summary: {e}"
                 else:
-                    print(f"[LLM] ⚠️ Токен '{tok}' НЕ добавлен в очередь TTS (tts_allowed_u={tts_allowed_u}, u_id={u_id})")
-
-        except asyncio.CancelledError:
-            # Корректная отмена
-            raise
-        except Exception as e:
-            print(f"[LLM] Error in run_llm: {e}")
-            try:
-                await safe_send_locked({"type": "llm_error", "utterance_id": u_id, "error": str(e)})
-            except Exception as send_err:
-                print(f"[LLM] Failed to send error (connection closed): {send_err}")
-        finally:
-            # Сигнал завершения для TTS
-            try:
-                await llm_to_tts_q.put((u_id, ""))
-            except asyncio.QueueFull:
-                print(f"[LLM] Очередь TTS переполнена, не удалось отправить сигнал завершения")
-
-            try:
-                await safe_send_locked({"type": "llm_end", "utterance_id": u_id})
-            except Exception as send_err:
-                print(f"[LLM] Failed to send llm_end (connection closed): {send_err}")
-
-    async def start_or_restart_llm(new_text: str, reason: str, play_ack: bool = False, allow_tts: bool = False):
-        nonlocal utterance_id, current_llm_task, llm_started, current_llm_input, llm_started_at_ms, llm_first_token_at_ms
-        nonlocal active_output_u, output_active, tts_epoch, last_tts_chunk_ms, tts_playing, tts_allowed_u
-        nonlocal barge_armed, silent_run_ms, voice_run_ms, tts_sending, voice_state
-
-        prev_u = active_output_u  # что сейчас играет
-
-        # новый ответ → barge-in не армим, пока не увидим тишину
-        barge_armed = False
-        silent_run_ms = 0
-        voice_run_ms = 0
-        tts_playing = False
-
-        utterance_id += 1
-        u_id = utterance_id
-
-        # устанавливаем разрешение на TTS
-        if allow_tts:
-            tts_allowed_u = u_id
-            print(f"[LLM] TTS allowed for utterance {u_id}")
-        else:
-            tts_allowed_u = 0
-            print(f"[LLM] TTS NOT allowed for utterance {u_id}")
-
-        # отменяем предыдущую LLM задачу
-        if current_llm_task and not current_llm_task.done():
-            current_llm_task.cancel()
-            if prev_u:
-                await safe_send_locked({"type": "abort", "scope": "llm", "reason": reason, "utterance_id": prev_u})
-
-        # останавливаем предыдущее аудио (ВАЖНО: prev_u)
-        if prev_u:
-            await safe_send_locked({"type": "abort", "scope": "tts", "reason": reason, "utterance_id": prev_u})
+                    log_session.info("No session or turns found for summary")
+                    summary = "Сессия пуста или не найдена"
 
-        # обесцениваем текущие отправки TTS
-        tts_epoch += 1
-
-        # чистим очередь TTS
-        while not llm_to_tts_q.empty():
-            try:
-                llm_to_tts_q.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-
-        # активируем новый output
-        active_output_u = u_id
-        output_active = True
-
-        current_llm_input = new_text
-        llm_started = True
-        llm_started_at_ms = now_ms()
-        llm_first_token_at_ms = 0
-
-        await safe_send_locked({
-            "type": "llm_start",
-            "utterance_id": u_id,
-            "text": current_llm_input
-        })
-
-        # ACK звук только если нужно И разрешено озвучивание
-        if play_ack and allow_tts:
-            if tts_sending:
-                proto_violation("Attempted ACK while TTS window is active")
-            elif voice_state == VoiceState.ASSISTANT_TTS:
-                proto_violation("Attempted ACK while in ASSISTANT_TTS state")
-            else:
-                # State transition: start ACK TTS
-                voice_state = VoiceState.ASSISTANT_TTS
-                tts_sending = True
-
-                ack_text, ack_wav = tts.get_random_ack_wav()
-                if ack_wav is None:
-                    # Если кэш не готов, синтезируем на лету
-                    ack_text = tts.get_random_ack_text()
-                    ack_wav = await call_with_retry(lambda: tts.synthesize_wav(ack_text, settings=tts_settings), retries=1)
-
-                # Жёстко открываем окно TTS для ACK
-                print(f"[WS] → JSON tts_start (ack)")
+                # Отправляем summary клиенту
                 await safe_send_locked({
-                    "type": "tts_start",
-                    "utterance_id": u_id,
-                    "mime": "audio/wav",
-                    "note": "ack"
+                    "type": "session_summary",
+                    "session_id": session_id,
+                    "agent_id": agent_id,
+                    "summary": summary,
                 })
 
-                await send_audio_binary(u_id, ack_wav)
-
-                # Отправляем tts_end для ACK, чтобы закрыть этот мини-сеанс
-                # Основной ответ LLM откроет свой tts_start в run_tts
-                print(f"[WS] → JSON tts_end (ack, u_id={u_id})")
+                # Отправляем подтверждение завершения
                 await safe_send_locked({
-                    "type": "tts_end",
-                    "utterance_id": u_id
+                    "type": "session_end",
+                    "session_id": session_id,
                 })
-                
-                # НЕ сбрасываем voice_state здесь, run_tts сам установит ASSISTANT_TTS
-                # voice_state = VoiceState.USER_SPEAKING # Эта строка вызывает race condition!
-                tts_sending = False  # ACK сессия завершена, run_tts откроет новую
-            tts_playing = True
-            last_tts_chunk_ms = now_ms()  # anti-echo окно
-            print(f"[ACK] Отправлен ACK '{ack_text}' для utterance {u_id}")
-
-        current_llm_task = asyncio.create_task(run_llm(u_id, current_llm_input))
-
-    async def abort_output(reason: str):
-        nonlocal output_active, active_output_u, tts_epoch
-        nonlocal voice_run_ms, last_barge_in_ms
-        nonlocal tts_playing, barge_armed, silent_run_ms
-        nonlocal current_llm_task
-
-        if not output_active or active_output_u == 0:
-            return
 
-        u = active_output_u
-        output_active = False
-        active_output_u = 0
-        tts_epoch += 1           # после этого run_tts перестанет отправлять аудио
-
-        # сброс barge-in state, иначе состояние может "залипнуть"
-        tts_playing = False
-        tts_sending = False
-        barge_armed = False
-
-        # State transition: abort resets to idle/speaking
-        if voice_state == VoiceState.ASSISTANT_TTS:
-            voice_state = VoiceState.USER_SPEAKING
-        silent_run_ms = 0
-        voice_run_ms = 0
-        tts_allowed_u = 0  # сброс разрешения на TTS
-
-        # сброс LLM состояний при abort
-        llm_started = False
-        current_llm_input = ""
-
-        last_barge_in_ms = now_ms()
-
-        # cancel LLM
-        if current_llm_task and not current_llm_task.done():
-            current_llm_task.cancel()
-
-        # команда клиенту остановить проигрывание
-        print(f"[WS] → JSON abort (llm)")
-        await safe_send_locked({"type": "abort", "scope": "llm", "reason": reason, "utterance_id": u})
-        print(f"[WS] → JSON abort (tts)")
-        await safe_send_locked({"type": "abort", "scope": "tts", "reason": reason, "utterance_id": u})
-
-        # чистим очередь, чтобы хвосты не догоняли
-        while not llm_to_tts_q.empty():
-            try:
-                llm_to_tts_q.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-
-    async def run_tts():
-        """
-        Consumer для очереди LLM→TTS.
-        Читает токены, собирает в чанки и озвучивает.
-        """
-        print(f"[TTS] run_tts STARTED")
-        nonlocal tts_epoch, active_output_u, output_active, last_tts_chunk_ms, tts_playing, tts_allowed_u
-        nonlocal asr_enabled, asr_warming_up, asr_warmup_deadline, llm_started, current_llm_input, tts_sending
-        nonlocal voice_state  # КРИТИЧНО: без этого изменения voice_state не видны в основном цикле!
-        current_u = -1  # Используем -1 вместо 0, чтобы избежать ложных cleanup
-        buf = ""
-        local_epoch = tts_epoch
-
-        print(f"[TTS] Consumer started with initial epoch {local_epoch}")
-
-        while True:
-            print(f"[TTS] Ожидание токена из очереди (epoch={local_epoch}, active={active_output_u})...")
-            u_id, tok = await llm_to_tts_q.get()
-            print(f"[TTS] Получен токен: utterance={u_id}, token='{tok[:20]}...', queue_size={llm_to_tts_q.qsize()}")
-
-            # Новый utterance - сбрасываем буфер и открываем окно TTS
-            if u_id != current_u and current_u != -1:  # Проверяем, что current_u был установлен ранее
-                if tts_sending:
-                    # Завершаем предыдущую TTS сессию, если она не была закрыта
-                    print(f"[WS] → JSON tts_end (overlap cleanup, current_u={current_u})")
-                    await safe_send_locked({"type": "tts_end", "utterance_id": current_u})
-                    tts_sending = False
-
-            # Устанавливаем новый utterance (если это первый запуск или новый utterance)
-            if u_id != current_u:
-                current_u = u_id
-                buf = ""
-                local_epoch = tts_epoch
-
-                # ВСЕГДА посылаем tts_start для основного ответа, даже если был ACK
-                # Это гарантирует, что фронтенд готов принимать новые чанки основного ответа
-                voice_state = VoiceState.ASSISTANT_TTS
-                tts_sending = True
-                
-                print(f"[WS] → JSON tts_start (main response, u_id={current_u})")
-                await safe_send_locked({
-                    "type": "tts_start",
-                    "utterance_id": current_u,
-                    "mime": "audio/wav"
-                })
-
-                # HARD MUTE ASR во время TTS
-                asr_enabled = False
-                asr_warming_up = False
-                print(f"[ASR] Muted during TTS utterance {current_u}")
-
-            # Игнорируем токены старых utterance
-            if u_id != current_u:
-                print(f"[TTS] SKIP token from old utterance: u_id={u_id}, current_u={current_u}, tok='{tok[:20] if tok else 'EOF'}'")
-                continue
-
-            # Маркер завершения LLM
-            if tok == "":
-                print(f"[TTS] ✅ EOF MARKER received for utterance {current_u}, buf: '{buf}' (len={len(buf)})")
-                print(f"[TTS] Starting cleanup: tts_sending={tts_sending}, voice_state={voice_state}")
-                
-                # Сначала обрабатываем все оставшиеся чанки из буфера
-                while buf.strip():
-                    chunks, buf = split_for_tts(buf)
-                    print(f"[TTS] Финальная обработка: разбито на {len(chunks)} чанков, остаток: '{buf}'")
-                    for chunk in chunks:
-                        if len(chunk) < 10:  # Очень маленькие чанки пропускаем
-                            continue
-                        try:
-                            wav = await call_with_retry(lambda: tts.synthesize_wav(chunk, settings=tts_settings), retries=1)
-                            guard_active = not output_active
-                            guard_u = current_u != active_output_u
-                            guard_epoch = local_epoch != tts_epoch
-                            guard_tts_allowed = (tts_allowed_u != current_u)
-                            if guard_active or guard_u or guard_epoch or guard_tts_allowed:
-                                print(f"[TTS] Финальный чанк пропущен: active={output_active}({guard_active}), current_u={current_u} != active_u={active_output_u}({guard_u})")
-                                continue
-                            await safe_send_locked({
-                                "type": "tts_audio",
-                                "utterance_id": current_u,
-                                "mime": "audio/wav"
-                            })
-                            tts_playing = True
-                            await send_audio_binary(current_u, wav)
-                            last_tts_chunk_ms = now_ms()
-                            print(f"[TTS] Финальный чанк отправлен: '{chunk[:30]}...' ({len(wav)} bytes)")
-                        except Exception as e:
-                            print(f"[TTS] Ошибка финального чанка: {e}")
-                    
-                    # Если после разбиения остался маленький остаток, отправляем его как есть
-                    if buf.strip() and len(buf.strip()) >= 10:
-                        tail = buf.strip()
-                        try:
-                            wav = await call_with_retry(lambda: tts.synthesize_wav(tail, settings=tts_settings), retries=1)
-                            guard_active = not output_active
-                            guard_u = current_u != active_output_u
-                            guard_epoch = local_epoch != tts_epoch
-                            guard_tts_allowed = (tts_allowed_u != current_u)
-                            if not (guard_active or guard_u or guard_epoch or guard_tts_allowed):
-                                await safe_send_locked({
-                                    "type": "tts_audio",
-                                    "utterance_id": current_u,
-                                    "mime": "audio/wav"
-                                })
-                                tts_playing = True
-                                await send_audio_binary(current_u, wav)
-                                last_tts_chunk_ms = now_ms()
-                                print(f"[TTS] Последний остаток отправлен: '{tail[:30]}...' ({len(wav)} bytes)")
-                        except Exception as e:
-                            print(f"[TTS] Ошибка последнего остатка: {e}")
-                        buf = ""  # Очищаем буфер после отправки
-
-                if current_u == active_output_u:
-                    output_active = False
-                    active_output_u = 0
-                
-                print(f"[WS] → JSON tts_end")
-                
-                # КРИТИЧНО: Сбрасываем флаги ДО отправки tts_end, чтобы избежать гонки условий
-                # Это гарантирует, что к моменту получения tts_end клиентом, состояние уже обновлено
-                tts_playing = False
-                tts_sending = False
-
-                # State transition: TTS finished
-                if voice_state != VoiceState.ASSISTANT_TTS:
-                    proto_violation("tts_end received while not in TTS state")
-                
-                # Возвращаемся в IDLE, чтобы начать ждать новую реплику пользователя
-                voice_state = VoiceState.IDLE
-                print(f"[STATE] ASSISTANT_TTS → IDLE (TTS finished for utterance {current_u})")
-                
-                await safe_send_locked({"type": "tts_end", "utterance_id": current_u})
-
-                # Сбрасываем распознаватель Vosk, чтобы он не учитывал старый шум/эхо
-                try:
-                    rec.Reset()
-                    print("[ASR] Vosk recognizer reset after TTS")
-                except Exception as e:
-                    print(f"[ASR] Failed to reset Vosk: {e}")
-
-                # СБРОС ТАЙМЕРОВ ТИШИНЫ: крайне важно для продолжения диалога
-                now_after_tts = now_ms()
-                last_voice_ms = now_after_tts
-                last_partial_change_ms = now_after_tts
-                last_tts_chunk_ms = 0  # КРИТИЧНО: сбрасываем таймер TTS, чтобы не блокировать обработку
-                last_partial = ""
-                endpoint_state = "listening"
-                ack_sent_for_turn = False # Разрешаем ACK для следующей фразы
-                print("[ASR] Silence timers, TTS timer, and endpoint state reset after TTS")
-
-                # ASR WARMUP: мягкая реинициализация после TTS
-                asr_enabled = True
-                asr_warming_up = True
-                asr_warmup_deadline = time.time() + (ASR_WARMUP_MS / 1000.0)
-                print(f"[ASR] Warmup mode after TTS utterance {current_u} (deadline: {asr_warmup_deadline:.3f})")
-
-                # СОХРАНИТЬ ПОЛНЫЙ ОТВЕТ АССИСТЕНТА В ИСТОРИЮ СЕССИИ (СТРОГО ОДИН РАЗ)
-                session = SESSIONS.get(session_id)
+                # Отмечаем сессию как завершенную (не удаляем сразу - нужен для HTTP API)
                 if session:
-                    assistant_text = session.llm_buffers.pop(current_u, "").strip()
-                    if assistant_text:
-                        session.add_turn("assistant", assistant_text, utterance_id=current_u)
-
-                        # Отправляем нормализованное событие в Voice Control
-                        event = normalize_event(
-                            event_type="final",
-                            role="assistant",
-                            text=assistant_text,
-                        )
-                        if event:
-                            await push_event_to_voice_control(session_id, event)
-                            print(f"[SESSION:{session_id}] Saved assistant response: '{assistant_text[:50]}...'")
-                            print(f"[SESSION:{session_id}] Session now has {len(session.turns)} turns total")
-                        else:
-                            print(f"[EVENT] Dropped invalid assistant event: text='{assistant_text[:50]}...'")
-                
-                # СБРОС состояний после завершения utterance
-                llm_started = False
-                current_llm_input = ""
-                tts_allowed_u = 0
-                continue
-
-            # Нормальный токен - добавляем в буфер с фильтром дублирования
-            # Фильтруем очевидные дублирования слов
-            test_buf = buf + tok
-            words = test_buf.split()
-            filtered_words = []
-            for word in words:
-                # Убираем слова, которые повторяются подряд
-                if len(filtered_words) == 0 or word != filtered_words[-1]:
-                    filtered_words.append(word)
-                elif word == filtered_words[-1] and len(word) > 3:  # Для коротких слов дублирование нормально
-                    continue  # Пропускаем дублирование длинных слов
-
-            buf = ' '.join(filtered_words)
-            print(f"[TTS] Буфер после фильтрации: '{buf}' (len={len(buf)})")
-
-            # Разбиваем на чанки и озвучиваем (только если чанк достаточно большой)
-            chunks, buf = split_for_tts(buf)
-            if chunks:
-                print(f"[TTS] Разбито на {len(chunks)} чанков, остаток: '{buf}'")
-            for chunk in chunks:
-                # Пропускаем слишком маленькие чанки, кроме завершающих предложений
-                # Снизили порог с 20 до 10 для более быстрой озвучки коротких ответов
-                if len(chunk) < 10 and not chunk.endswith(('.', '!', '?', '\n', ',')):
-                    print(f"[TTS] Чанк слишком маленький, откладываем: '{chunk}' (len={len(chunk)})")
-                    buf = chunk + ' ' + buf  # Возвращаем обратно в буфер
-                    continue
-                try:
-                    wav = await call_with_retry(lambda: tts.synthesize_wav(chunk, settings=tts_settings), retries=1)
-                    guard_active = not output_active
-                    guard_u = current_u != active_output_u
-                    guard_epoch = local_epoch != tts_epoch
-                    guard_tts_allowed = (tts_allowed_u != current_u)
-                    print(f"[TTS] Guard check: active={output_active}, current_u={current_u}, active_u={active_output_u}, tts_allowed_u={tts_allowed_u}, epoch={local_epoch}/{tts_epoch}")
-                    if guard_active or guard_u or guard_epoch or guard_tts_allowed:
-                        # ответ уже прерван или устарел или TTS не разрешено
-                        print(f"[TTS] ❌ Чанк пропущен: active={output_active}({guard_active}), current_u={current_u} != active_u={active_output_u}({guard_u}), local_epoch={local_epoch} != global_epoch={tts_epoch}({guard_epoch}), tts_allowed_u={tts_allowed_u}({guard_tts_allowed})")
-                        continue
-                    print(f"[TTS] ✅ Отправка чанка: '{chunk[:30]}...' ({len(wav)} bytes)")
-                    await safe_send_locked({
-                        "type": "tts_audio",
-                        "utterance_id": current_u,
-                        "mime": "audio/wav"
-                    })
-                    tts_playing = True
-                    await send_audio_binary(current_u, wav)
-                    last_tts_chunk_ms = now_ms()
-                    print(f"[TTS] ✅ Чанк отправлен: '{chunk[:30]}...' ({len(wav)} bytes)")
-                except Exception as e:
-                    print(f"[TTS] Ошибка чанка '{chunk[:30]}...': {e}")
-                    await safe_send_locked({
-                        "type": "tts_error",
-                        "utterance_id": current_u,
-                        "error": f"Chunk failed: {str(e)}"
-                    })
-
-    # Запускаем TTS consumer
-    if tts_task is None:
-        tts_task = asyncio.create_task(run_tts())
-        print("[TTS] Consumer запущен")
-    else:
-        print("[TTS] Consumer уже запущен")
-
-    await safe_send_locked({
-        "event": "ready",
-        "sample_rate": sample_rate,
-        "frame_ms": FRAME_MS,
-        "vad_mode": VAD_MODE,
-        "early_pause_ms": EARLY_PAUSE_MS,
-        "final_pause_ms": FINAL_PAUSE_MS,
-        "stable_ms": STABLE_MS
-    })
-
-    # Для cancel предыдущих chat запросов (legacy)
-    current_chat_task: asyncio.Task | None = None
-
-    async def run_chat(question: str):
-        """Запускает streaming chat с DeepSeek"""
-        try:
-            print(f"[CHAT] Начинаем обработку вопроса: '{question}'")
-            await safe_send_locked({"type": "chat_start", "question": question})
-            print(f"[CHAT] Отправлено chat_start")
-
-            acc = []
-            token_count = 0
-            async for token in openai_stream(question, model=llm_model, system_prompt=system_prompt, max_tokens=llm_max_tokens, temperature=llm_temp):
-                acc.append(token)
-                token_count += 1
-                await safe_send_locked({"type": "chat_delta", "delta": token})
-
-            answer = "".join(acc).strip()
-            print(f"[CHAT] Завершено. Токенов: {token_count}, Ответ: '{answer[:100]}...'")
-
-            # Автоматически озвучиваем ответ через TTS
-            print(f"[TTS] Отправляем на озвучку: '{answer[:50]}...'")
-            audio_data = await call_tts_api(answer)
-            print(f"[TTS] Аудио данные получены (длина: {len(audio_data) if audio_data else 0})")
-
-            await safe_send_locked({"type": "chat_end", "question": question, "answer": answer, "audio_data": audio_data})
-        except asyncio.CancelledError:
-            print(f"[CHAT] Задача отменена для вопроса: '{question}'")
-            # Задача отменена, ничего не делаем
-            pass
-        except Exception as e:
-            print(f"[CHAT] Ошибка при обработке вопроса '{question}': {e}")
-            await safe_send_locked({"type": "chat_error", "error": str(e)})
-
-    try:
-        async for msg in ws:
-            # === ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ (JSON) ===
-            if isinstance(msg, str):
-                print(f"[WS] Получено текстовое сообщение: {msg[:100]}..." if len(msg) > 100 else f"[WS] Получено текстовое сообщение: {msg}")
-                try:
-                    data = json.loads(msg)
-                    print(f"[WS] Распарсено JSON: {data}")
-                except json.JSONDecodeError as e:
-                    print(f"[WS] Ошибка парсинга JSON: {e}")
-                    continue
-
-                # === CONFIG HANDLER (HANDSHAKE) ===
-                if "config" in data:
-                    try:
-                        if handshake_done:
-                            # Повторный config — протокольное нарушение, но не рвём соединение
-                            logger.warning("[PROTO] Duplicate config received, ignored")
-                            await safe_send_locked({
-                                "event": "warning",
-                                "reason": "config_already_applied"
-                            })
-                            continue  # Продолжаем обработку, не закрываем соединение
-
-                        cfg = data.get("config") or {}
-                        print(f"[HANDSHAKE] Received config: {cfg}")
-
-                        # --- sample_rate ---
-                        requested_sr = cfg.get("sample_rate")
-                        try:
-                            requested_sr = int(requested_sr) if requested_sr is not None else None
-                        except Exception:
-                            requested_sr = None
-
-                        new_sr = normalize_sample_rate(requested_sr)
-
-                        if requested_sr and requested_sr != new_sr:
-                            await safe_send_locked({
-                                "event": "reconfigured",
-                                "sample_rate": new_sr,
-                                "note": "server supports pcm16 mono 16000 only"
-                            })
-
-                        # --- ASR options ---
-                        words = bool(cfg.get("words", False))
-                        phrase_list = cfg.get("phrase_list")
-
-                        # --- apply settings ---
-                        sample_rate = new_sr
-                        fb = frame_bytes(sample_rate, FRAME_MS)
-
-                        audio_buf.clear()
-                        # webrtcvad.Vad не имеет метода reset(), но состояние VAD не критично для handshake
-                        # VAD продолжит работу с текущим состоянием
-                        rec = build_recognizer(
-                            sample_rate=sample_rate,
-                            phrase_list=phrase_list,
-                            words=words,
-                        )
-
-                        # --- handshake completed ---
-                        handshake_done = True
-                        asr_enabled = True
-
-                        print("[HANDSHAKE] Config applied, sending READY")
-
-                        await safe_send_locked({
-                            "event": "ready",
-                            "sample_rate": sample_rate,
-                            "frame_ms": FRAME_MS,
-                            "vad_mode": VAD_MODE,
-                            "early_pause_ms": EARLY_PAUSE_MS,
-                        })
-
-                        print("[HANDSHAKE] READY sent")
-                        continue  # Продолжаем обработку следующих сообщений
-
-                    except Exception as e:
-                        print("[HANDSHAKE][FATAL]", e)
-                        import traceback
-                        traceback.print_exc()
-                        await ws.close(code=1011, reason="config handler failed")
-                        return
-
-                # ОБРАБОТКА КОМАНДЫ ЗАВЕРШЕНИЯ СЕССИИ
-                if data.get("type") == "end_session":
-                    print(f"[SESSION] Received end_session command for session {session_id}")
-                    session = SESSIONS.get(session_id)
-                    summary = ""
-
-                    if session and session.turns:
-                        print(f"[SESSION] Building summary for session {session_id} with {len(session.turns)} turns")
-                        try:
-                            summary = build_session_summary(session)
-                            print(f"[SESSION] Summary generated: {len(summary)} chars")
-                        except Exception as e:
-                            print(f"[SESSION] Error generating summary: {e}")
-                            summary = f"Ошибка генерации summary: {e}"
-                    else:
-                        print(f"[SESSION] No session or turns found for summary")
-                        summary = "Сессия пуста или не найдена"
-
-                    # Отправляем summary клиенту
-                    await safe_send_locked({
-                        "type": "session_summary",
-                        "session_id": session_id,
-                        "agent_id": agent_id,
-                        "summary": summary,
-                    })
-
-                    # Отправляем подтверждение завершения
-                    await safe_send_locked({
-                        "type": "session_end",
-                        "session_id": session_id,
-                    })
-
-                    # Отмечаем сессию как завершенную (не удаляем сразу - нужен для HTTP API)
-                    if session:
-                        session.ended = True
-                        session.ended_at_ms = now_ms()
-                        session.summary = summary
-                        print(f"[SESSION] Session {session_id} marked as ended (will be cleaned up by TTL)")
-
-                    # Закрываем соединение
-                    await ws.close(code=1000, reason="client_end")
-                    return
+                    SESSIONS.mark_ended(session_id, summary)
+                    log_session.info("Session %s marked as ended (will be cleaned up by TTL)", session_id)
 
+                # Закрываем соединение
+                await ws.close(code=1000, reason="client_end")
+                return
 
-                # reset: финализировать текущую фразу и продолжить
-                if data.get("reset") == 1:
-                    final_json = json.loads(rec.FinalResult())
-                    final_text = (final_json.get("text") or "").strip()
-                    if final_text:  # НЕ отправляем пустые final
-                        await safe_send_locked({"type": "final", **final_json})
-
-                        # State transition: user finished speaking, starting LLM
-                        if voice_state == VoiceState.USER_SPEAKING:
-                            voice_state = VoiceState.IDLE  # User input complete, waiting for LLM
-
-                    # ЗАПУСК LLM ПО ФИНАЛЬНОМУ РЕЗУЛЬТАТУ ASR
-                    await handle_final_text(final_json.get("text"), reason="final_reset")
-
-                    # Новая пользовательская реплика - сбрасываем состояния turn
-                    turn_id += 1
-                    ack_sent_for_turn = False
-                    llm_started = False
-                    current_llm_input = ""
-                    pause_gate_open = True
-
-                    # Сброс WPS состояний для новой реплики
-                    wps_ema = 2.2
-                    prev_wc = 0
-                    prev_wc_ts_ms = 0
-                    rec = build_recognizer(sample_rate, phrase_list=phrase_list, words=words)
-                    last_partial = ""
-                    continue
-
-                # partial: имитация ASR partial для тестирования
-                if data.get("type") == "partial":
-                    partial_text = data.get("partial", "").strip()
-                    if partial_text:
-                        # Имитируем ASR partial результат
-                        last_partial = partial_text
-                        last_partial_change_ms = now_ms()
-
-                        part_json = {
-                            "partial": partial_text,
-                            "result": []
-                        }
-                        await safe_send_locked({"type": "partial", **part_json})
-                        print(f"[ASR] Имитирован ASR partial: '{partial_text}'")
-                    continue
-
-                # final: имитация ASR final для тестирования - ВЫЗЫВАЕМ FINAL ENDPOINT ЛОГИКУ
-                if data.get("type") == "final":
-                    final_text = data.get("text", "").strip()
-                    if final_text:
-                        # Имитируем ASR final результат
-                        final_json = {
-                            "text": final_text,
-                            "result": []
-                        }
-
-                        # ВЫЗЫВАЕМ FINAL ENDPOINT ЛОГИКУ ЗДЕСЬ
-                        await handle_final_text(final_text, reason="final_json")
-
-                        await safe_send_locked({"type": "final", **final_json})
-
-                        # State transition: test final
-                        if voice_state == VoiceState.USER_SPEAKING:
-                            voice_state = VoiceState.IDLE
-                        print(f"[TEST] Имитирован ASR final: '{final_text}'")
-
-                        # Новая пользовательская реплика - сбрасываем состояния turn
-                        turn_id += 1
-                        ack_sent_for_turn = False
-                        llm_started = False
-                        current_llm_input = ""
-                        pause_gate_open = True
-
-                        # Сброс WPS состояний для новой реплики
-                        wps_ema = 2.2
-                        prev_wc = 0
-                        prev_wc_ts_ms = 0
-
-                        # Сброс FSM endpointing состояний
-                        endpoint_state = "listening"
-                        endpoint_tentative_start_ms = 0
-                        endpoint_confirmed_start_ms = 0
-
-                    continue
-
-                # ping: keep-alive от клиента
-                if "ping" in data:
-                    # Отвечаем pong для keep-alive
-                    await safe_send_locked({"pong": data["ping"]})
-                    continue
-
-                # eof: финализировать и закрыть
-                if data.get("eof") == 1:
-                    final_json = json.loads(rec.FinalResult())
-                    final_text = (final_json.get("text") or "").strip()
-                    if final_text:  # НЕ отправляем пустые final
-                        await safe_send_locked({"type": "final", **final_json})
-                    # Новая пользовательская реплика - сбрасываем состояния turn
-                    turn_id += 1
-                    ack_sent_for_turn = False
-                    llm_started = False
-                    current_llm_input = ""
-                    pause_gate_open = True
-
-                    # Сброс WPS состояний для новой реплики
-                    wps_ema = 2.2
-                    prev_wc = 0
-                    prev_wc_ts_ms = 0
-                    await ws.close(code=1000, reason="eof")
-                    return
-
-                # chat: отправить вопрос в DeepSeek API с streaming
-                if "chat" in data:
-                    question = data["chat"].strip()
-                    print(f"[CHAT] Получен вопрос: '{question}'")
-                    if question:
-                        # Отменяем предыдущий LLM запрос если он еще выполняется
-                        if current_llm_task and not current_llm_task.done():
-                            print(f"[CHAT] Отменяем предыдущий LLM task")
-                            current_llm_task.cancel()
-                            await safe_send_locked({"type": "abort", "scope": "llm", "reason": "new_chat"})
-
-                        async def run_llm(q: str):
-                            """Запуск LLM streaming для конкретного utterance_id (chat версия)"""
-                            nonlocal llm_first_token_at_ms
-
-                            utterance_id = 1  # Для chat запросов используем фиксированный utterance_id
-                            await safe_send_locked({"type": "nlu_start", "utterance_id": utterance_id, "text": q})
-                            await safe_send_locked({"type": "chat_start", "question": q})
-
-                            first = True
-                            acc = []  # Собираем полный ответ
-                            try:
-                                async for tok in openai_stream(q, model=llm_model, system_prompt=system_prompt, max_tokens=llm_max_tokens, temperature=llm_temp):
-                                    if first:
-                                        llm_first_token_at_ms = now_ms()
-                                        first = False
-                                        await safe_send_locked({
-                                            "type": "metric",
-                                            "utterance_id": utterance_id,
-                                            "llm_first_token_ms": llm_first_token_at_ms - llm_started_at_ms
-                                        })
-
-                                    await safe_send_locked({"type": "llm_delta", "utterance_id": utterance_id, "delta": tok})
-
-                                    # Кладём токен в очередь для TTS
-                                    try:
-                                        await llm_to_tts_q.put((utterance_id, tok))
-                                    except asyncio.QueueFull:
-                                        print(f"[LLM] Очередь TTS переполнена, пропускаем токен")
-
-                            except asyncio.CancelledError:
-                                # Корректная отмена
-                                raise
-                            except Exception as e:
-                                await safe_send_locked({"type": "llm_error", "utterance_id": utterance_id, "error": str(e)})
-                            finally:
-                                # Сигнал завершения для TTS
-                                try:
-                                    await llm_to_tts_q.put((utterance_id, ""))
-                                except asyncio.QueueFull:
-                                    print(f"[LLM] Очередь TTS переполнена, не удалось отправить сигнал завершения")
-
-                                await safe_send_locked({"type": "chat_response", "question": q, "answer": "".join(acc)})
-                                await safe_send_locked({"type": "llm_end", "utterance_id": utterance_id})
-
-                        print(f"[CHAT] Запускаем новый LLM task для вопроса: '{question}'")
-                        current_llm_task = asyncio.create_task(run_llm(question))
-                    else:
-                        print(f"[CHAT] Пустой вопрос, пропускаем")
-                    continue
-
-                continue
-
-            # === ОБРАБОТКА БИНАРНЫХ СООБЩЕНИЙ (PCM) ===
-            else:  # Бинарный аудио-чанк: 16-bit mono PCM little-endian
-                # Проверка протокола
-                if not handshake_done:
-                    proto_violation("PCM received before READY")
-                    continue
-
-                if voice_state == VoiceState.ASSISTANT_TTS:
-                    proto_violation("User PCM received during ASSISTANT_TTS state - dropped")
-                    continue
-
-                pcm_data = msg
-                print(f"[PCM] Получены бинарные данные: {len(pcm_data)} bytes")
-
-                # Проверяем что PCM в правильном формате (int16 mono)
-                if len(pcm_data) % 2 != 0:
-                    proto_violation(f"PCM data size {len(pcm_data)} not divisible by 2 (expected int16)")
-                    continue
-
-                expected_samples_per_20ms = int(sample_rate * 0.02)  # 20ms фрейм
-                expected_bytes_per_20ms = expected_samples_per_20ms * 2  # int16 = 2 bytes
-                if len(pcm_data) != expected_bytes_per_20ms:
-                    proto_violation(f"Bad PCM frame size: {len(pcm_data)} bytes, expected {expected_bytes_per_20ms} bytes (20ms @ {sample_rate}Hz int16 mono)")
-                    continue
-
-                # ПРОВЕРКА ASR MUTE
-                if not asr_enabled:
-                    continue
-
-                # ASR WARMUP: собираем буфер в течении ASR_WARMUP_MS
-                if asr_warming_up:
-                    # Добавляем PCM в буфер
-                    audio_buf.extend(pcm_data)
-
-                    # Проверяем завершение warmup
-                    if time.time() >= asr_warmup_deadline:
-                        asr_warming_up = False
-                        # Мягкий сброс VAD (только временные счетчики)
-                        vad.soft_reset()
-                        print("[ASR] Warmup completed, ASR fully active, processing buffered audio")
-                        # НЕ continue - обрабатываем накопленный буфер сразу
-                    else:
-                        continue  # Продолжаем собирать буфер
-                else:
-                    # Нормальная работа: добавляем новый PCM в буфер
-                    print(f"[AUDIO] Получен чанк: {len(pcm_data)} bytes, буфер: {len(audio_buf)}")
-                    audio_buf.extend(pcm_data)
-
-                # Обрабатываем аудио по фреймам
-                frames_processed = 0
-                while len(audio_buf) >= fb:
-                    frame = bytes(audio_buf[:fb])
-                    del audio_buf[:fb]
-                    frames_processed += 1
-
-                    # 1) VAD: определяем речь/тишину
-                    try:
-                        is_voice = vad.is_speech(frame, sample_rate)
-                    except ValueError as e:
-                        # Защита от некорректного фрейма / несостыковки sample_rate
-                        print(f"[VAD] Frame mismatch error: {e} (frame_len={len(frame)}, sample_rate={sample_rate})")
-                        # Сбрасываем буфер и продолжаем работу (не рвём соединение)
-                        audio_buf.clear()
-                        continue
-                    if is_voice:
-                        last_voice_ms = now_ms()
-                        print(f"[VAD] Речь обнаружена в фрейме {frames_processed}")
-                        
-                        # Если мы были в IDLE, переходим в состояние USER_SPEAKING
-                        if voice_state == VoiceState.IDLE:
-                            voice_state = VoiceState.USER_SPEAKING
-                            print("[STATE] IDLE → USER_SPEAKING")
-                    else:
-                        print(f"[VAD] Тишина в фрейме {frames_processed}")
-
-                    # ---------- Обновление статистики пауз для адаптивности ----------
-                    if was_voice_prev and (not is_voice):
-                        silence_start_ms = now_ms()
-                    if (not was_voice_prev) and is_voice and silence_start_ms:
-                        pause_ms = now_ms() - silence_start_ms
-                        pause_ema_ms = update_pause_ema(pause_ema_ms, pause_ms, PAUSE_EMA_ALPHA)
-                        silence_start_ms = 0
-                    was_voice_prev = is_voice
-
-                    # ---------- BARGE-IN ARMING (только после тишины) ----------
-                    if output_active:
-                        if not is_voice:
-                            silent_run_ms += FRAME_MS
-                            if silent_run_ms >= BARGE_IN_ARM_SILENCE_MS:
-                                barge_armed = True
-                        else:
-                            silent_run_ms = 0
-                    else:
-                        # если нет активного ответа — сбрасываем
-                        barge_armed = False
-                        silent_run_ms = 0
-                        voice_run_ms = 0
-
-                    # ---------- BARGE-IN (прерывание ответа) ----------
-                    if BARGE_IN_ENABLED and output_active and is_voice:
-                        now_bi = now_ms()
-
-                        # 1) пока озвучка "идёт" — barge-in запрещён (иначе эхо рубит)
-                        if tts_playing:
-                            voice_run_ms = 0
-
-                        # 2) ещё не было тишины во время ответа → это хвост пользовательской реплики, НЕ barge-in
-                        elif not barge_armed:
-                            voice_run_ms = 0
-
-                        # 3) cooldown
-                        elif now_bi - last_barge_in_ms < BARGE_IN_COOLDOWN_MS:
-                            pass
-
-                        # 4) анти-эхо окно после последнего отправленного аудио
-                        elif now_bi - last_tts_chunk_ms < BARGE_IN_IGNORE_AFTER_TTS_MS:
-                            voice_run_ms = 0
-
-                        else:
-                            voice_run_ms += FRAME_MS
-                            if voice_run_ms >= BARGE_IN_MIN_VOICE_MS:
-                                await abort_output("barge_in_user_speaking")
-                    else:
-                        if not is_voice:
-                            voice_run_ms = 0
-
-                    # 2) ASR: скармливаем Vosk тот же фрейм
-                    # Если идёт озвучка — не пускаем аудио в ASR, иначе ловим эхо TTS
-                    if output_active and tts_playing:
-                        continue
-                    # Доп. окно после чанка TTS
-                    if output_active and (now_ms() - last_tts_chunk_ms) < BARGE_IN_IGNORE_AFTER_TTS_MS:
-                        continue
-                    ok = await decode_accept(rec, frame)
-
-                    if ok:
-                        # Vosk решил, что фраза завершилась (по своей логике)
-                        final_json = json.loads(rec.Result())
-                        final_text = (final_json.get("text") or "").strip()
-                        if final_text:  # НЕ отправляем пустые final
-                            await safe_send_locked({"type": "final", **final_json})
-
-                            # State transition: user finished speaking, starting LLM
-                                voice_state = VoiceState.IDLE
-                            print("[STATE] USER_SPEAKING → IDLE (final received)")
-
-                        # ВАЖНО: Запуск LLM по final из Vosk (rec.Result())
-                        await handle_final_text(final_json.get("text"), reason="final_vosk_result")
-
-                        # сброс состояний под новую фразу
-                        last_partial = ""
-                        last_partial_change_ms = now_ms()
-                        early_endpoint_fired = False
-                        # СБРОС: новая фраза пользователя
-                        llm_started = False
-                        current_llm_input = ""
-                        continue
-
-                    # 3) partial: ограничиваем частоту + отслеживаем стабильность
-                    now = now_ms()
-                    if now - last_partial_sent_ms >= PARTIAL_RATE_LIMIT_MS:
-                        part_json = json.loads(rec.PartialResult())
-                        partial = (part_json.get("partial") or "").strip()
-
-                        if partial and partial != last_partial:
-                            # Если мы получили текст, а состояние всё еще IDLE - значит пользователь начал говорить
-                            if voice_state == VoiceState.IDLE:
-                                voice_state = VoiceState.USER_SPEAKING
-                                print(f"[STATE] IDLE → USER_SPEAKING (detected by partial: '{partial[:30]}')")
-
-                            # Фильтр tail jitter: не сбрасываем стабильность на мелкие изменения хвоста
-                            if not is_tail_jitter(partial, last_partial):
-                                last_partial_change_ms = now
-
-                                # Обновляем скорость речи
-                                curr_wc = word_count(partial)
-                                if prev_wc_ts_ms > 0 and curr_wc > prev_wc:
-                                    dt = now - prev_wc_ts_ms
-                                    wps_ema = update_wps_ema(wps_ema, prev_wc, curr_wc, dt)
-                                prev_wc = curr_wc
-                                prev_wc_ts_ms = now
-
-                            last_partial = partial
-                            await safe_send_locked({"type": "partial", **part_json})
-                            last_partial_sent_ms = now
-
-
-                    # 4) FSM Endpointing логика: listening -> tentative -> confirmed -> final
-                    silent_ms = now - last_voice_ms
-                    stable_ms = now - last_partial_change_ms
-
-                    # Рассчитываем адаптивные пороги для текущего текста
-                    if last_partial:
-                        tent_ms, conf_ms, fin_ms = compute_adaptive_thresholds(last_partial, wps_ema, pause_ema_ms)
-                    else:
-                        tent_ms, conf_ms, fin_ms = 350, 1100, 1600  # дефолтные значения
-
-                    # FSM логика переходов
-                    print(f"[ENDPOINT] state={endpoint_state} | silence={silent_ms}ms | stable={stable_ms}ms | text='{last_partial[:50]}...'")
-
-                    if endpoint_state == "listening":
-                        # Переход в tentative при достаточной паузе и стабильности
-                        if (last_partial and is_meaningful(last_partial) and
-                            stable_ms >= 300 and silent_ms >= tent_ms):
-                            endpoint_state = "tentative"
-                            endpoint_tentative_start_ms = now
-                            print(f"[ENDPOINT] → tentative (tent_ms={tent_ms})")
-
-                            await safe_send_locked({
-                                "type": "asr_tentative_pause",
-                                "text": last_partial,
-                                "silent_ms": silent_ms,
-                                "stable_ms": stable_ms,
-                                "tentative_ms": tent_ms,
-                                "confirm_ms": conf_ms
-                            })
-
-                            # LLM стартует ТОЛЬКО из final - убираем tentative_pause
-
-                    elif endpoint_state == "tentative":
-                        # Возврат в listening если partial изменился
-                        if last_partial and last_partial != part_json.get("partial", ""):
-                            endpoint_state = "listening"
-                            print("[ENDPOINT] ← listening (partial changed)")
-                        # Переход в confirmed при достаточной паузе и хорошем конце
-                        elif (silent_ms >= conf_ms and stable_ms >= 500 and
-                              last_partial and is_good_end(last_partial)):
-                            endpoint_state = "confirmed"
-                            endpoint_confirmed_start_ms = now
-                            print(f"[ENDPOINT] → confirmed (conf_ms={conf_ms})")
-
-                            await safe_send_locked({
-                                "type": "asr_confirmed_end",
-                                "text": last_partial,
-                                "silent_ms": silent_ms,
-                                "stable_ms": stable_ms,
-                                "confirm_ms": conf_ms,
-                                "tentative_ms": tent_ms,
-                                "final_ms": fin_ms,
-                                "pause_ema_ms": pause_ema_ms,
-                                "wps_ema": wps_ema,
-                                "word_count": len(last_partial.strip().split()),
-                                "is_good_end": is_good_end(last_partial)
-                            })
-
-                            # LLM стартует ТОЛЬКО из final - confirmed_end_start удален
-
-                    elif endpoint_state == "confirmed":
-                        # Возврат в listening если partial изменился
-                        if last_partial and last_partial != part_json.get("partial", ""):
-                            endpoint_state = "listening"
-                            print("[ENDPOINT] ← listening (partial changed in confirmed)")
-                        # Переход в final при максимальной паузе
-                        elif silent_ms >= fin_ms:
-                            endpoint_state = "final"
-                            print(f"[ENDPOINT] → final (fin_ms={fin_ms})")
-
-                    # Сброс FSM при начале новой речи
-                    if is_voice and endpoint_state != "listening":
-                        endpoint_state = "listening"
-                        print("[ENDPOINT] ← listening (voice detected)")
-
-                    # FINAL ENDPOINT: длинная пауза -> финализируем принудительно
-                    # Обрабатывается только по аудио данным (не по JSON)
-                    if last_partial and silent_ms >= fin_ms:
-                        final_json = json.loads(rec.FinalResult())
-                        final_text = (final_json.get("text") or "").strip()
-                        if final_text:  # НЕ отправляем пустые final
-                            await safe_send_locked({"type": "final", **final_json})
-
-                            # State transition: user finished speaking (pause timeout)
-                            if voice_state == VoiceState.USER_SPEAKING:
-                                voice_state = VoiceState.IDLE
-
-                        # Проверяем, нужно ли запустить/перезапустить LLM по финальному тексту
-                        await handle_final_text(final_json.get("text"), reason="final_pause")
-
-                        # Новая пользовательская реплика - сбрасываем состояния turn
-                        turn_id += 1
-                        ack_sent_for_turn = False
-                        llm_started = False  # СБРОС: разрешаем запуск LLM для следующей реплики
-                        current_llm_input = ""  # СБРОС: очищаем предыдущий input
-                        pause_gate_open = True
-
-                        # Сброс WPS состояний для новой реплики
-                        wps_ema = 2.2
-                        prev_wc = 0
-                        prev_wc_ts_ms = 0
-
-                        # Сброс FSM endpointing состояний
-                        endpoint_state = "listening"
-                        endpoint_tentative_start_ms = 0
-                        endpoint_confirmed_start_ms = 0
-
-                        # пересоздаём recognizer под следующую фразу
-                        rec = build_recognizer(sample_rate, phrase_list=phrase_list, words=words)
-
-                        last_partial = ""
-                        last_partial_change_ms = now_ms()
-                        early_endpoint_fired = False
+            # config, reset, partial/final (тесты), ping, eof, chat
+            if not await pipeline.handle_control(data):
+                return
 
     except websockets.exceptions.ConnectionClosed as e:
-        logger.info(f"WebSocket connection closed normally: {e.code} {e.reason}")
-        # Cancel активные tasks при закрытии соединения
-        if current_chat_task and not current_chat_task.done():
-            current_chat_task.cancel()
-        if current_llm_task and not current_llm_task.done():
-            current_llm_task.cancel()
-        if tts_task and not tts_task.done():
-            tts_task.cancel()
+        log_handler.info("WebSocket connection closed normally: %s %s", e.code, e.reason)
         return
     except Exception as e:
-        print(f"[HANDLER][FATAL] Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
-        logger.exception("handler crashed with unexpected error")
+        log_handler.exception("FATAL: handler crashed with unexpected error: %s", e)
         # Короткая причина (reason должен быть коротким)
         try:
             await ws.close(code=1011, reason="internal_error")
@@ -2554,20 +1390,28 @@ async def handler(ws: WebSocketServerProtocol):
             pass
     finally:
         # Отменяем все активные задачи при закрытии соединения
-        print("[HANDLER] Закрытие соединения, отменяем задачи")
-        if tts_task and not tts_task.done():
-            tts_task.cancel()
-            print("[HANDLER] TTS task отменен")
-
-
-async def main():
-    print(f"[boot] ws://{HOST}:{PORT}, health:{HEALTH_PORT}")
+        log_handler.info("Закрытие соединения, отменяем задачи")
+        pipeline.close()
+        SESSIONS.detach(session_id)
+        if not session.attached:
+            # соединение ушло без end_session: SSE-подписчики не должны ждать вечно
+            EVENT_BUS.publish(session_id, "session_detached",
+                              json.dumps({"type": "session_detached", "session_id": session_id}))
+        LLM_TO_TTS_QUEUES.discard(pipeline.llm_to_tts_q)
+        WS_CONNECTIONS.dec()
+        if recorder is not None:
+            recorder.close()
+            log_handler.info("Запись сессии: %s (%s сообщений)", recorder.path, recorder.frames)
+
+
+async def main(reuse_port: bool = False):
+    log_boot.info("ws://%s:%s, health:%s", HOST, PORT, HEALTH_PORT)
 
     # Graceful shutdown event
     stop_event = asyncio.Event()
 
     def _stop(*_):
-        print("[SHUTDOWN] Получен сигнал завершения")
+        log_shutdown.info("Получен сигнал завершения")
         stop_event.set()
 
     # Настраиваем обработчики сигналов
@@ -2581,26 +1425,29 @@ async def main():
         await init_tts_api_http()
     await init_tts_http()
 
-    # Запускаем health сервер
+    if VOICE_INTERNAL_KEY and VOICE_CONTROL_URL:
+        VOICE_CONTROL_OUTBOX.start()
+    ADMISSION.start()
+
+    # Запускаем health сервер до загрузки моделей: /health жив сразу, /ready — после прогрева
     health_srv = await health_server()
 
     async def cleanup_sessions_task():
         while True:
             await asyncio.sleep(60)
-            now = now_ms()
-            ttl = 10 * 60 * 1000  # 10 минут
-            dead = []
-            for sid, sess in SESSIONS.items():
-                if sess.ended and sess.ended_at_ms and (now - sess.ended_at_ms) > ttl:
-                    dead.append(sid)
-            for sid in dead:
-                SESSIONS.pop(sid, None)
-                print(f"[SESSION] cleaned {sid}")
+            for sid in SESSIONS.evict_expired(now_ms()):
+                log_session.info("cleaned %s", sid)
+            log_session.info("stats: %s", SESSIONS.stats())
+
+    if SESSIONS.backend:
+        SESSIONS.backend.start()
 
     try:
         # Запускаем cleanup task
         asyncio.create_task(cleanup_sessions_task())
 
+        await load_models()
+
         # Отключаем compression для минимального CPU overhead и latency
         async with websockets.serve(
             handler,
@@ -2610,25 +1457,95 @@ async def main():
             max_size=4 * 1024 * 1024,  # Уменьшаем лимит для защиты
             ping_interval=None,  # Отключаем ping - используем клиентский keep-alive
             ping_timeout=None,
+            reuse_port=reuse_port,  # воркеры супервизора слушают один PORT
         ):
-            print("[boot] WS сервер запущен, ждем сигнала завершения...")
+            STARTUP.set_ready("ws")
+            STARTUP.log_report(log_boot)
+            log_boot.info("WS сервер запущен, ждем сигнала завершения...")
             await stop_event.wait()
-            print("[SHUTDOWN] Начинаем graceful shutdown...")
+            log_shutdown.info("Начинаем graceful shutdown...")
     finally:
-        # Закрываем HTTP клиенты
+        # Досылаем события Voice Control и закрываем HTTP клиенты
+        await ADMISSION.close()
+        await VOICE_CONTROL_OUTBOX.close()
         await close_openai_http()
+        await close_llm_hedge_http()
         await close_tts_api_http()
         await close_tts_http()
 
+        if SESSIONS.backend:
+            await SESSIONS.backend.close()
+            log_shutdown.info("Сессии сброшены в SQLite")
+        if SESSIONS.snapshots:
+            await SESSIONS.flush_snapshots()
+            SESSIONS.snapshots.close()
+            log_shutdown.info("Снимки сессий сохранены")
+
         # Закрываем health сервер
         if health_srv:
             health_srv.close()
             await health_srv.wait_closed()
-            print("[SHUTDOWN] Health сервер закрыт")
+            log_shutdown.info("Health сервер закрыт")
+
+        log_shutdown.info("Graceful shutdown завершен")
+
+
+def worker_health_port(worker_id: int) -> int:
+    return HEALTH_PORT + 1 + worker_id
+
+
+_torch_threads: int | None = None
+
+
+def preload_models():
+    """
+    Прогрев моделей в супервизоре до fork (WORKER_PRELOAD=1).
+
+    Vosk и Silero загружаются и прогреваются параллельно (как load_models), Silero
+    переносится в shared memory. Потоки загрузки завершаются до первого fork. GC
+    выключен на время загрузки, а перед каждым fork всё живое замораживается
+    (gc.freeze): сборщик в воркере не обходит эти объекты и не пачкает их страницы.
+    Воркеры наследуют готовность asr/tts и повторно модели не грузят.
+    """
+    global _torch_threads
+    gc.disable()
+    t0 = time.monotonic()
+    with STARTUP.phase("load_models"), ThreadPoolExecutor(max_workers=2, thread_name_prefix="preload") as pool:
+        asr = pool.submit(load_asr_model)
+        tts = pool.submit(load_tts_models, True)
+        asr.result()
+        _torch_threads = tts.result()
+    log_boot.info("Модели прогреты до fork за %.1fs", time.monotonic() - t0)
+
+
+def freeze_before_fork():
+    gc.collect()
+    gc.freeze()
+    gc.enable()  # замороженное сборщик больше не обходит — ни в супервизоре, ни в воркерах
+
 
-        print("[SHUTDOWN] Graceful shutdown завершен")
+def run_worker(worker_id: int):
+    """Точка входа воркера после fork: свой loop, свой health-порт, общий PORT"""
+    global HEALTH_PORT
+    HEALTH_PORT = worker_health_port(worker_id)
+    if _torch_threads is not None:
+        tts_silero.after_fork(_torch_threads)
+    log_boot.info("Воркер %s: pid=%s", worker_id, os.getpid())
+    asyncio.run(main(reuse_port=True))
 
 
 if __name__ == "__main__":
+    if WORKERS > 1:
+        if WORKER_PRELOAD:
+            preload_models()
+        raise SystemExit(Supervisor(
+            WORKERS,
+            run_worker,
+            health_port=HEALTH_PORT,
+            worker_health_port=worker_health_port,
+            check_s=WORKER_CHECK_S,
+            shutdown_timeout_s=WORKER_SHUTDOWN_TIMEOUT_S,
+            before_fork=freeze_before_fork if WORKER_PRELOAD else None,
+        ).run())
     asyncio.run(main())
 
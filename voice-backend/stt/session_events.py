@@ -0,0 +1,57 @@
+"""
+Живой поток событий сессии для /v1/voice/sessions/{id}/events (SSE).
+
+handler публикует каждое JSON-сообщение, отправленное клиенту (partial, final,
+llm_*, tts_*, session_end ...); при закрытии последнего соединения без end_session —
+session_detached. Оба события завершают поток подписчика. Пока на сессию никто не подписан, publish — это
+один поиск в dict. У каждого подписчика ограниченная очередь: медленный
+дашборд теряет старые события, но не тормозит голосовой конвейер.
+"""
+import asyncio
+
+# после них событий сессии не будет (до переподключения) — SSE-поток закрывается
+TERMINAL_EVENTS = frozenset({"session_end", "session_detached"})
+
+
+class SessionEventBus:
+    def __init__(self, queue_max: int = 256):
+        self.queue_max = queue_max
+        self._subs: dict[str, set[asyncio.Queue]] = {}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        q: asyncio.Queue[tuple[str, str]] = asyncio.Queue(maxsize=self.queue_max)
+        self._subs.setdefault(session_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, session_id: str, q: asyncio.Queue):
+        subs = self._subs.get(session_id)
+        if subs is None:
+            return
+        subs.discard(q)
+        if not subs:
+            del self._subs[session_id]
+
+    def subscribers(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+    def publish(self, session_id: str, event_type: str, data: str):
+        """data — уже сериализованный JSON (тот же, что ушёл в WebSocket)"""
+        subs = self._subs.get(session_id)
+        if not subs:
+            return
+        self.published += 1
+        for q in subs:
+            if q.full():
+                # вытесняем самое старое событие
+                q.get_nowait()
+                self.dropped += 1
+            q.put_nowait((event_type, data))
+
+
+def sse_frame(event_type: str, data: str) -> bytes:
+    return f"event: {event_type}\ndata: {data}\n\n".encode("utf-8")
+
+
+EVENT_BUS = SessionEventBus()
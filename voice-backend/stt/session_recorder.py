@@ -0,0 +1,115 @@
+"""
+Запись входящего потока WebSocket-сессии для последующего воспроизведения.
+
+Включается SESSION_RECORD_DIR: handler пишет каждое входящее сообщение
+(PCM-фрейм или JSON) с временем от начала сессии в файл
+<dir>/<session_id>.vrec. Воспроизведение — test_ws.py --replay.
+
+Формат (little-endian):
+    b"VREC" u8 version  u32 len  header JSON (session_id, agent_id, started_at)
+    далее записи:       u8 kind  u32 t_us  u32 len  payload
+kind: 0 — бинарный PCM, 1 — текст (JSON как есть). t_us — микросекунды
+от открытия файла (хватает на ~71 минуту, дальше сессия не пишется).
+Запись — буферизованный write в том же потоке: один фрейм 20 мс = 649 байт.
+"""
+import json
+import os
+import re
+import struct
+import time
+from typing import Iterator, Union
+
+from voice_log import get_logger
+
+log = get_logger("RECORD")
+
+MAGIC = b"VREC"
+VERSION = 1
+KIND_BINARY = 0
+KIND_TEXT = 1
+
+_REC = struct.Struct("<BII")
+_HDR = struct.Struct("<4sBI")
+_MAX_T_US = 0xFFFFFFFF
+_SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+class SessionRecorder:
+    __slots__ = ("path", "_f", "_t0", "frames", "bytes")
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self._f = open(path, "wb", buffering=64 * 1024)
+        head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        self._f.write(_HDR.pack(MAGIC, VERSION, len(head)) + head)
+        self._t0 = time.perf_counter_ns()
+        self.frames = 0
+        self.bytes = 0
+
+    @classmethod
+    def open(cls, directory: str, session_id: str, agent_id: str) -> "SessionRecorder | None":
+        """Создаёт файл записи; при ошибке ФС сессия просто не пишется"""
+        name = _SAFE_NAME_RE.sub("_", session_id) or "session"
+        path = os.path.join(directory, f"{name}.vrec")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            rec = cls(path, {"session_id": session_id, "agent_id": agent_id, "started_at": time.time()})
+        except OSError as e:
+            log.warn("Не удалось открыть запись %s: %s", path, e)
+            return None
+        log.info("Запись сессии: %s", path, session=session_id)
+        return rec
+
+    def write(self, msg: Union[str, bytes]):
+        if self._f is None:
+            return
+        t_us = (time.perf_counter_ns() - self._t0) // 1000
+        if t_us > _MAX_T_US:
+            log.warn("Запись %s остановлена: превышена длительность", self.path)
+            self.close()
+            return
+        if isinstance(msg, str):
+            kind, payload = KIND_TEXT, msg.encode("utf-8")
+        else:
+            kind, payload = KIND_BINARY, msg
+        self._f.write(_REC.pack(kind, t_us, len(payload)))
+        self._f.write(payload)
+        self.frames += 1
+        self.bytes += len(payload)
+
+    def close(self):
+        if self._f is None:
+            return
+        try:
+            self._f.close()
+        except OSError as e:
+            log.warn("Ошибка закрытия записи %s: %s", self.path, e)
+        self._f = None
+
+
+def read_recording(path: str) -> tuple[dict, Iterator[tuple[float, Union[str, bytes]]]]:
+    """Возвращает (header, итератор (t_s, сообщение)); str — JSON, bytes — PCM"""
+    f = open(path, "rb")
+    raw = f.read(_HDR.size)
+    if len(raw) < _HDR.size:
+        f.close()
+        raise ValueError(f"{path}: слишком короткий файл")
+    magic, version, head_len = _HDR.unpack(raw)
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError(f"{path}: не запись сессии (magic={magic!r}, version={version})")
+    header = json.loads(f.read(head_len).decode("utf-8"))
+
+    def _records():
+        with f:
+            while True:
+                raw = f.read(_REC.size)
+                if len(raw) < _REC.size:
+                    return  # обрыв при аварийном завершении — отдаём то, что есть
+                kind, t_us, n = _REC.unpack(raw)
+                payload = f.read(n)
+                if len(payload) < n:
+                    return
+                yield t_us / 1e6, (payload.decode("utf-8") if kind == KIND_TEXT else payload)
+
+    return header, _records()
@@ -0,0 +1,516 @@
+"""
+Хранилище голосовых сессий.
+
+SessionStore заменяет голый dict SESSIONS: ограничивает число сессий (LRU среди
+отключённых), выселяет сессии по idle-TTL и TTL после end_session, режет историю
+до SESSION_MAX_TURNS и считает примерный объём памяти. Опциональный
+SQLiteSessionBackend (WAL) пишет сессии и реплики пачками в фоновом потоке,
+не блокируя event loop.
+
+SnapshotStore — общий для всех воркеров файл SQLite со снимками сессий
+(SessionState.to_snapshot): сессию, начатую в одном процессе, можно
+продолжить в другом, поиск по первичному ключу занимает доли миллисекунды.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from voice_log import get_logger
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    # orjson не установлен, используем stdlib
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _loads = json.loads
+
+SESSION_IDLE_TTL_MS = int(os.getenv("SESSION_IDLE_TTL_MS", str(30 * 60 * 1000)))   # отключённая сессия без активности
+SESSION_ENDED_TTL_MS = int(os.getenv("SESSION_ENDED_TTL_MS", str(10 * 60 * 1000)))  # после end_session (нужна HTTP API)
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "200"))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "")            # пусто = только память
+SESSION_DB_FLUSH_MS = int(os.getenv("SESSION_DB_FLUSH_MS", "500"))
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "")  # общий для воркеров файл снимков; пусто = выкл
+# отрицательный кэш aget(): опрос неизвестного id по HTTP не ходит в SQLite чаще раза в TTL
+SESSION_SNAPSHOT_MISS_TTL_MS = int(os.getenv("SESSION_SNAPSHOT_MISS_TTL_MS", "2000"))
+
+SNAPSHOT_VERSION = 1
+
+log = get_logger("SESSION")
+
+# Примерные накладные расходы на объекты (CPython, 64 бит) для учёта памяти
+_TURN_OVERHEAD = 120
+_SESSION_OVERHEAD = 600
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+@dataclass(slots=True)
+class Turn:
+    role: str            # "user" | "assistant"
+    text: str
+    ts: int = field(default_factory=now_ms)
+    utterance_id: int | None = None
+
+
+@dataclass(slots=True)
+class SessionState:
+    session_id: str
+    agent_id: str
+    turns: list[Turn] = field(default_factory=list)
+    llm_buffers: dict[int, str] = field(default_factory=dict)
+    summary: str = ""
+    ended: bool = False
+    ended_at_ms: int | None = None
+    last_active_ms: int = field(default_factory=now_ms)
+    attached: int = 0    # сколько WS-соединений сейчас держат сессию (такие не выселяем)
+    on_turn: Optional[Callable[["SessionState", Turn], None]] = None  # write-behind хук стора
+    snapshot_ms: int = 0  # updated_ms последнего сохранённого/загруженного снимка
+
+    def add_turn(self, role: str, text: str, utterance_id: int | None = None):
+        text = (text or "").strip()
+        if not text:
+            return
+        turn = Turn(role=role, text=text, utterance_id=utterance_id)
+        self.turns.append(turn)
+        excess = len(self.turns) - SESSION_MAX_TURNS
+        if excess > 0:
+            del self.turns[:excess]
+        self.last_active_ms = turn.ts
+        if self.on_turn is not None:
+            self.on_turn(self, turn)
+        log.debug("Added %s turn: '%s...'", role, text[:50], session=self.session_id)
+
+    def build_llm_messages(self, system_prompt: str, max_turns: int = 12):
+        history = self.turns[-max_turns:]
+        messages = [{"role": "system", "content": system_prompt}]
+        for t in history:
+            messages.append({"role": "user" if t.role == "user" else "assistant", "content": t.text})
+        return messages
+
+    def to_snapshot(self) -> bytes:
+        """Сериализует сессию: реплики, резюме, агент и незавершённые буферы LLM"""
+        return _dumps({
+            "v": SNAPSHOT_VERSION,
+            "session_id": self.session_id,
+            "agent_id": self.agent_id,
+            "summary": self.summary,
+            "ended": self.ended,
+            "ended_at_ms": self.ended_at_ms,
+            "last_active_ms": self.last_active_ms,
+            "turns": [[t.role, t.text, t.ts, t.utterance_id] for t in self.turns],
+            "llm_buffers": {str(k): v for k, v in self.llm_buffers.items()},
+        })
+
+    @classmethod
+    def from_snapshot(cls, data: bytes) -> "SessionState":
+        snap = _loads(data)
+        if snap.get("v") != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version: {snap.get('v')}")
+        return cls(
+            session_id=snap["session_id"],
+            agent_id=snap["agent_id"],
+            turns=[Turn(role=r, text=t, ts=ts, utterance_id=u) for r, t, ts, u in snap["turns"]],
+            llm_buffers={int(k): v for k, v in snap["llm_buffers"].items()},
+            summary=snap["summary"],
+            ended=snap["ended"],
+            ended_at_ms=snap["ended_at_ms"],
+            last_active_ms=snap["last_active_ms"],
+        )
+
+    def approx_bytes(self) -> int:
+        """Примерный объём памяти сессии (тексты реплик и буферы LLM)"""
+        total = _SESSION_OVERHEAD + sys.getsizeof(self.summary)
+        for t in self.turns:
+            total += _TURN_OVERHEAD + sys.getsizeof(t.text)
+        for buf in self.llm_buffers.values():
+            total += sys.getsizeof(buf)
+        return total
+
+
+class SQLiteSessionBackend:
+    """Write-behind персистентность в SQLite (WAL): операции копятся и пишутся пачкой в потоке"""
+
+    def __init__(self, path: str, flush_ms: int = SESSION_DB_FLUSH_MS, max_pending: int = 20000):
+        self.path = path
+        self.flush_ms = flush_ms
+        self.max_pending = max_pending
+        self._conn: sqlite3.Connection | None = None
+        self._turns: list[tuple] = []
+        self._sessions: dict[str, tuple] = {}   # последнее состояние сессии побеждает
+        self._task: asyncio.Task | None = None
+        self.written = 0
+        self.dropped = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, agent_id TEXT, summary TEXT,"
+                " ended INTEGER, ended_at_ms INTEGER, updated_ms INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, role TEXT,"
+                " text TEXT, ts INTEGER, utterance_id INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns(session_id, id)")
+            self._conn = conn
+        return self._conn
+
+    def record_turn(self, session: SessionState, turn: Turn):
+        if len(self._turns) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._turns.append((session.session_id, turn.role, turn.text, turn.ts, turn.utterance_id))
+
+    def record_session(self, session: SessionState):
+        self._sessions[session.session_id] = (
+            session.session_id, session.agent_id, session.summary,
+            int(session.ended), session.ended_at_ms, now_ms(),
+        )
+
+    def _write(self, sessions: list[tuple], turns: list[tuple]):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            if sessions:
+                conn.executemany(
+                    "INSERT INTO sessions (session_id, agent_id, summary, ended, ended_at_ms, updated_ms)"
+                    " VALUES (?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET agent_id=excluded.agent_id,"
+                    " summary=excluded.summary, ended=excluded.ended,"
+                    " ended_at_ms=excluded.ended_at_ms, updated_ms=excluded.updated_ms",
+                    sessions,
+                )
+            if turns:
+                conn.executemany(
+                    "INSERT INTO turns (session_id, role, text, ts, utterance_id) VALUES (?, ?, ?, ?, ?)",
+                    turns,
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def flush(self):
+        if not self._sessions and not self._turns:
+            return
+        sessions = list(self._sessions.values())
+        turns = self._turns
+        self._sessions = {}
+        self._turns = []
+        try:
+            await asyncio.to_thread(self._write, sessions, turns)
+            self.written += len(sessions) + len(turns)
+        except Exception as e:
+            self.dropped += len(sessions) + len(turns)
+            log.error("SQLite: ошибка записи пачки: %s", e)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_ms / 1000.0)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+
+class SnapshotStore:
+    """Снимки сессий в общем SQLite-файле (WAL): читают и пишут все воркеры"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()   # одно соединение на процесс: event loop + to_thread
+        self.loads = 0
+        self.saves = 0
+        self.errors = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                " session_id TEXT PRIMARY KEY, data BLOB, updated_ms INTEGER)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def load(self, session_id: str, newer_than_ms: int = 0) -> SessionState | None:
+        """Синхронное чтение снимка (поиск по PK); None, если снимка нет или он не новее newer_than_ms"""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT data, updated_ms FROM snapshots WHERE session_id = ? AND updated_ms > ?",
+                    (session_id, newer_than_ms),
+                ).fetchone()
+            if row is None:
+                return None
+            session = SessionState.from_snapshot(row[0])
+        except Exception as e:
+            self.errors += 1
+            log.error("Снимок: ошибка чтения %s: %s", session_id, e)
+            return None
+        session.snapshot_ms = row[1]
+        self.loads += 1
+        return session
+
+    def _save(self, session_id: str, data: bytes, updated_ms: int):
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO snapshots (session_id, data, updated_ms) VALUES (?, ?, ?)"
+                " ON CONFLICT(session_id) DO UPDATE SET data=excluded.data, updated_ms=excluded.updated_ms"
+                " WHERE excluded.updated_ms >= snapshots.updated_ms",
+                (session_id, data, updated_ms),
+            )
+
+    async def save(self, session: SessionState):
+        """Сериализует в event loop (согласованный срез), пишет в потоке"""
+        updated_ms = max(now_ms(), session.snapshot_ms + 1)
+        data = session.to_snapshot()
+        try:
+            await asyncio.to_thread(self._save, session.session_id, data, updated_ms)
+        except Exception as e:
+            self.errors += 1
+            log.error("Снимок: ошибка записи %s: %s", session.session_id, e)
+            return
+        session.snapshot_ms = updated_ms
+        self.saves += 1
+
+    def purge(self, items: list[tuple[str, int]]):
+        """Удаляет снимки выселенных сессий, если другой воркер не записал более свежий"""
+        with self._lock:
+            self._connect().executemany(
+                "DELETE FROM snapshots WHERE session_id = ? AND updated_ms <= ?", items,
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SessionStore:
+    """Ограниченный реестр сессий с idle-TTL и опциональной write-behind персистентностью"""
+
+    def __init__(self, *, max_sessions: int = SESSION_MAX, idle_ttl_ms: int = SESSION_IDLE_TTL_MS,
+                 ended_ttl_ms: int = SESSION_ENDED_TTL_MS, backend: SQLiteSessionBackend | None = None,
+                 snapshots: SnapshotStore | None = None):
+        self.max_sessions = max_sessions
+        self.idle_ttl_ms = idle_ttl_ms
+        self.ended_ttl_ms = ended_ttl_ms
+        self.backend = backend
+        self.snapshots = snapshots
+        self._sessions: OrderedDict[str, SessionState] = OrderedDict()   # порядок = LRU
+        self._snapshot_tasks: set[asyncio.Task] = set()
+        self._snapshot_misses: dict[str, int] = {}   # session_id → до какого now_ms() снимка нет
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def get(self, session_id: str) -> SessionState | None:
+        session = self._sessions.get(session_id)
+        if session is None and self.snapshots is not None:
+            session = self.snapshots.load(session_id)
+            if session is not None:
+                self.put(session)
+        return session
+
+    async def aget(self, session_id: str) -> SessionState | None:
+        """get() для event loop: снимок читается в потоке, промахи кэшируются на SNAPSHOT_MISS_TTL"""
+        session = self._sessions.get(session_id)
+        if session is not None or self.snapshots is None:
+            return session
+        now = now_ms()
+        if self._snapshot_misses.get(session_id, 0) > now:
+            return None
+        loaded = await asyncio.to_thread(self.snapshots.load, session_id)
+        session = self._sessions.get(session_id)   # пока читали, сессию могли создать здесь
+        if session is not None:
+            return session
+        if loaded is None:
+            if len(self._snapshot_misses) >= self.max_sessions:
+                self._snapshot_misses = {k: v for k, v in self._snapshot_misses.items() if v > now}
+            self._snapshot_misses[session_id] = now + SESSION_SNAPSHOT_MISS_TTL_MS
+            return None
+        self.put(loaded)
+        return loaded
+
+    async def aresume(self, session_id: str) -> SessionState | None:
+        """resume() для event loop: сверка со снимком — в потоке, без отрицательного кэша"""
+        session = self._sessions.get(session_id)
+        if session is not None and (session.attached or self.snapshots is None):
+            return session
+        if self.snapshots is None:
+            return session
+        newer = await asyncio.to_thread(
+            self.snapshots.load, session_id, session.snapshot_ms if session else 0)
+        current = self._sessions.get(session_id)
+        if newer is not None and not (current is not None and current.attached):
+            self.put(newer)
+            return newer
+        return current
+
+    def resume(self, session_id: str) -> SessionState | None:
+        """
+        Сессия для нового WS-соединения. Если локальная копия не подключена,
+        сверяемся со снимком: после переподключения к другому воркеру он мог уйти вперёд.
+        """
+        session = self._sessions.get(session_id)
+        if session is not None and (session.attached or self.snapshots is None):
+            return session
+        if self.snapshots is not None:
+            newer = self.snapshots.load(session_id, newer_than_ms=session.snapshot_ms if session else 0)
+            if newer is not None:
+                self.put(newer)
+                return newer
+        return session
+
+    def items(self):
+        return self._sessions.items()
+
+    def put(self, session: SessionState):
+        self._snapshot_misses.pop(session.session_id, None)
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        if self.backend is not None:
+            session.on_turn = self.backend.record_turn
+            self.backend.record_session(session)
+        self._enforce_limit(keep=session.session_id)
+
+    def pop(self, session_id: str) -> SessionState | None:
+        return self._sessions.pop(session_id, None)
+
+    def attach(self, session: SessionState):
+        """WS-соединение начало работать с сессией"""
+        session.attached += 1
+        session.last_active_ms = now_ms()
+        # сессию могли выселить между put() и attach(): подключённая всегда в реестре
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+
+    def detach(self, session_id: str):
+        """WS-соединение закрылось: с этого момента идёт idle-TTL"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        session.attached = max(0, session.attached - 1)
+        session.last_active_ms = now_ms()
+        if self.backend is not None:
+            self.backend.record_session(session)
+        self._save_snapshot(session)
+
+    def _save_snapshot(self, session: SessionState):
+        """Фоновая запись снимка, чтобы переподключение к любому воркеру нашло свежее состояние"""
+        if self.snapshots is None:
+            return
+        task = asyncio.create_task(self.snapshots.save(session))
+        self._snapshot_tasks.add(task)
+        task.add_done_callback(self._snapshot_tasks.discard)
+
+    async def flush_snapshots(self):
+        """Дожидается незаписанных снимков и сохраняет все сессии (graceful shutdown)"""
+        if self.snapshots is None:
+            return
+        if self._snapshot_tasks:
+            await asyncio.gather(*self._snapshot_tasks, return_exceptions=True)
+        for session in list(self._sessions.values()):
+            await self.snapshots.save(session)
+
+    def mark_ended(self, session_id: str, summary: str | None = None) -> SessionState | None:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if summary is not None:
+            session.summary = summary
+        session.ended = True
+        session.ended_at_ms = now_ms()
+        if self.backend is not None:
+            self.backend.record_session(session)
+        self._save_snapshot(session)
+        return session
+
+    def _enforce_limit(self, keep: str | None = None):
+        """Сверх лимита выселяем самые давние отключённые сессии, кроме только что добавленной keep"""
+        excess = len(self._sessions) - self.max_sessions
+        if excess <= 0:
+            return
+        idle = [sid for sid, s in self._sessions.items() if not s.attached and sid != keep]
+        for sid in idle[:excess]:
+            self._sessions.pop(sid, None)
+            self.evicted += 1
+
+    def evict_expired(self, now: int | None = None) -> list[str]:
+        """Выселяет завершённые сессии старше ended_ttl и отключённые без активности дольше idle_ttl"""
+        if now is None:
+            now = now_ms()
+        dead = []
+        for sid, s in self._sessions.items():
+            if s.attached:
+                continue
+            if s.ended and s.ended_at_ms and (now - s.ended_at_ms) > self.ended_ttl_ms:
+                dead.append(sid)
+            elif (now - s.last_active_ms) > self.idle_ttl_ms:
+                dead.append(sid)
+        purge = []
+        for sid in dead:
+            s = self._sessions.pop(sid, None)
+            if s is not None and s.snapshot_ms:
+                purge.append((sid, s.snapshot_ms))
+        self.evicted += len(dead)
+        if purge and self.snapshots is not None:
+            task = asyncio.create_task(asyncio.to_thread(self.snapshots.purge, purge))
+            self._snapshot_tasks.add(task)
+            task.add_done_callback(self._snapshot_tasks.discard)
+        return dead
+
+    def stats(self) -> dict:
+        attached = sum(1 for s in self._sessions.values() if s.attached)
+        return {
+            "sessions": len(self._sessions),
+            "attached": attached,
+            "turns": sum(len(s.turns) for s in self._sessions.values()),
+            "approx_bytes": sum(s.approx_bytes() for s in self._sessions.values()),
+            "evicted": self.evicted,
+            "db_written": self.backend.written if self.backend else 0,
+            "db_dropped": self.backend.dropped if self.backend else 0,
+            "snapshot_loads": self.snapshots.loads if self.snapshots else 0,
+            "snapshot_saves": self.snapshots.saves if self.snapshots else 0,
+        }
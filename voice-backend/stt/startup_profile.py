@@ -0,0 +1,133 @@
+"""
+Профиль холодного старта и готовность сервера.
+
+STARTUP.phase(name) замеряет фазу старта (импорт, загрузка и прогрев модели);
+фазы из разных потоков пишутся с номером потока, так что параллельная загрузка
+Vosk и Silero видна как перекрывающиеся интервалы. Отсчёт — от запуска процесса
+(/proc/self/stat), поэтому в профиль попадает и время интерпретатора до первого
+import. Подробная разбивка по модулям — `python -X importtime server_fixed.py`.
+
+lazy_import(name) — модуль-заместитель: настоящий import выполняется при первом
+обращении к атрибуту и попадает в профиль фазой "import <name>".
+
+Готовность: require() перечисляет компоненты (asr, tts, ws), set_ready() отмечает
+прогретые; /ready отдаёт 200 только когда готовы все, /health — живость процесса.
+"""
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _process_start_monotonic() -> float:
+    """Момент запуска процесса в шкале time.monotonic() (Linux), иначе — сейчас"""
+    try:
+        with open("/proc/self/stat", "rb") as f:
+            stat = f.read().rsplit(b")", 1)[1].split()
+        started_s = int(stat[19]) / os.sysconf("SC_CLK_TCK")   # поле 22: starttime от загрузки системы
+        age_s = time.clock_gettime(time.CLOCK_BOOTTIME) - started_s
+        return time.monotonic() - max(0.0, age_s)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic()
+
+
+class StartupProfile:
+    def __init__(self):
+        self.t0 = _process_start_monotonic()
+        self.phases: list[dict] = []
+        self.components: dict[str, bool] = {}
+        self.ready_ms: float | None = None
+        self._lock = threading.Lock()
+
+    def _ms(self, t: float) -> float:
+        return round((t - self.t0) * 1000.0, 1)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            end = time.monotonic()
+            rec = {
+                "name": name,
+                "start_ms": self._ms(start),
+                "duration_ms": round((end - start) * 1000.0, 1),
+                "thread": threading.current_thread().name,
+            }
+            if error:
+                rec["error"] = error
+            with self._lock:
+                self.phases.append(rec)
+
+    # --- готовность -------------------------------------------------------------
+
+    def require(self, *components: str):
+        for name in components:
+            self.components.setdefault(name, False)
+
+    def set_ready(self, component: str):
+        with self._lock:
+            self.components[component] = True
+            if self.ready_ms is None and all(self.components.values()):
+                self.ready_ms = self._ms(time.monotonic())
+
+    def is_ready(self, component: str | None = None) -> bool:
+        if component is not None:
+            return self.components.get(component, False)
+        return bool(self.components) and all(self.components.values())
+
+    def readiness(self) -> dict:
+        return {
+            "ready": self.is_ready(),
+            "components": dict(self.components),
+            "ready_ms": self.ready_ms,
+            "uptime_s": round(time.monotonic() - self.t0, 1),
+        }
+
+    def report(self) -> dict:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p["start_ms"])
+        return {**self.readiness(), "phases": phases}
+
+    def log_report(self, logger):
+        report = self.report()
+        for p in report["phases"]:
+            logger.info("startup %-24s +%8.1f мс  %8.1f мс  [%s]%s", p["name"], p["start_ms"], p["duration_ms"],
+                        p["thread"], " " + p["error"] if "error" in p else "")
+        logger.info("startup: готов через %s мс от запуска процесса", report["ready_ms"])
+
+
+STARTUP = StartupProfile()
+
+
+class _LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    with STARTUP.phase(f"import {self._name}"):
+                        self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "deferred"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str):
+    """Отложенный import: модуль загружается при первом обращении к атрибуту"""
+    return _LazyModule(name)
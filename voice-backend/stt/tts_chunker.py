@@ -0,0 +1,314 @@
+"""
+Адаптивная нарезка ответа LLM на чанки для TTS.
+
+TTSLatencyModel держит EMA скорости синтеза (мс на символ + фиксированный
+overhead) и длительности проигрывания (мс аудио на символ), измеренные на
+текущей машине. AdaptiveChunker по этой модели:
+  - отдаёт первую короткую клаузу как можно раньше (минимум времени до первого звука);
+  - размер следующих чанков подбирает так, чтобы синтез чанка N+1 закончился
+    до того, как клиент доиграет уже отправленное аудио.
+TokenAssembler инкрементально собирает токены LLM в текст для чанкера.
+"""
+import os
+import re
+import struct
+import time
+
+TTS_FIRST_MIN_CHARS = int(os.getenv("TTS_FIRST_MIN_CHARS", "12"))    # первая клауза не короче
+TTS_FIRST_MAX_CHARS = int(os.getenv("TTS_FIRST_MAX_CHARS", "40"))    # и не длиннее
+TTS_CHUNK_MIN_CHARS = int(os.getenv("TTS_CHUNK_MIN_CHARS", "20"))
+TTS_CHUNK_MAX_CHARS = int(os.getenv("TTS_CHUNK_MAX_CHARS", "240"))
+TTS_READY_SAFETY = float(os.getenv("TTS_READY_SAFETY", "0.7"))      # доля запаса проигрывания под синтез
+
+SENTENCE_ENDS = frozenset(".!?\n")
+CLAUSE_ENDS = frozenset(",;:—–")
+
+
+def wav_duration_ms(wav: bytes) -> float:
+    """Длительность PCM WAV по заголовку (0.0, если это не WAV)"""
+    if len(wav) < 12 or wav[:4] != b"RIFF" or wav[8:12] != b"WAVE":
+        return 0.0
+    pos = 12
+    byte_rate = 0
+    data_len = 0
+    while pos + 8 <= len(wav):
+        chunk_id = wav[pos:pos + 4]
+        size = struct.unpack_from("<I", wav, pos + 4)[0]
+        if chunk_id == b"fmt " and pos + 20 <= len(wav):
+            byte_rate = struct.unpack_from("<I", wav, pos + 16)[0]
+        elif chunk_id == b"data":
+            data_len = min(size, len(wav) - pos - 8)
+            break
+        pos += 8 + size + (size & 1)
+    return data_len * 1000.0 / byte_rate if byte_rate else 0.0
+
+
+class TTSLatencyModel:
+    """EMA скорости синтеза и проигрывания на символ"""
+
+    __slots__ = ("synth_ms_per_char", "synth_overhead_ms", "play_ms_per_char", "alpha", "samples")
+
+    def __init__(self, synth_ms_per_char: float = 8.0, synth_overhead_ms: float = 60.0,
+                 play_ms_per_char: float = 65.0, alpha: float = 0.2):
+        self.synth_ms_per_char = synth_ms_per_char
+        self.synth_overhead_ms = synth_overhead_ms
+        self.play_ms_per_char = play_ms_per_char
+        self.alpha = alpha
+        self.samples = 0
+
+    def observe(self, chars: int, synth_ms: float, audio_ms: float):
+        """Учитывает один реальный синтез: chars символов за synth_ms, audio_ms аудио"""
+        if chars <= 0:
+            return
+        a = self.alpha
+        per_char = max(0.0, synth_ms - self.synth_overhead_ms) / chars
+        self.synth_ms_per_char += a * (per_char - self.synth_ms_per_char)
+        if audio_ms > 0:
+            self.play_ms_per_char += a * (audio_ms / chars - self.play_ms_per_char)
+        self.samples += 1
+
+    def synth_ms(self, chars: int) -> float:
+        return self.synth_overhead_ms + self.synth_ms_per_char * chars
+
+    def play_ms(self, chars: int) -> float:
+        return self.play_ms_per_char * chars
+
+    def max_chars_within(self, budget_ms: float) -> int:
+        """Сколько символов успеет синтезироваться за budget_ms"""
+        if self.synth_ms_per_char <= 0:
+            return 1 << 30
+        return int((budget_ms - self.synth_overhead_ms) / self.synth_ms_per_char)
+
+
+# Модель общая для процесса: скорость Silero зависит от машины и нагрузки, а не от сессии
+TTS_LATENCY = TTSLatencyModel()
+
+
+def _is_end_at(text: str, i: int, final: bool) -> bool:
+    """Разделитель в позиции i завершает фразу: за ним пробел (или конец буфера при final).
+    Без final точка в конце буфера может оказаться '3.' из '3.5'."""
+    j = i + 1
+    return text[j].isspace() if j < len(text) else final
+
+
+def _last_end(text: str, ends: frozenset, lo: int, hi: int, final: bool) -> int:
+    """Позиция после последнего разделителя в text[lo:hi] (-1, если нет)"""
+    lo = max(lo, 0)
+    hi = min(hi, len(text))
+    best = -1
+    for ch in ends:
+        i = text.rfind(ch, lo, hi)
+        while i > best:
+            if _is_end_at(text, i, final):
+                best = i
+                break
+            i = text.rfind(ch, lo, i)
+    return best + 1 if best != -1 else -1
+
+
+def _first_end(text: str, ends: frozenset, lo: int, hi: int, final: bool) -> int:
+    """Позиция после первого разделителя в text[lo:hi] (-1, если нет)"""
+    lo = max(lo, 0)
+    best = hi = min(hi, len(text))
+    for ch in ends:
+        i = text.find(ch, lo, best)
+        while i != -1:
+            if _is_end_at(text, i, final):
+                best = i
+                break
+            i = text.find(ch, i + 1, best)
+    return best + 1 if best != hi else -1
+
+
+def _word_cut(text: str, limit: int) -> int:
+    """Разрез по последнему пробелу до limit, иначе по первому после: слова не рвём (-1 — ждём пробела)"""
+    space = text.rfind(" ", 1, limit + 1)
+    if space == -1:
+        space = text.find(" ", limit)
+    return space
+
+
+class AdaptiveChunker:
+    """
+    Нарезка буфера на чанки по модели латентности.
+
+    split(buf) -> (готовые_чанки, остаток).
+    После отправки аудио чанка нужно вызвать on_audio_sent(), после пропуска — on_chunk_dropped().
+    """
+
+    __slots__ = ("model", "first_min", "first_max", "min_chars", "max_chars", "safety",
+                 "_first", "_play_end", "_backlog_chars", "_target")
+
+    def __init__(self, model: TTSLatencyModel = TTS_LATENCY, *,
+                 first_min: int = TTS_FIRST_MIN_CHARS, first_max: int = TTS_FIRST_MAX_CHARS,
+                 min_chars: int = TTS_CHUNK_MIN_CHARS, max_chars: int = TTS_CHUNK_MAX_CHARS,
+                 safety: float = TTS_READY_SAFETY):
+        self.model = model
+        self.first_min = first_min
+        self.first_max = first_max
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.safety = safety
+        self.reset()
+
+    def reset(self):
+        """Новый ответ: снова ждём короткую первую клаузу"""
+        self._first = True
+        self._play_end = 0.0       # monotonic-время, когда клиент доиграет отправленное аудио
+        self._backlog_chars = 0    # нарезано, но ещё не отправлено
+        self._target = self.first_max  # target_chars() на момент последнего split/отправки
+
+    def target_chars(self, now: float | None = None) -> int:
+        """Максимальный размер следующего чанка, который успеет синтезироваться к концу проигрывания"""
+        if self._first:
+            return self.first_max
+        if now is None:
+            now = time.monotonic()
+        m = self.model
+        ahead_ms = max(0.0, self._play_end - now) * 1000.0
+        if self._backlog_chars:
+            # следующий чанк синтезируется после backlog'а и понадобится после его проигрывания
+            ahead_ms += m.play_ms(self._backlog_chars) - m.synth_ms(self._backlog_chars)
+        n = m.max_chars_within(ahead_ms * self.safety)
+        return max(self.min_chars, min(self.max_chars, n))
+
+    def worth_splitting(self, buf_len: int) -> bool:
+        """Буфер дорос до целевого размера чанка (дешёвая проверка на каждом токене).
+        Цель берётся из кеша: пересчитывается в split() и после отправки аудио."""
+        return buf_len >= self._target
+
+    def _cut_first(self, text: str, final: bool) -> int:
+        cut = _first_end(text, SENTENCE_ENDS | CLAUSE_ENDS, self.first_min - 1, self.first_max, final)
+        if cut != -1:
+            return cut
+        if len(text) >= self.first_max:
+            return _word_cut(text, self.first_max)
+        return -1
+
+    def _cut_next(self, text: str, target: int, final: bool) -> int:
+        lo = self.min_chars - 1
+        cut = _last_end(text, SENTENCE_ENDS, lo, target, final)
+        if cut != -1:
+            return cut
+        if len(text) < target:
+            return -1
+        cut = _last_end(text, CLAUSE_ENDS, lo, target, final)
+        if cut != -1:
+            return cut
+        return _word_cut(text, target)
+
+    def split(self, buf: str, final: bool = False) -> tuple[list[str], str]:
+        out: list[str] = []
+        now = time.monotonic()
+        while True:
+            text = buf.lstrip()
+            if not text:
+                self._target = self.target_chars(now)
+                return out, ""
+            if self._first:
+                cut = self._cut_first(text, final)
+            else:
+                cut = self._cut_next(text, self.target_chars(now), final)
+            if cut <= 0:
+                if final:
+                    out.append(text.strip())
+                    self._first = False
+                    self._backlog_chars += len(text)
+                    text = ""
+                self._target = self.target_chars(now)
+                return out, text
+            chunk = text[:cut].strip()
+            buf = text[cut:]
+            if chunk:
+                out.append(chunk)
+                self._first = False
+                self._backlog_chars += len(chunk)
+
+    def on_audio_sent(self, chars: int, synth_ms: float, wav: bytes):
+        """Чанк синтезирован за synth_ms и отправлен клиенту"""
+        self.on_audio_queued(chars, synth_ms, wav_duration_ms(wav))
+
+    def on_audio_queued(self, chars: int, synth_ms: float, audio_ms: float):
+        """То же, что on_audio_sent, но с уже известной длительностью аудио"""
+        if synth_ms >= 1.0:  # попадания в кеш не учитываем
+            self.model.observe(chars, synth_ms, audio_ms)
+        self._backlog_chars = max(0, self._backlog_chars - chars)
+        now = time.monotonic()
+        self._play_end = max(now, self._play_end) + audio_ms / 1000.0
+        self._target = self.target_chars(now)
+
+    def on_chunk_dropped(self, chars: int):
+        self._backlog_chars = max(0, self._backlog_chars - chars)
+        self._target = self.target_chars()
+
+
+_WS_SPLIT = re.compile(r"(\s+)")
+
+
+class TokenAssembler:
+    """
+    Инкрементальная сборка токенов LLM в текст для TTS.
+
+    Слово отдаётся только целиком (после пробела или flush()), подряд идущие
+    одинаковые слова выкидываются вместе с пробелом после них, исходные пробелы
+    и переводы строк сохраняются. feed() работает за O(len(token)) и помечает
+    границу предложения/клаузы, чтобы чанкер не сканировал буфер на каждом токене.
+    """
+
+    __slots__ = ("_word", "_last_word", "_dropped", "_started", "boundary")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._word = ""          # незавершённое слово (ждём пробел)
+        self._last_word = ""     # последнее отданное слово
+        self._dropped = False    # последнее слово выкинуто как дубль — глотаем пробел после него
+        self._started = False    # уже что-то отдали (ведущие пробелы не нужны)
+        self.boundary = False    # с прошлого take_boundary() отдана граница предложения/клаузы
+
+    def _commit_word(self, out: list[str]):
+        word = self._word
+        self._word = ""
+        if word == self._last_word:
+            self._dropped = True
+            return
+        out.append(word)
+        self._last_word = word
+        self._dropped = False
+        self._started = True
+
+    def feed(self, tok: str) -> str:
+        """Принимает токен, возвращает новый готовый текст (может быть пустым)"""
+        if " " not in tok and "\n" not in tok and "\t" not in tok and "\r" not in tok:
+            # быстрый путь: токен-продолжение слова
+            self._word += tok
+            return ""
+        out: list[str] = []
+        for i, piece in enumerate(_WS_SPLIT.split(tok)):
+            if not piece:
+                continue
+            if i & 1:  # нечётные куски re.split с группой — пробельные
+                if self._word:
+                    self._commit_word(out)
+                if not self._started or (self._dropped and "\n" not in piece):
+                    continue
+                last = self._last_word[-1]
+                if last in SENTENCE_ENDS or last in CLAUSE_ENDS or "\n" in piece:
+                    self.boundary = True
+                out.append(piece)
+            else:
+                self._word += piece
+        return "".join(out)
+
+    def flush(self) -> str:
+        """Конец ответа: отдаёт хвостовое слово"""
+        out: list[str] = []
+        if self._word:
+            self._commit_word(out)
+        return "".join(out)
+
+    def take_boundary(self) -> bool:
+        b = self.boundary
+        self.boundary = False
+        return b
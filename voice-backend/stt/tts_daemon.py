@@ -0,0 +1,127 @@
+"""
+Резидентный демон Silero на Unix-сокете для generate_tts_cli.py.
+
+server.js запускает generate_tts_cli.py на каждый запрос TTS; без демона каждый
+вызов заново импортирует torch и грузит модель через torch.hub — секунды холодного
+старта. Демон держит модели TTS_DAEMON_MODELS прогретыми, а CLI становится тонким
+клиентом: request_wav() не импортирует torch и возвращает None, если демон не
+запущен, — тогда CLI синтезирует сам.
+
+Протокол — одно соединение на запрос:
+    клиент → {"text", "model", "voice", "speed", "emotion"} + "\\n"
+    демон  → {"ok": true, "size": N} + "\\n" + N байт WAV
+           | {"ok": false, "error": "..."} + "\\n"
+
+    python3 generate_tts_cli.py --daemon
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+
+from startup_profile import lazy_import
+
+# torch и модели нужны только демону — клиент их не загружает
+tts_silero = lazy_import("tts_silero")
+
+TTS_DAEMON_SOCKET = os.getenv("TTS_DAEMON_SOCKET", "/tmp/voice_tts_daemon.sock")
+TTS_DAEMON_MODELS = [m.strip() for m in os.getenv("TTS_DAEMON_MODELS", "silero_ru").split(",") if m.strip()]
+TTS_DAEMON_CONCURRENCY = int(os.getenv("TTS_DAEMON_CONCURRENCY", "2"))
+TTS_DAEMON_TIMEOUT = float(os.getenv("TTS_DAEMON_TIMEOUT", "60"))
+
+_MAX_REQUEST = 1 << 20
+
+
+class DaemonError(RuntimeError):
+    """Демон ответил ошибкой синтеза (повтор в процессе дал бы то же самое)"""
+
+
+# ---------------------------------------------------------------------------
+# Клиент
+# ---------------------------------------------------------------------------
+
+def request_wav(text: str, model: str, voice: str, speed: float, emotion: str,
+                path: str = TTS_DAEMON_SOCKET, timeout: float = TTS_DAEMON_TIMEOUT) -> bytes | None:
+    """WAV от демона; None — демон недоступен (нет сокета, не отвечает, оборвал ответ)"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            request = {"text": text, "model": model, "voice": voice, "speed": speed, "emotion": emotion}
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                header = json.loads(f.readline(_MAX_REQUEST) or b"null")
+                if not isinstance(header, dict):
+                    return None
+                if not header.get("ok"):
+                    raise DaemonError(header.get("error") or "unknown error")
+                wav = f.read(header["size"])
+            return wav if len(wav) == header["size"] else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Демон
+# ---------------------------------------------------------------------------
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, sem: asyncio.Semaphore):
+    try:
+        line = await reader.readline()
+        try:
+            req = json.loads(line)
+            args = (req["text"], req.get("model", "silero_ru"), req.get("voice", "eugene"),
+                    float(req.get("speed", 1.0)), req.get("emotion", "neutral"))
+        except (ValueError, KeyError, TypeError) as e:
+            writer.write(json.dumps({"ok": False, "error": f"bad request: {e}"}).encode() + b"\n")
+            return
+        try:
+            async with sem:
+                wav, _ = await asyncio.to_thread(tts_silero.generate_audio_sync, *args)
+        except Exception as e:
+            writer.write(json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False).encode("utf-8") + b"\n")
+            return
+        writer.write(json.dumps({"ok": True, "size": len(wav)}).encode() + b"\n")
+        writer.write(wav)
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass   # клиент ушёл или прислал строку длиннее лимита
+    finally:
+        writer.close()
+
+
+def _socket_in_use(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+async def serve(path: str = TTS_DAEMON_SOCKET):
+    if os.path.exists(path):
+        if _socket_in_use(path):
+            raise SystemExit(f"TTS daemon already running on {path}")
+        os.unlink(path)   # сокет от упавшего демона
+
+    # модели грузятся до открытия сокета: пока демона нет, клиенты синтезируют сами
+    await asyncio.to_thread(tts_silero.warm, TTS_DAEMON_MODELS)
+
+    sem = asyncio.Semaphore(TTS_DAEMON_CONCURRENCY)
+    server = await asyncio.start_unix_server(lambda r, w: _handle(r, w, sem), path=path, limit=_MAX_REQUEST)
+    os.chmod(path, 0o660)
+    print(f"TTS daemon: {', '.join(TTS_DAEMON_MODELS)} ready on {path}", flush=True)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if os.path.exists(path):
+            os.unlink(path)
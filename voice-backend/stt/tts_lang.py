@@ -0,0 +1,225 @@
+"""
+Маршрутизация TTS-чанков по языку: кириллица → silero_ru, латиница → silero_en.
+
+Вместо langdetect на каждый чанк (медленно, на коротких строках недетерминированно и
+один язык на весь чанк) — разбиение по письменности: буквы кириллицы дают отрезок ru,
+латиницы — en; цифры, пробелы и пунктуация приклеиваются к предыдущему отрезку (в
+начале чанка — к следующему). «Купите iPhone 15 Pro сегодня» → ru «Купите », en
+«iPhone 15 Pro », ru «сегодня». Латиница-двойник внутри русского слова («Привeт» с
+латинской e) и наоборот исправляется заменой буквы, а не отдельным отрезком. Части
+слова через апостроф или дефис разбираются отдельно: «iPhone'а» → en «iPhone'», ru «а».
+
+Язык «липкий» в пределах реплики: первый чанк с буквами задаёт язык utterance, и
+отрезки без букв (числа, знаки) в следующих чанках идут им же. langdetect — только
+для неоднозначного: слово, в котором письменности смешаны поровну. Разбиение и
+ответы langdetect кэшируются.
+
+TTS_LANG_SPLIT=0 — один язык на чанк (по большинству букв), без разбиения.
+"""
+import os
+import re
+import struct
+import unicodedata
+from functools import lru_cache
+
+from startup_profile import lazy_import
+
+langdetect = lazy_import("langdetect")
+
+TTS_LANG_SPLIT = os.getenv("TTS_LANG_SPLIT", "1") == "1"
+
+AMBIGUOUS = "?"
+
+# визуально одинаковые буквы: латиница → кириллица
+_LAT_TO_CYR = str.maketrans("aeopcxyAEOPCXHKMBT", "аеорсхуАЕОРСХНКМВТ")
+_CYR_TO_LAT = str.maketrans("аеорсхуАЕОРСХНКМВТ", "aeopcxyAEOPCXHKMBT")
+_HOMOGLYPHS_LAT = frozenset("aeopcxyAEOPCXHKMBT")
+_HOMOGLYPHS_CYR = frozenset("аеорсхуАЕОРСХНКМВТ")
+_WORD_JOINER = re.compile(r"(['’-])")
+
+
+@lru_cache(maxsize=1024)
+def _char_script(ch: str) -> str | None:
+    """'ru' — кириллица, 'en' — латиница, None — не буква (цифры, знаки, прочие письменности)"""
+    if not ch.isalpha():
+        return None
+    if ch.isascii():
+        return "en"
+    if "Ѐ" <= ch <= "ӿ":
+        return "ru"
+    name = unicodedata.name(ch, "")
+    if name.startswith("LATIN"):
+        return "en"
+    if name.startswith("CYRILLIC"):
+        return "ru"
+    return None
+
+
+def _word_runs(word: str) -> list[tuple[str, str]]:
+    """
+    Слово → отрезки по письменности. Части через апостроф/дефис — отдельно: окончание
+    другой письменности («iPhone'а») — свой отрезок, а не двойник
+    """
+    if len(word) > 1 and _WORD_JOINER.search(word):
+        runs: list[tuple[str, str]] = []
+        for part in _WORD_JOINER.split(word):
+            if part:
+                runs.extend(_part_runs(part))   # апостроф/дефис — (None, ...), segment приклеит
+        return runs
+    return _part_runs(word)
+
+
+def _part_runs(word: str) -> list[tuple[str, str]]:
+    """Часть слова → отрезки; двойники меньшинства заменяются буквами большинства"""
+    scripts = [_char_script(ch) for ch in word]
+    ru = scripts.count("ru")
+    en = scripts.count("en")
+    if not ru and not en:
+        return [(None, word)]    # другие письменности — как знаки
+    if not ru or not en:
+        return [("ru" if ru else "en", word)]
+    if ru > en and all(ch in _HOMOGLYPHS_LAT for ch, s in zip(word, scripts) if s == "en"):
+        return [("ru", word.translate(_LAT_TO_CYR))]
+    if en > ru and all(ch in _HOMOGLYPHS_CYR for ch, s in zip(word, scripts) if s == "ru"):
+        return [("en", word.translate(_CYR_TO_LAT))]
+    if ru == en:
+        return [(AMBIGUOUS, word)]
+    # настоящая смесь («MacBookом»): режем на границах письменности
+    runs: list[tuple[str, str]] = []
+    for ch, s in zip(word, scripts):
+        s = s or (runs[-1][0] if runs else None)
+        if runs and (s is None or s == runs[-1][0]):
+            runs[-1] = (runs[-1][0], runs[-1][1] + ch)
+        else:
+            runs.append((s, ch))
+    return runs
+
+
+@lru_cache(maxsize=4096)
+def segment(text: str) -> tuple[tuple[str | None, str], ...]:
+    """
+    Чанк → отрезки (язык, текст), склейка отрезков равна исходному тексту (с точностью
+    до исправленных двойников). Язык: 'ru', 'en', AMBIGUOUS; None — в чанке нет букв.
+    """
+    runs: list[list] = []
+    pending = ""      # не-буквы до первого отрезка
+    word = ""
+
+    def push(lang, part):
+        nonlocal pending
+        if lang is None:
+            if runs:
+                runs[-1][1] += part
+            else:
+                pending += part
+            return
+        if runs and runs[-1][0] == lang:
+            runs[-1][1] += part
+        else:
+            runs.append([lang, pending + part])
+            pending = ""
+
+    for ch in text:
+        if ch.isalpha():
+            word += ch
+            continue
+        if word and ch in "'’-":
+            word += ch    # апостроф и дефис внутри слова: «iPhone'а», «Wi-Fi»
+            continue
+        if word:
+            for lang, part in _word_runs(word):
+                push(lang, part)
+            word = ""
+        push(None, ch)
+    if word:
+        for lang, part in _word_runs(word):
+            push(lang, part)
+    if not runs:
+        return ((None, text),)
+    if pending:
+        runs[0][1] = pending + runs[0][1]
+    return tuple((lang, part) for lang, part in runs)
+
+
+@lru_cache(maxsize=1024)
+def detect(text: str, default: str) -> str:
+    """langdetect для неоднозначного: 'en' или 'ru' (Silero знает только эти два)"""
+    try:
+        return "en" if langdetect.detect(text).startswith("en") else "ru"
+    except Exception:
+        return default
+
+
+def _letters(text: str) -> int:
+    return sum(1 for ch in text if ch.isalpha())
+
+
+class LangRouter:
+    """Язык отрезков чанков одной сессии; липкий язык сбрасывается на новой реплике"""
+
+    __slots__ = ("utterance_id", "sticky")
+
+    def __init__(self):
+        self.utterance_id: int | None = None
+        self.sticky: str | None = None
+
+    def route(self, text: str, utterance_id: int | None = None, default: str = "ru") -> list[tuple[str, str]]:
+        if utterance_id is None or utterance_id != self.utterance_id:
+            self.utterance_id = utterance_id
+            self.sticky = None
+
+        resolved: list[tuple[str, str]] = []
+        for lang, part in segment(text):
+            if lang is None:
+                lang = self.sticky or default
+            elif lang == AMBIGUOUS:
+                lang = self.sticky or detect(text, default)
+            if resolved and resolved[-1][0] == lang:
+                resolved[-1] = (lang, resolved[-1][1] + part)
+            else:
+                resolved.append((lang, part))
+
+        letters = {"ru": 0, "en": 0}
+        for lang, part in resolved:
+            letters[lang] += _letters(part)
+        dominant = "en" if letters["en"] > letters["ru"] else "ru"
+        if self.sticky is None and utterance_id is not None and any(letters.values()):
+            self.sticky = dominant
+
+        if not TTS_LANG_SPLIT and len(resolved) > 1:
+            return [(dominant, "".join(part for _, part in resolved))]
+        return resolved
+
+
+# ---------------------------------------------------------------------------
+# Склейка WAV отрезков
+# ---------------------------------------------------------------------------
+
+def _wav_fmt_data(wav: bytes) -> tuple[bytes, bytes]:
+    """(тело fmt-чанка, PCM из data-чанка) RIFF/WAVE"""
+    if len(wav) < 12 or wav[:4] != b"RIFF" or wav[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE")
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(wav):
+        chunk_id = wav[pos:pos + 4]
+        size = struct.unpack_from("<I", wav, pos + 4)[0]
+        if chunk_id == b"fmt ":
+            fmt = wav[pos + 8:pos + 8 + size]
+        elif chunk_id == b"data":
+            if fmt is None:
+                break
+            return fmt, wav[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+    raise ValueError("WAV without fmt/data chunk")
+
+
+def concat_wav(wavs: list[bytes]) -> bytes:
+    """Один WAV из нескольких с одинаковым форматом (silero_ru и silero_en — 48 kHz PCM16 mono)"""
+    parts = [_wav_fmt_data(w) for w in wavs]
+    fmt = parts[0][0]
+    if any(f != fmt for f, _ in parts):
+        raise ValueError("WAV formats differ")
+    data = b"".join(d for _, d in parts)
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", len(data)) + data
+    return b"RIFF" + struct.pack("<I", len(body)) + body
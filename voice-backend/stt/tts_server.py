@@ -1,54 +1,230 @@
+"""
+HTTP-сервис синтеза речи (Silero) отдельно от голосового рантайма.
+
+    POST /tts, /tts_wav   один WAV на текст; /tts_wav — маршрут, который зовут
+                          удалённый TTS и HTTP fallback в server_fixed.TTSBackend
+    POST /tts_stream      PCM16 mono кусками по предложениям (chunked): первый звук
+                          приходит после синтеза первого предложения; частота — в
+                          заголовке X-Sample-Rate
+    POST /tts_batch       {"texts": [...]} или {"items": [{"text": ...}, ...]} и общие
+                          параметры → {"results": [{"wav_b64", "sample_rate"} | {"error"}]}
+    GET  /health, /ready  живость и готовность (модели TTS_PRELOAD_MODELS прогреты)
+
+Параметры запроса: text, model, voice, speed, emotion, pause_between_sentences (или pause).
+
+TTS_WORKERS>1 — как server_fixed: модели грузятся и прогреваются в родителе, затем
+worker_supervisor делает fork воркеров на общий TTS_PORT (SO_REUSEPORT). У воркера i
+свой health-порт TTS_HEALTH_PORT+1+i, сводные /health и /ready — на TTS_HEALTH_PORT.
+"""
 import asyncio
+import base64
 import json
 import logging
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import Response
+import os
+import socket
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uvicorn
 import tts_silero
-import os
+from worker_supervisor import Supervisor
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("tts_server")
 
+TTS_HOST = os.getenv("TTS_HOST", "0.0.0.0")
+# 8002 занят MCP-сервером (mcp-server/index.js), поэтому по умолчанию 8003
+TTS_PORT = int(os.getenv("TTS_PORT", "8003"))
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "1"))
+TTS_HEALTH_PORT = int(os.getenv("TTS_HEALTH_PORT", str(TTS_PORT + 100)))
+TTS_PRELOAD_MODELS = [m.strip() for m in os.getenv("TTS_PRELOAD_MODELS", "silero_ru,silero_en").split(",") if m.strip()]
+TTS_BATCH_MAX = int(os.getenv("TTS_BATCH_MAX", "64"))
+
 app = FastAPI()
 
+_ready = False              # модели прогреты (при TTS_WORKERS>1 — ещё в родителе до fork)
+_torch_threads: int | None = None
+
+
+def _error(status: int, message: str) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status)
+
+
+def _params(data: dict, defaults: dict | None = None) -> dict:
+    """Параметры синтеза из тела запроса (defaults — общие поля пакета)"""
+    if not isinstance(data, dict):
+        raise ValueError("JSON object expected")
+    data = {**(defaults or {}), **data}
+    text = (data.get("text") or "").strip()
+    if not text:
+        raise ValueError("text is required")
+    model = data.get("model", "silero_ru")
+    if model not in tts_silero.MODEL_CONFIGS:
+        raise ValueError(f"unknown model: {model}")
+    return {
+        "text": text,
+        "model_name": model,
+        "voice": data.get("voice", tts_silero.MODEL_CONFIGS[model]["default_voice"]),
+        "speed": float(data.get("speed", 1.0)),
+        "emotion": data.get("emotion", "neutral"),
+        "pause_between_sentences": float(data.get("pause_between_sentences", data.get("pause", 0.3))),
+    }
+
+
+async def _read_params(request: Request) -> dict:
+    try:
+        return _params(await request.json())
+    except json.JSONDecodeError:
+        raise ValueError("invalid JSON body")
+
+
 @app.post("/tts")
+@app.post("/tts_wav")
 async def tts_endpoint(request: Request):
     try:
-        data = await request.json()
-        text = data.get("text", "")
-        model = data.get("model", "silero_ru")
-        voice = data.get("voice", "eugene")
-        speed = float(data.get("speed", 1.0))
-        emotion = data.get("emotion", "neutral")
-
-        if not text:
-            return {"error": "text is required"}, 400
-
-        logger.info(f"Generating TTS for: {text[:50]}...")
-        
-        # Синтезируем WAV
-        wav_bytes = await tts_silero.synthesize_wav(
-            text=text,
-            model_name=model,
-            voice=voice,
-            speed=speed,
-            emotion=emotion
-        )
+        params = await _read_params(request)
+    except ValueError as e:
+        return _error(400, str(e))
 
+    try:
+        logger.info(f"Generating TTS for: {params['text'][:50]}...")
+        wav_bytes, _ = await asyncio.to_thread(tts_silero.generate_audio_sync, **params)
         return Response(content=wav_bytes, media_type="audio/wav")
-
     except Exception as e:
         logger.error(f"TTS Error: {e}")
-        return {"error": str(e)}, 500
+        return _error(500, str(e))
+
+
+@app.post("/tts_stream")
+async def tts_stream(request: Request):
+    try:
+        params = await _read_params(request)
+    except ValueError as e:
+        return _error(400, str(e))
+
+    rate = tts_silero.MODEL_CONFIGS[params["model_name"]]["sample_rate"]
+    chunks = tts_silero.generate_pcm_stream(**params)
+
+    async def body():
+        # генератор синтезирует следующее предложение только по запросу — в потоке,
+        # чтобы loop успевал отдавать уже готовые куски
+        try:
+            while True:
+                pcm = await asyncio.to_thread(next, chunks, None)
+                if pcm is None:
+                    return
+                yield pcm
+        except Exception as e:
+            logger.error(f"TTS stream error: {e}")   # заголовки уже ушли: поток просто обрывается
+
+    logger.info(f"Streaming TTS for: {params['text'][:50]}...")
+    return StreamingResponse(
+        body(),
+        media_type=f"audio/L16; rate={rate}; channels=1",
+        headers={"X-Sample-Rate": str(rate)},
+    )
+
+
+def _synthesize_batch(items: list, defaults: dict) -> list[dict]:
+    """Тексты пакета подряд в одном потоке: torch и так параллелит один синтез по ядрам"""
+    results = []
+    for item in items:
+        try:
+            params = _params(item if isinstance(item, dict) else {"text": item}, defaults)
+            wav_bytes, sample_rate = tts_silero.generate_audio_sync(**params)
+            results.append({"wav_b64": base64.b64encode(wav_bytes).decode("ascii"), "sample_rate": sample_rate})
+        except Exception as e:
+            results.append({"error": str(e)})
+    return results
+
+
+@app.post("/tts_batch")
+async def tts_batch(request: Request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return _error(400, "invalid JSON body")
+    if not isinstance(data, dict):
+        return _error(400, "JSON object expected")
+    items = data.get("items") or data.get("texts") or []
+    if not isinstance(items, list) or not items:
+        return _error(400, "texts or items is required")
+    if len(items) > TTS_BATCH_MAX:
+        return _error(413, f"batch too large: {len(items)} > {TTS_BATCH_MAX}")
+
+    defaults = {k: v for k, v in data.items() if k not in ("items", "texts", "text")}
+    logger.info(f"Batch TTS: {len(items)} texts")
+    return {"results": await asyncio.to_thread(_synthesize_batch, items, defaults)}
+
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+
+@app.get("/ready")
+async def ready():
+    body = {"ready": _ready, "models": TTS_PRELOAD_MODELS}
+    return JSONResponse(body, status_code=200 if _ready else 503)
+
+
+@app.on_event("startup")
+async def _warm_models():
+    """Один воркер: прогрев в фоне — /health отвечает сразу, /ready после прогрева"""
+    if not _ready:
+        asyncio.create_task(_warm())
+
+
+async def _warm():
+    global _ready
+    try:
+        await asyncio.to_thread(tts_silero.warm, TTS_PRELOAD_MODELS)
+    except Exception as e:
+        logger.error(f"Прогрев моделей не удался: {e}")
+        return
+    _ready = True
+    logger.info(f"Модели прогреты: {', '.join(TTS_PRELOAD_MODELS)}")
+
+
+# ---------------------------------------------------------------------------
+# Несколько воркеров
+# ---------------------------------------------------------------------------
+
+def worker_health_port(worker_id: int) -> int:
+    return TTS_HEALTH_PORT + 1 + worker_id
+
+
+def _listen(port: int, reuse_port: bool = False) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((TTS_HOST, port))
+    sock.listen(2048)
+    return sock
+
+
+def run_worker(worker_id: int):
+    """Воркер после fork: один uvicorn на общем TTS_PORT и своём health-порту"""
+    if _torch_threads is not None:
+        tts_silero.after_fork(_torch_threads)
+    sockets = [_listen(TTS_PORT, reuse_port=True), _listen(worker_health_port(worker_id))]
+    logger.info(f"Воркер {worker_id}: pid={os.getpid()}, health-порт {worker_health_port(worker_id)}")
+    asyncio.run(uvicorn.Server(uvicorn.Config(app, log_level="info")).serve(sockets=sockets))
+
+
 if __name__ == "__main__":
-    port = int(os.getenv("TTS_PORT", 8002))
-    # Используем порт 8002, так как он уже прописан в server.js (хотя там был конфликт с MCP)
-    # На самом деле лучше использовать другой свободный порт, например 8003
-    uvicorn.run(app, host="0.0.0.0", port=8003)
+    if TTS_WORKERS > 1:
+        try:
+            _torch_threads = tts_silero.preload(TTS_PRELOAD_MODELS)
+            _ready = True
+        except Exception as e:
+            logger.error(f"Модели не загружены до fork ({e}) — воркеры прогреют их сами")
+        raise SystemExit(Supervisor(
+            TTS_WORKERS,
+            run_worker,
+            health_port=TTS_HEALTH_PORT,
+            worker_health_port=worker_health_port,
+        ).run())
+    uvicorn.run(app, host=TTS_HOST, port=TTS_PORT)
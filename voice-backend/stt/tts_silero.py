@@ -4,7 +4,7 @@ import logging
 import os
 import re
 import threading
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import soundfile as sf
@@ -73,6 +73,51 @@ def load_model(model_name: str):
             logger.error(f"Ошибка загрузки модели {model_name}: {e}")
             raise
 
+def _share_memory(model):
+    """Переносит тензоры модели в shared memory: у воркеров после fork это общие, а не CoW-страницы"""
+    for obj in (model, getattr(model, "model", None)):
+        share = getattr(obj, "share_memory", None)
+        if callable(share):
+            try:
+                share()
+            except Exception as e:
+                logger.warning(f"share_memory() не удался: {e}")
+            return
+
+
+def preload(model_names: List[str]) -> int:
+    """
+    Загрузка и прогрев моделей в родительском процессе до fork воркеров.
+
+    Прогрев идёт в один поток: пул OpenMP, созданный до fork, в дочерних
+    процессах не работает. Возвращает прежнее число потоков torch —
+    воркер восстанавливает его через after_fork().
+    """
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    warm(model_names)
+    for name in model_names:
+        _share_memory(model_cache[name])
+        logger.info(f"Модель {name} загружена и прогрета до fork")
+    return threads
+
+
+# Фраза прогрева на языке модели: кириллица для v3_en не даёт входа для синтеза
+WARMUP_TEXTS = {"ru": "Привет.", "en": "Hello."}
+
+
+def warm(model_names: List[str]):
+    """Загрузка моделей и пробный синтез — первый запрос не платит за ленивую инициализацию"""
+    for name in model_names:
+        load_model(name)
+        config = MODEL_CONFIGS[name]
+        generate_audio_sync(WARMUP_TEXTS.get(config["language"], "Hello."), name, config["default_voice"])
+
+
+def after_fork(threads: int):
+    torch.set_num_threads(threads)
+
+
 def split_text_by_sentences(text: str, pause_duration: float) -> List[Dict[str, Any]]:
     """Разбиение текста на предложения с паузами"""
     sentences = re.split(r'(?<=[.!?])\s+', text.strip())
@@ -85,42 +130,44 @@ def split_text_by_sentences(text: str, pause_duration: float) -> List[Dict[str,
             })
     return result
 
-def generate_audio_sync(text: str, model_name: str, voice: str, speed: float = 1.0,
-                       emotion: str = "neutral", pause_between_sentences: float = 0.3) -> Tuple[bytes, int]:
-    """Синхронная генерация аудио (WAV bytes)"""
-    try:
-        model_config = MODEL_CONFIGS.get(model_name, MODEL_CONFIGS["silero_ru"])
-        model = load_model(model_name)
+def iter_sentence_audio(text: str, model_name: str, voice: str, emotion: str = "neutral",
+                        pause_between_sentences: float = 0.3) -> Iterator[np.ndarray]:
+    """Аудио (float32) по предложениям; пауза после предложения — в том же куске"""
+    model_config = MODEL_CONFIGS.get(model_name, MODEL_CONFIGS["silero_ru"])
+    model = load_model(model_name)
 
-        emotion_config = EMOTION_PRESETS.get(emotion, EMOTION_PRESETS["neutral"])
-        effective_speed = speed * emotion_config["speed"]
-        effective_pause = pause_between_sentences if pause_between_sentences is not None else emotion_config["pause"]
+    emotion_config = EMOTION_PRESETS.get(emotion, EMOTION_PRESETS["neutral"])
+    effective_pause = pause_between_sentences if pause_between_sentences is not None else emotion_config["pause"]
+    sample_rate = model_config["sample_rate"]
 
-        sentences = split_text_by_sentences(text, effective_pause)
-        audio_parts = []
-        sample_rate = model_config["sample_rate"]
+    for sentence_info in split_text_by_sentences(text, effective_pause):
+        sentence_text = sentence_info["text"]
+        if not sentence_text.strip():
+            continue
 
         with torch.inference_mode():
-            for sentence_info in sentences:
-                sentence_text = sentence_info["text"]
-                if not sentence_text.strip():
-                    continue
+            sentence_audio = model.apply_tts(
+                text=sentence_text,
+                speaker=voice if voice != "random" else model_config["default_voice"],
+                sample_rate=sample_rate
+            )
 
-                sentence_audio = model.apply_tts(
-                    text=sentence_text,
-                    speaker=voice if voice != "random" else model_config["default_voice"],
-                    sample_rate=sample_rate
-                )
+        if isinstance(sentence_audio, torch.Tensor):
+            sentence_audio = sentence_audio.cpu().numpy()
 
-                if isinstance(sentence_audio, torch.Tensor):
-                    sentence_audio = sentence_audio.cpu().numpy()
+        if sentence_info["pause_after"] > 0:
+            pause_samples = int(sample_rate * sentence_info["pause_after"])
+            sentence_audio = np.concatenate([sentence_audio, np.zeros(pause_samples, dtype=np.float32)])
 
-                audio_parts.append(sentence_audio)
+        yield sentence_audio
 
-                if sentence_info["pause_after"] > 0:
-                    pause_samples = int(sample_rate * sentence_info["pause_after"])
-                    pause_audio = np.zeros(pause_samples, dtype=np.float32)
-                    audio_parts.append(pause_audio)
+
+def generate_audio_sync(text: str, model_name: str, voice: str, speed: float = 1.0,
+                       emotion: str = "neutral", pause_between_sentences: float = 0.3) -> Tuple[bytes, int]:
+    """Синхронная генерация аудио (WAV bytes)"""
+    try:
+        sample_rate = MODEL_CONFIGS.get(model_name, MODEL_CONFIGS["silero_ru"])["sample_rate"]
+        audio_parts = list(iter_sentence_audio(text, model_name, voice, emotion, pause_between_sentences))
 
         if audio_parts:
             combined_audio = np.concatenate(audio_parts)
@@ -138,6 +185,16 @@ def generate_audio_sync(text: str, model_name: str, voice: str, speed: float = 1
         logger.error(f"Ошибка генерации аудио: {e}")
         raise
 
+
+def generate_pcm_stream(text: str, model_name: str, voice: str, speed: float = 1.0,
+                        emotion: str = "neutral", pause_between_sentences: float = 0.3) -> Iterator[bytes]:
+    """
+    PCM16 mono little-endian по предложениям — для потоковой отдачи: первый кусок
+    готов после синтеза первого предложения. Частота — MODEL_CONFIGS[model]["sample_rate"].
+    """
+    for audio in iter_sentence_audio(text, model_name, voice, emotion, pause_between_sentences):
+        yield (np.clip(audio, -1.0, 1.0) * 32767.0).astype("<i2").tobytes()
+
 async def synthesize_wav(text: str, model_name: str, voice: str, speed: float = 1.0,
                         emotion: str = "neutral", pause: float = 0.3) -> bytes:
     """Асинхронная обертка для генерации WAV"""
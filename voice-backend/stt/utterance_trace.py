@@ -0,0 +1,160 @@
+"""
+Трассировка задержек по репликам: от последнего голосового фрейма до первого аудио.
+
+Каждая реплика пользователя получает UtteranceTrace; handler отмечает события
+(mark — мгновенные, span — интервалы) с монотонными метками perf_counter_ns.
+Завершённые трассы хранятся в кольце TRACE_KEEP и отдаются:
+  - в формате Chrome trace-event (chrome://tracing, Perfetto) — chrome_trace();
+  - агрегатами по стадиям (p50/p90/p99) — stage_percentiles().
+"""
+import os
+import time
+from collections import deque
+
+from metrics import percentile
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))
+
+# Дорожки (tid) в Chrome trace
+LANES = {"asr": 1, "llm": 2, "tts": 3, "ws": 4}
+
+# Стадии для перцентилей: (имя, событие-начало, событие-конец)
+STAGES = (
+    ("endpoint", "last_voiced_frame", "final_text"),
+    ("final_to_llm_start", "final_text", "llm_start"),
+    ("llm_ttft", "llm_start", "llm_first_token"),
+    ("first_token_to_audio", "llm_first_token", "first_audio"),
+    ("llm_start_to_audio", "llm_start", "first_audio"),
+    ("user_stop_to_audio", "last_voiced_frame", "first_audio"),
+)
+
+
+def _now_ns() -> int:
+    return time.perf_counter_ns()
+
+
+class UtteranceTrace:
+    """Таймлайн одной реплики: события (name, lane, ts_ns, dur_ns | None, args)"""
+
+    __slots__ = ("session_id", "utterance_ids", "events", "first", "last_voice_ns", "_tracer")
+
+    def __init__(self, tracer: "Tracer", session_id: str):
+        self._tracer = tracer
+        self.session_id = session_id
+        self.utterance_ids: list[int] = []
+        self.events: list[tuple] = []
+        self.first: dict[str, int] = {}   # имя события → ts первого вхождения
+        self.last_voice_ns = 0            # обновляется на каждом голосовом фрейме, событием становится при final
+
+    def mark(self, name: str, lane: str = "asr", ts_ns: int | None = None, **args):
+        ts = ts_ns if ts_ns is not None else _now_ns()
+        self.events.append((name, lane, ts, None, args))
+        self.first.setdefault(name, ts)
+
+    def span_start(self) -> int:
+        return _now_ns()
+
+    def span_end(self, name: str, start_ns: int, lane: str = "tts", **args):
+        end = _now_ns()
+        self.events.append((name, lane, start_ns, end - start_ns, args))
+        self.first.setdefault(name, start_ns)
+
+    def bind(self, utterance_id: int):
+        """Привязывает utterance_id (при рестарте LLM у реплики их несколько)"""
+        self.utterance_ids.append(utterance_id)
+
+    def finish(self):
+        self._tracer.finish(self)
+
+    def stage_ms(self) -> dict[str, float]:
+        out = {}
+        for stage, a, b in STAGES:
+            if a in self.first and b in self.first and self.first[b] >= self.first[a]:
+                out[stage] = (self.first[b] - self.first[a]) / 1e6
+        return out
+
+
+class _NullTrace:
+    """Трасса-заглушка при TRACE_ENABLED=0: все вызовы — no-op"""
+
+    __slots__ = ("last_voice_ns",)
+    utterance_ids = ()
+
+    def __init__(self):
+        self.last_voice_ns = 0
+
+    def mark(self, *a, **k):
+        pass
+
+    def span_start(self) -> int:
+        return 0
+
+    def span_end(self, *a, **k):
+        pass
+
+    def bind(self, *a):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Tracer:
+    def __init__(self, keep: int = TRACE_KEEP, enabled: bool = TRACE_ENABLED):
+        self.enabled = enabled
+        self.done: deque[UtteranceTrace] = deque(maxlen=keep)
+
+    def begin(self, session_id: str):
+        return UtteranceTrace(self, session_id) if self.enabled else _NullTrace()
+
+    def finish(self, trace: UtteranceTrace):
+        # реплики без запуска LLM (пустой final, эхо) не интересны
+        if "llm_start" in trace.first:
+            self.done.append(trace)
+
+    def traces(self, session_id: str | None = None, limit: int | None = None) -> list[UtteranceTrace]:
+        items = [t for t in self.done if session_id is None or t.session_id == session_id]
+        return items[-limit:] if limit else items
+
+    def chrome_trace(self, session_id: str | None = None, limit: int | None = None) -> dict:
+        """Chrome trace-event JSON: процесс = реплика, потоки = asr/llm/tts/ws"""
+        events = []
+        for pid, trace in enumerate(self.traces(session_id, limit), start=1):
+            u = ",".join(str(x) for x in trace.utterance_ids)
+            events.append({"name": "process_name", "ph": "M", "pid": pid,
+                           "args": {"name": f"{trace.session_id} u{u}"}})
+            for lane, tid in LANES.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": lane}})
+            for name, lane, ts, dur, args in trace.events:
+                ev = {"name": name, "pid": pid, "tid": LANES.get(lane, 0), "ts": ts / 1000.0, "args": args}
+                if dur is None:
+                    ev["ph"] = "i"
+                    ev["s"] = "t"
+                else:
+                    ev["ph"] = "X"
+                    ev["dur"] = dur / 1000.0
+                events.append(ev)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def stage_percentiles(self, session_id: str | None = None) -> dict[str, dict]:
+        samples: dict[str, list[float]] = {}
+        for trace in self.traces(session_id):
+            for stage, ms in trace.stage_ms().items():
+                samples.setdefault(stage, []).append(ms)
+        out = {}
+        for stage, _, _ in STAGES:
+            values = sorted(samples.get(stage, ()))
+            if not values:
+                continue
+            out[stage] = {
+                "n": len(values),
+                "p50": percentile(values, 50, 2),
+                "p90": percentile(values, 90, 2),
+                "p99": percentile(values, 99, 2),
+                "max": round(values[-1], 2),
+            }
+        return out
+
+
+TRACER = Tracer()
@@ -0,0 +1,171 @@
+"""
+Лёгкий структурированный логгер для realtime-пути.
+
+    log = get_logger("TTS")
+    log.info("Чанк отправлен: '%s' (%d bytes)", chunk[:30], len(wav), u=current_u)
+    log.trace("Получен токен: %r", tok)   # на каждый фрейм/токен — с сэмплированием
+
+Строка форматируется (msg % args) только если запись проходит по уровню, поэтому
+выключенный debug/trace стоит одного сравнения. trace пишется каждое
+LOG_TRACE_SAMPLE-е событие подсистемы. Записи от LOG_RING_LEVEL и выше
+дополнительно складываются в кольцевой буфер (LOG_RING_SIZE) для отладочного
+снимка через /debug/log. По умолчанию буфер выключен: в warn-записях бывают тексты
+реплик пользователя — включать только для отладки.
+
+Конфиг:
+    LOG_LEVEL=info                 trace|debug|info|warn|error
+    LOG_LEVELS=TTS=debug,VAD=trace переопределения по подсистемам
+    LOG_FORMAT=text                text|json
+    LOG_TRACE_SAMPLE=50
+    LOG_RING_SIZE=0                0 — буфер выключен (для отладки: 2000)
+    LOG_RING_LEVEL=info
+"""
+import os
+import sys
+import time
+import traceback
+from collections import deque
+
+try:
+    import orjson
+
+    def _json_line(obj) -> str:
+        return orjson.dumps(obj, default=str).decode("utf-8")
+except ImportError:
+    import json
+
+    def _json_line(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, default=str)
+
+TRACE, DEBUG, INFO, WARN, ERROR = 5, 10, 20, 30, 40
+LEVELS = {"trace": TRACE, "debug": DEBUG, "info": INFO, "warn": WARN, "warning": WARN, "error": ERROR}
+LEVEL_NAMES = {TRACE: "trace", DEBUG: "debug", INFO: "info", WARN: "warn", ERROR: "error"}
+_OFF = 100
+
+
+def _parse_level(name: str, default: int = INFO) -> int:
+    return LEVELS.get((name or "").strip().lower(), default)
+
+
+LOG_LEVEL = _parse_level(os.getenv("LOG_LEVEL", "info"))
+LOG_LEVELS = {
+    k.strip().upper(): _parse_level(v)
+    for k, _, v in (item.partition("=") for item in os.getenv("LOG_LEVELS", "").split(",") if "=" in item)
+}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_TRACE_SAMPLE = max(1, int(os.getenv("LOG_TRACE_SAMPLE", "50")))
+LOG_RING_SIZE = int(os.getenv("LOG_RING_SIZE", "0"))
+LOG_RING_LEVEL = _parse_level(os.getenv("LOG_RING_LEVEL", "info"))
+
+# (ts, subsystem, level, msg, args, fields); форматируется при чтении
+_RING: deque | None = deque(maxlen=LOG_RING_SIZE) if LOG_RING_SIZE > 0 else None
+
+
+def _render(msg: str, args: tuple) -> str:
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return f"{msg} {args!r}"
+
+
+class Logger:
+    """Логгер подсистемы; уровни проверяются до форматирования"""
+
+    __slots__ = ("name", "level", "_min", "_trace_n")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._trace_n = 0
+        self.set_level(LOG_LEVELS.get(name, LOG_LEVEL))
+
+    def set_level(self, level: int):
+        self.level = level
+        ring = LOG_RING_LEVEL if _RING is not None else _OFF
+        self._min = min(level, ring)
+
+    def enabled(self, level: int) -> bool:
+        """Для дорогих аргументов: if log.enabled(DEBUG): log.debug(..., expensive())"""
+        return level >= self._min
+
+    def _emit(self, level: int, msg: str, args: tuple, fields: dict):
+        now = time.time()
+        if _RING is not None and level >= LOG_RING_LEVEL:
+            _RING.append((now, self.name, level, msg, args, fields))
+        if level < self.level:
+            return
+        text = _render(msg, args)
+        if LOG_FORMAT == "json":
+            rec = {"ts": round(now, 3), "sub": self.name, "lvl": LEVEL_NAMES.get(level, level), "msg": text}
+            if fields:
+                rec.update(fields)
+            line = _json_line(rec)
+        elif fields:
+            line = f"[{self.name}] {text} " + " ".join(f"{k}={v}" for k, v in fields.items())
+        else:
+            line = f"[{self.name}] {text}"
+        try:
+            sys.stdout.write(line + "\n")
+        except (OSError, ValueError):
+            pass  # stdout закрыт при shutdown
+
+    def trace(self, msg: str, *args, **fields):
+        if TRACE < self._min:
+            return
+        self._trace_n += 1
+        if self._trace_n % LOG_TRACE_SAMPLE:
+            return
+        self._emit(TRACE, msg, args, fields)
+
+    def debug(self, msg: str, *args, **fields):
+        if DEBUG >= self._min:
+            self._emit(DEBUG, msg, args, fields)
+
+    def info(self, msg: str, *args, **fields):
+        if INFO >= self._min:
+            self._emit(INFO, msg, args, fields)
+
+    def warn(self, msg: str, *args, **fields):
+        if WARN >= self._min:
+            self._emit(WARN, msg, args, fields)
+
+    def error(self, msg: str, *args, **fields):
+        if ERROR >= self._min:
+            self._emit(ERROR, msg, args, fields)
+
+    def exception(self, msg: str, *args, **fields):
+        """error + traceback текущего исключения"""
+        if ERROR >= self._min:
+            self._emit(ERROR, msg + "\n%s", args + (traceback.format_exc().rstrip(),), fields)
+
+
+_LOGGERS: dict[str, Logger] = {}
+
+
+def get_logger(name: str) -> Logger:
+    log = _LOGGERS.get(name)
+    if log is None:
+        log = _LOGGERS[name] = Logger(name)
+    return log
+
+
+def set_level(name: str, level: str | int):
+    """Меняет уровень подсистемы на лету (например, из отладочного HTTP-запроса)"""
+    get_logger(name).set_level(level if isinstance(level, int) else _parse_level(level))
+
+
+def ring_records(limit: int | None = None) -> list[dict]:
+    """Последние записи кольцевого буфера (старые первыми)"""
+    if _RING is None:
+        return []
+    items = list(_RING)
+    if limit:
+        items = items[-limit:]
+    out = []
+    for ts, name, level, msg, args, fields in items:
+        rec = {"ts": round(ts, 3), "sub": name, "lvl": LEVEL_NAMES.get(level, level), "msg": _render(msg, args)}
+        if fields:
+            rec.update(fields)
+        out.append(rec)
+    return out
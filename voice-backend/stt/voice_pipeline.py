@@ -1,22 +1,53 @@
+"""
+Голосовой конвейер одной сессии без привязки к транспорту.
+
+VoicePipeline — единственный движок разговора: VAD, распознавание, endpointing
+FSM (listening → tentative → confirmed → final), запуск/рестарт LLM, ACK,
+очередь LLM→TTS с guard'ами по utterance/epoch и barge-in. server_fixed.py
+делает только WebSocket-обвязку (auth, Origin, запись, допуск) и передаёт
+колбэки отправки; тот же объект можно гонять в процессе без сокета.
+
+Состояние — атрибуты со __slots__: сессий много, а доступ к ним — в горячем
+цикле по каждому 20-мс фрейму.
+"""
 import asyncio
 import json
-import logging
 import os
 import re
 import struct
 import time
-import uuid
-from dataclasses import dataclass, field
 from enum import Enum
-from typing import Any, Dict, List, Optional, Callable, Tuple, Union
+from typing import Any, AsyncIterator, Awaitable, Callable
 
 import httpx
-from langdetect import detect
 
-import tts_silero
+from admission import ADMISSION
+from g711 import ENCODING_PCM16, G711_SAMPLE_RATE, G711Decoder, normalize_encoding
+from g711 import frame_bytes as g711_frame_bytes
+from llm_stream import coalesce_deltas
+from metrics import (
+    ASR_FINAL_LAG_MS, ENDPOINT_DECISION_MS, LLM_TTFT_MS, LLM_TOTAL_MS, TTS_SYNTH_MS_PER_CHAR, FIRST_AUDIO_MS,
+)
+from tts_chunker import AdaptiveChunker, TokenAssembler, wav_duration_ms
+from utterance_trace import TRACER
+from voice_log import get_logger
 
-# Настройка логирования
-logger = logging.getLogger("voice_pipeline")
+log = get_logger("PIPELINE")
+log_config = get_logger("CONFIG")
+log_handshake = get_logger("HANDSHAKE")
+log_proto = get_logger("PROTO")
+log_ws = get_logger("WS")
+log_audio = get_logger("AUDIO")
+log_vad = get_logger("VAD")
+log_asr = get_logger("ASR")
+log_endpoint = get_logger("ENDPOINT")
+log_state = get_logger("STATE")
+log_echo = get_logger("ECHO")
+log_session = get_logger("SESSION")
+log_llm = get_logger("LLM")
+log_chat = get_logger("CHAT")
+log_tts = get_logger("TTS")
+log_retry = get_logger("RETRY")
 
 # Функция для быстрой конвертации цифр в слова
 async def convert_numbers_to_words(text: str) -> str:
@@ -40,405 +71,1510 @@ async def convert_numbers_to_words(text: str) -> str:
         llm_api_key = os.getenv('LLM_API_KEY', '')
         
         if not llm_api_key:
-            logger.warning("LLM_API_KEY not set, skipping number conversion")
+            log.warn("LLM_API_KEY not set, skipping number conversion")
             return text
         
         # Быстрый запрос с таймаутом 2 секунды
         async with httpx.AsyncClient(timeout=2.0) as client:
-                    response = await client.post(
-                        f"{llm_base_url}/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {llm_api_key}"},
-                        json={
-                            "model": "deepseek-chat",
-                            "messages": [
-                                {
-                                    "role": "system",
-                                    "content": "Ты помощник для конвертации чисел в слова на русском языке. Замени ВСЕ числа (включая десятичные, дроби, научную нотацию типа 5,97 × 10²⁴) на слова с правильным склонением. Научную нотацию преобразуй в полную форму (например, '5,97 × 10²⁴' → 'пять целых девяносто семь сотых умножить на десять в двадцать четвертой степени' или 'пять целых девяносто семь сотых на десять в двадцать четвертой степени'). Сохраняй весь остальной текст без изменений. Отвечай ТОЛЬКО преобразованным текстом, без объяснений."
-                                },
-                                {
-                                    "role": "user",
-                                    "content": f"Преобразуй все числа (включая научную нотацию) в слова с правильным склонением:\n\n{text}"
-                                }
-                            ],
-                            "max_tokens": 300,  # Увеличено для научной нотации
-                            "temperature": 0.1
+            response = await client.post(
+                f"{llm_base_url}/v1/chat/completions",
+                headers={"Authorization": f"Bearer {llm_api_key}"},
+                json={
+                    "model": "deepseek-chat",
+                    "messages": [
+                        {
+                            "role": "system",
+                            "content": "Ты помощник для конвертации чисел в слова на русском языке. Замени ВСЕ числа (включая десятичные, дроби, научную нотацию типа 5,97 × 10²⁴) на слова с правильным склонением. Научную нотацию преобразуй в полную форму (например, '5,97 × 10²⁴' → 'пять целых девяносто семь сотых умножить на десять в двадцать четвертой степени' или 'пять целых девяносто семь сотых на десять в двадцать четвертой степени'). Сохраняй весь остальной текст без изменений. Отвечай ТОЛЬКО преобразованным текстом, без объяснений."
+                        },
+                        {
+                            "role": "user",
+                            "content": f"Преобразуй все числа (включая научную нотацию) в слова с правильным склонением:\n\n{text}"
                         }
-                    )
+                    ],
+                    "max_tokens": 300,  # Увеличено для научной нотации
+                    "temperature": 0.1
+                }
+            )
             
             if response.status_code == 200:
                 data = response.json()
                 converted = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
                 if converted:
-                    logger.info(f"✅ Numbers converted: {text[:50]}... → {converted[:50]}...")
+                    log.debug("✅ Numbers converted: %s... → %s...", text[:50], converted[:50])
                     return converted
         
         return text  # Fallback на оригинал
     except asyncio.TimeoutError:
-        logger.warning("Number conversion timeout, using original text")
+        log.warn("Number conversion timeout, using original text")
         return text
     except Exception as e:
-        logger.warning(f"Number conversion error: {e}, using original text")
+        log.warn("Number conversion error: %s, using original text", e)
         return text
 
+# Voice Session States
 class VoiceState(Enum):
-    IDLE = "idle"
-    USER_SPEAKING = "user"
-    ASSISTANT_TTS = "tts"
-
-@dataclass
-class Turn:
-    role: str            # "user" | "assistant"
-    text: str
-    ts: int = field(default_factory=lambda: int(time.time() * 1000))
-    utterance_id: int | None = None
-
-@dataclass
-class SessionState:
-    session_id: str
-    turns: list[Turn] = field(default_factory=list)
-    llm_buffers: dict[int, str] = field(default_factory=dict)
-    summary: str = ""
-    ended: bool = False
-    ended_at_ms: int | None = None
-
-    def add_turn(self, role: str, text: str, utterance_id: int | None = None):
-        text = (text or "").strip()
-        if not text:
-            return
-        self.turns.append(Turn(role=role, text=text, utterance_id=utterance_id))
+    IDLE = "idle"              # Waiting for user input
+    USER_SPEAKING = "user"     # ASR active, user is speaking
+    ASSISTANT_TTS = "tts"      # Assistant is speaking via TTS
+
+# Бинарный протокол аудио
+MIME_WAV = 1
+AUDIO_MAGIC = b"AUD0"
+
+# Фиксированная политика sample rate
+ALLOWED_SAMPLE_RATE = 16000
+
+def normalize_sample_rate(requested: int | None) -> int:
+    """Нормализует sample_rate PCM16: сервер поддерживает только 16000 Hz mono (G.711 — см. g711.py)"""
+    if requested != ALLOWED_SAMPLE_RATE:
+        log_config.warn("Client requested sample_rate=%s, forcing to %s", requested, ALLOWED_SAMPLE_RATE)
+        return ALLOWED_SAMPLE_RATE
+    return requested
+
+# VAD и endpointing параметры
+FRAME_MS = int(os.getenv("FRAME_MS", "20"))          # 10/20/30 ms
+VAD_MODE = int(os.getenv("VAD_MODE", "2"))           # 0..3 (0 мягкий, 3 агрессивный)
+EARLY_PAUSE_MS = int(os.getenv("EARLY_PAUSE_MS", "300"))   # Уменьшено: быстрее старт
+FINAL_PAUSE_MS = int(os.getenv("FINAL_PAUSE_MS", "800"))   # Уменьшено: быстрее финал
+STABLE_MS = int(os.getenv("STABLE_MS", "250"))
+PARTIAL_RATE_LIMIT_MS = int(os.getenv("PARTIAL_RATE_LIMIT_MS", "150"))
+MIN_WORDS_EARLY = int(os.getenv("MIN_WORDS_EARLY", "1"))   # Было 3: теперь реагирует на 1 слово
+MIN_CHARS_EARLY = int(os.getenv("MIN_CHARS_EARLY", "3"))   # Было 12: теперь реагирует на "Да", "Нет"
+
+# Barge-in
+BARGE_IN_ENABLED = os.getenv("BARGE_IN_ENABLED", "1") == "1"
+BARGE_IN_MIN_VOICE_MS = int(os.getenv("BARGE_IN_MIN_VOICE_MS", "1000"))
+BARGE_IN_COOLDOWN_MS = int(os.getenv("BARGE_IN_COOLDOWN_MS", "2000"))
+BARGE_IN_IGNORE_AFTER_TTS_MS = int(os.getenv("BARGE_IN_IGNORE_AFTER_TTS_MS", "500"))
+BARGE_IN_ARM_SILENCE_MS = int(os.getenv("BARGE_IN_ARM_SILENCE_MS", "1000"))
+
+PAUSE_EMA_ALPHA = float(os.getenv("PAUSE_EMA_ALPHA", "0.15"))  # сглаживание оценки пауз
+ASR_WARMUP_MS = int(os.getenv("ASR_WARMUP_MS", "200"))        # ASR после TTS: 200ms оптимально для turn-taking
+
+# Склейка llm_delta: токены в пределах окна уходят одним событием и одним put в очередь TTS
+LLM_DELTA_COALESCE_MS = int(os.getenv("LLM_DELTA_COALESCE_MS", "25"))  # 0 = отключить
+LLM_DELTA_MAX_CHARS = int(os.getenv("LLM_DELTA_MAX_CHARS", "64"))
+
+# Чтобы event loop не “умирал” на CPU-bound декодинге, гоняем декод в thread pool
+DECODE_IN_THREAD = os.getenv("DECODE_IN_THREAD", "1") == "1"
+
+def recognizer_final(rec) -> dict:
+    """FinalResult() с замером задержки декодера"""
+    t0 = time.perf_counter()
+    final_json = json.loads(rec.FinalResult())
+    ASR_FINAL_LAG_MS.observe((time.perf_counter() - t0) * 1000.0)
+    return final_json
+
+def now_ms() -> int:
+    """Текущее время в миллисекундах"""
+    return int(time.time() * 1000)
+
+def frame_bytes(sample_rate: int, frame_ms: int) -> int:
+    """Размер фрейма в байтах для mono PCM16"""
+    return int(sample_rate * frame_ms / 1000) * 2
+
+def word_count(text: str) -> int:
+    """Количество слов в тексте"""
+    return len([w for w in text.strip().split() if w])
+
+def is_meaningful(text: str) -> bool:
+    """Проверяет, имеет ли текст достаточный смысл для запуска ответа"""
+    t = (text or "").strip()
+    return (len(t) >= MIN_CHARS_EARLY) and (word_count(t) >= MIN_WORDS_EARLY)
+
+async def call_with_retry(fn, retries=1, backoff=0.2):
+    """Простой retry для сетевых вызовов"""
+    for attempt in range(retries + 1):
+        try:
+            return await fn()
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            if attempt == retries:
+                raise
+            log_retry.warn("Попытка %s не удалась: %s, ждем %ss", attempt + 1, e, backoff)
+            await asyncio.sleep(backoff)
+            backoff *= 2
+        except httpx.HTTPStatusError as e:
+            # Не ретраим 4xx ошибки
+            if e.response.status_code < 500:
+                raise
+            if attempt == retries:
+                raise
+            log_retry.warn("Попытка %s не удалась: %s, ждем %ss", attempt + 1, e, backoff)
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+def _accept_timed(rec, chunk: bytes) -> bool:
+    """AcceptWaveform с замером для RTF распознавания (без ожидания в пуле потоков)"""
+    t0 = time.perf_counter()
+    ok = rec.AcceptWaveform(chunk)
+    ADMISSION.observe_asr(time.perf_counter() - t0, len(chunk) / (2 * ALLOWED_SAMPLE_RATE))
+    return ok
+
+async def decode_accept(rec, chunk: bytes) -> bool:
+    if DECODE_IN_THREAD:
+        return await asyncio.to_thread(_accept_timed, rec, chunk)
+    return _accept_timed(rec, chunk)
+
+def should_restart_llm(new_text: str, old_text: str) -> bool:
+    """Эвристика: нужно ли перезапускать LLM при изменении текста"""
+    new_text = (new_text or "").strip()
+    old_text = (old_text or "").strip()
+    if not old_text:
+        return True
+    if new_text == old_text:
+        return False
+
+    # 1) существенный рост длины (>30%)
+    if len(new_text) > int(len(old_text) * 1.3):
+        return True
+
+    # 2) если новая строка сильно "перестроилась"
+    # общий префикс меньше половины старого текста
+    common = 0
+    for a, b in zip(new_text, old_text):
+        if a == b:
+            common += 1
+        else:
+            break
+    if common < max(1, len(old_text) // 2):
+        return True
+
+    return False
+
+# ---------- Интеллектуальный endpointing: функции ----------
+
+def clamp(v: float, lo: float, hi: float) -> float:
+    return lo if v < lo else hi if v > hi else v
+
+def update_pause_ema(pause_ema_ms: float, pause_ms: float, alpha: float) -> float:
+    # учитываем только "внутренние" паузы (запинки), не финальные
+    if pause_ms <= 800:
+        return pause_ema_ms * (1 - alpha) + pause_ms * alpha
+    return pause_ema_ms
+
+def compute_adaptive_thresholds(text: str, wps: float, pause_ema: float) -> tuple[int, int, int]:
+    """Расчет адаптивных порогов для FSM endpointing"""
+    wc = len(text.strip().split())
+
+    # Базовые пороги от типичной внутрипредложенческой паузы
+    tent = max(int(pause_ema * 1.2), 300)
+    confirm = max(int(pause_ema * 2.5), 900)
+    final = confirm + 500
+
+    # Коррекция по длине фразы
+    if wc < 4:
+        confirm += 200
+        final += 300
+
+    # Коррекция по качеству концовки
+    if not is_good_end(text):
+        confirm += 300
+
+    # Коррекция по скорости речи
+    if wps > 2.5:
+        confirm += 100
+
+    return tent, confirm, final
+
+def compute_thresholds(pause_ema_ms: float, tentative_min: int, confirm_min: int, confirm_max: int) -> tuple[int, int]:
+    """Устаревшая версия для совместимости"""
+    tentative = int(clamp(pause_ema_ms * 1.3, tentative_min, 650))
+    confirm = int(clamp(pause_ema_ms * 3.0, confirm_min, confirm_max))
+    return tentative, confirm
+
+CONTINUE_WORDS = {
+    "что","который","которая","которые","чтобы","потому","потому что",
+    "если","когда","почему","зачем","как","где","куда","откуда",
+    "и","а","но","или","ли","то","это","вот"
+}
+FILLERS = {"э","эм","ну","типа","короче","значит","мм"}
+
+# Расширенные словари для continuation penalty
+# Эвристики для определения плохих концовок фраз
+BAD_ENDINGS = {
+    "и", "а", "но", "или", "что", "если", "то", "который", "которая", "которые",
+    "чтобы", "потому", "также", "либо", "вот", "это", "так", "как", "где", "куда",
+    "откуда", "зачем", "почему", "когда", "тогда", "здесь", "там", "тут"
+}
+
+def is_good_end(text: str) -> bool:
+    """Проверяет, является ли конец фразы хорошим для завершения"""
+    words = text.strip().lower().split()
+    if len(words) < 3:
+        return False
+    return words[-1] not in BAD_ENDINGS
+
+def common_prefix_len(a: str, b: str) -> int:
+    """Длина общего префикса двух строк"""
+    n = 0
+    for x, y in zip(a, b):
+        if x == y:
+            n += 1
+        else:
+            break
+    return n
+
+def is_tail_jitter(new: str, old: str, max_tail: int = 3) -> bool:
+    """Проверяет, является ли изменение только jitter'ом на хвосте"""
+    new = (new or "").strip()
+    old = (old or "").strip()
+    if not old or not new or new == old:
+        return False
+    cp = common_prefix_len(new, old)
+    tail_new = len(new) - cp
+    tail_old = len(old) - cp
+    return max(tail_new, tail_old) <= max_tail
+
+def update_wps_ema(wps_ema: float, prev_words: int, new_words: int, dt_ms: int, alpha: float = 0.2) -> float:
+    """Обновляет EMA скорости речи (слов/сек)"""
+    if dt_ms <= 0:
+        return wps_ema
+    dw = max(0, new_words - prev_words)
+    inst = (dw * 1000.0) / dt_ms
+    if inst <= 0:
+        return wps_ema
+    return wps_ema * (1 - alpha) + inst * alpha
+
+def last_word(text: str) -> str:
+    t = (text or "").strip().lower()
+    if not t:
+        return ""
+    parts = t.split()
+    return parts[-1] if parts else ""
+
+def need_stricter_confirm(text: str) -> bool:
+    w = last_word(text)
+    return (w in CONTINUE_WORDS) or (w in FILLERS)
+
+# ---------- Защита от эха ----------
+
+def _norm(s: str) -> str:
+    return " ".join((s or "").lower().strip().split())
+
+def is_echo_like(text: str, session) -> bool:
+    # простая защита: если final слишком похож на последний assistant
+    u = _norm(text)
+    if len(u) < 8:
+        return False
+    last_a = ""
+    for t in reversed(session.turns):
+        if t.role == "assistant" and t.text:
+            last_a = _norm(t.text)
+            break
+    if not last_a:
+        return False
+    # грубый similarity: совпадение по префиксу/подстроке
+    return (u in last_a) or (last_a in u) or (u[:40] == last_a[:40])
 
-    def build_llm_messages(self, system_prompt: str, max_turns: int = 12):
-        history = self.turns[-max_turns:]
-        messages = [{"role": "system", "content": system_prompt}]
-        for t in history:
-            messages.append({"role": "user" if t.role == "user" else "assistant", "content": t.text})
-        return messages
 
 class VoicePipeline:
+    """
+    Движок голосовой сессии: VAD → Vosk → endpointing FSM → LLM → TTS с barge-in,
+    ACK и guard'ами озвучки. Транспорт не знает: всё наружу идёт через колбэки
+
+        send_json(payload: dict)        — JSON-событие клиенту
+        send_binary(data: bytes)        — аудиофрейм (AUD0-заголовок + WAV)
+        close(code: int, reason: str)   — закрыть сессию (eof, ошибка config)
+
+    а модели и сервисы передаются снаружи: recognizer_factory(sample_rate,
+    phrase_list, words), vad (is_speech), tts (TTSBackend: synthesize_wav,
+    ACK-кэш), stream_llm (сигнатура openai_stream), on_turn(role, text) — реплика
+    добавлена в историю (Voice Control). Поэтому сессию можно крутить в процессе
+    без сокета: feed_pcm()/handle_control() из бенчмарка или офлайн-прогона.
+
+    Жизненный цикл: start() (прогрев ACK, TTS consumer, ready) → handle_control()/
+    feed_pcm() на каждое входящее сообщение → close().
+    """
+
+    __slots__ = (
+        # зависимости
+        "session", "session_id", "agent", "tts", "tts_settings", "recognizer_factory", "vad",
+        "stream_llm", "send_json", "send_binary", "close_transport", "on_turn",
+        # параметры агента
+        "llm_model", "llm_temp", "llm_max_tokens", "system_prompt",
+        # протокол и ASR
+        "voice_state", "handshake_done", "tts_sending", "sample_rate", "phrase_list", "words",
+        "input_encoding", "ingest", "in_fb", "rec", "fb", "audio_buf", "asr_enabled", "asr_warming_up", "asr_warmup_deadline",
+        # VAD и endpointing
+        "last_voice_ms", "last_partial", "last_partial_change_ms", "last_partial_sent_ms",
+        "part_json", "early_endpoint_fired", "pause_ema_ms", "silence_start_ms", "was_voice_prev",
+        "wps_ema", "prev_wc", "prev_wc_ts_ms", "endpoint_state", "endpoint_tentative_start_ms",
+        "endpoint_confirmed_start_ms",
+        # turn и ACK
+        "turn_id", "ack_sent_for_turn", "pause_gate_open",
+        # LLM
+        "utterance_id", "current_llm_task", "llm_started", "current_llm_input",
+        "llm_started_at_ms", "llm_first_token_at_ms", "llm_to_tts_q",
+        # вывод и barge-in
+        "active_output_u", "output_active", "tts_epoch", "tts_allowed_u", "tts_playing",
+        "barge_armed", "silent_run_ms", "voice_run_ms", "last_barge_in_ms", "last_tts_chunk_ms",
+        # задачи и трассировка
+        "tts_task", "turn_trace", "traces_by_u",
+    )
+
     def __init__(
-        self, 
-        session_id: str,
-        preset: dict,
-        send_event: Callable[[dict], Any],
-        send_audio: Callable[[int, bytes], Any],
-        vad_engine: Any,
-        recognizer: Any,
-        sample_rate: int,
-        protocol_version: int = 1
+        self,
+        session,
+        agent: dict,
+        *,
+        tts,
+        tts_settings,
+        recognizer_factory: Callable[..., Any],
+        vad: Any,
+        stream_llm: Callable[..., AsyncIterator[str]],
+        send_json: Callable[[dict], Awaitable[Any]],
+        send_binary: Callable[[bytes], Awaitable[Any]],
+        close: Callable[[int, str], Awaitable[Any]],
+        on_turn: Callable[[str, str], Any] | None = None,
+        sample_rate: int = ALLOWED_SAMPLE_RATE,
     ):
-        self.session_id = session_id
-        self.preset = preset
-        self.send_event_cb = send_event
-        self.send_audio_cb = send_audio
-        self.vad = vad_engine
-        self.rec = recognizer
+        self.session = session
+        self.session_id = session.session_id
+        self.agent = agent
+        self.tts = tts
+        self.tts_settings = tts_settings
+        self.recognizer_factory = recognizer_factory
+        self.vad = vad
+        self.stream_llm = stream_llm
+        self.send_json = send_json
+        self.send_binary = send_binary
+        self.close_transport = close
+        self.on_turn = on_turn
+
+        # Настройки LLM для этой сессии
+        self.llm_model = agent.get("model") or agent.get("llm_model", "deepseek-chat")
+        self.llm_temp = agent.get("temperature", 0.4)
+        self.llm_max_tokens = agent.get("max_tokens", 220)
+        self.system_prompt = agent.get("system_prompt", "Ты ассистент.")
+
+        # Voice Protocol State Machine: сессия аутентифицирована, ждём речь пользователя
+        self.voice_state = VoiceState.USER_SPEAKING
+        self.handshake_done = False  # получен config
+        self.tts_sending = False     # окно между tts_start и tts_end
+
         self.sample_rate = sample_rate
-        self.protocol_version = protocol_version
+        self.phrase_list = None
+        self.words = False
+        # формат входа клиента; G.711 декодируется в PCM16 sample_rate до VAD/ASR
+        self.input_encoding = ENCODING_PCM16
+        self.ingest: G711Decoder | None = None
+        self.in_fb = int(sample_rate * 0.02) * 2    # байт в одном бинарном сообщении (20 мс)
+        self.rec = recognizer_factory(sample_rate, phrase_list=None, words=False)
+        self.fb = frame_bytes(sample_rate, FRAME_MS)
+        self.audio_buf = bytearray()
 
-        # State management
-        self.voice_state = VoiceState.IDLE
-        self.session = SessionState(session_id=session_id)
-        
-        # Runtime flags
+        # ASR mute во время TTS
         self.asr_enabled = True
         self.asr_warming_up = False
-        self.asr_warmup_deadline = 0
-        
-        # Utterance tracking
+        self.asr_warmup_deadline = 0.0
+
+        # Состояние для VAD и endpointing
+        self.last_voice_ms = now_ms()
+        self.last_partial = ""
+        self.last_partial_change_ms = now_ms()
+        self.last_partial_sent_ms = 0
+        self.part_json: dict = {}
+        self.early_endpoint_fired = False
+        self.pause_ema_ms = 350.0        # адаптивная оценка "типичной внутрипредложенческой паузы"
+        self.silence_start_ms = 0        # когда началась последняя тишина
+        self.was_voice_prev = False
+        # Скорость речи (WPS) для динамических порогов
+        self.wps_ema = 2.2
+        self.prev_wc = 0
+        self.prev_wc_ts_ms = 0
+        # FSM endpointing: listening | tentative | confirmed | final
+        self.endpoint_state = "listening"
+        self.endpoint_tentative_start_ms = 0
+        self.endpoint_confirmed_start_ms = 0
+
+        # turn и ACK
+        self.turn_id = 0
+        self.ack_sent_for_turn = False
+        self.pause_gate_open = True
+
+        # Состояние LLM конвейера
         self.utterance_id = 0
-        self.active_output_u = 0
-        self.tts_allowed_u = 0
-        self.tts_sending = False
-        self.tts_playing = False
-        self.output_active = False
-        self.tts_epoch = 0
-        
-        # Barge-in tracking
-        self.last_voice_ms = 0
-        self.last_tts_chunk_ms = 0
-        self.last_barge_in_ms = 0
-        self.barge_armed = False
-        self.silent_run_ms = 0
-        self.voice_run_ms = 0
-        
-        # Endpointing & Context
-        self.current_llm_input = ""
+        self.current_llm_task: asyncio.Task | None = None
         self.llm_started = False
-        self.silence_start_ms = 0
-        self.audio_buf = bytearray()
-        self.llm_to_tts_q = asyncio.Queue(maxsize=100)
-        
-        # Config (moved from server_fixed.py)
-        self.BARGE_IN_ENABLED = os.getenv("BARGE_IN_ENABLED", "true").lower() == "true"
-        self.BARGE_IN_MIN_VOICE_MS = int(os.getenv("BARGE_IN_MIN_VOICE_MS", "100"))
-        self.BARGE_IN_COOLDOWN_MS = int(os.getenv("BARGE_IN_COOLDOWN_MS", "2000"))
-        self.BARGE_IN_IGNORE_AFTER_TTS_MS = int(os.getenv("BARGE_IN_IGNORE_AFTER_TTS_MS", "500"))
-        self.BARGE_IN_ARM_SILENCE_MS = int(os.getenv("BARGE_IN_ARM_SILENCE_MS", "300"))
-        self.ASR_WARMUP_MS = int(os.getenv("ASR_WARMUP_MS", "200"))
-        self.EARLY_PAUSE_MS = int(os.getenv("EARLY_PAUSE_MS", "350"))
-        self.MIN_CHARS_EARLY = int(os.getenv("MIN_CHARS_EARLY", "12"))
-        
-        # Async tasks
-        self.current_llm_task = None
-        self.tts_task = asyncio.create_task(self._run_tts_loop())
+        self.current_llm_input = ""
+        self.llm_started_at_ms = 0
+        self.llm_first_token_at_ms = 0
+        # Очередь от LLM к TTS: (utterance_id, token); пустая строка — сигнал завершения
+        self.llm_to_tts_q: asyncio.Queue[tuple[int, str]] = asyncio.Queue(maxsize=5000)
 
-    def now_ms(self) -> int:
-        return int(time.time() * 1000)
+        # --- Output state ---
+        self.active_output_u = 0     # utterance_id, который сейчас озвучивается/генерится
+        self.output_active = False   # идёт ответ (LLM/TTS)
+        self.tts_epoch = 0           # версия потока TTS, чтобы мгновенно "обесценивать" отправки после abort
+        self.tts_allowed_u = 0       # utterance_id, которому разрешено озвучивание
 
-    async def process_pcm(self, pcm_bytes: bytes):
-        """Main entry point for audio data from transport"""
-        if self.voice_state == VoiceState.ASSISTANT_TTS and not self.BARGE_IN_ENABLED:
+        # --- Barge-in ---
+        self.tts_playing = False     # сервер считает, что сейчас идёт озвучка
+        self.barge_armed = False     # barge-in разрешён только после тишины
+        self.silent_run_ms = 0       # сколько подряд тишины во время output_active
+        self.voice_run_ms = 0
+        self.last_barge_in_ms = 0
+        self.last_tts_chunk_ms = 0   # когда последний раз отправили аудио (ACK/чанк)
+
+        self.tts_task: asyncio.Task | None = None
+        # Трассировка задержек: trace текущей реплики пользователя и трассы по utterance_id ответа
+        self.turn_trace = TRACER.begin(self.session_id)
+        self.traces_by_u: dict[int, object] = {}
+
+    # ------------------------------------------------------------------
+    # транспорт
+    # ------------------------------------------------------------------
+
+    async def _send(self, payload: dict):
+        await self.send_json(payload)
+
+    def _violation(self, msg: str):
+        """Log protocol violation for debugging"""
+        log_proto.warn("VIOLATION: %s", msg)
+
+    async def _send_audio(self, u_id: int, wav_bytes: bytes):
+        """Отправка аудио бинарным фреймом вместо base64"""
+        if self.voice_state != VoiceState.ASSISTANT_TTS:
+            self._violation(f"Audio chunk sent while not in ASSISTANT_TTS state (u_id={u_id})")
             return
 
-        if not self.asr_enabled:
+        if not self.tts_sending:
+            self._violation(f"Audio chunk sent outside tts window (u_id={u_id})")
             return
 
-        # Warmup handler
-        if self.asr_warming_up:
-            if time.time() < self.asr_warmup_deadline:
-                return
-            self.asr_warming_up = False
-            print("[PIPELINE] ASR Warmup finished")
+        log_ws.trace("→ BIN audio %s bytes", len(wav_bytes))
+        header = struct.pack("<4sIHI", AUDIO_MAGIC, u_id, MIME_WAV, len(wav_bytes))
+        await self.send_binary(header + wav_bytes)
 
-        self.audio_buf.extend(pcm_bytes)
-        fb = int(self.sample_rate * 0.02) * 2 # 20ms frame
-        
-        while len(self.audio_buf) >= fb:
-            frame = bytes(self.audio_buf[:fb])
-            del self.audio_buf[:fb]
-            
-            is_voice = self.vad.is_speech(frame, self.sample_rate)
-            now = self.now_ms()
-            
-            if is_voice:
-                self.last_voice_ms = now
-            
-            # 1. Barge-in detection
-            await self._handle_barge_in(is_voice, now)
-            
-            # 2. ASR & Endpointing (only if user can speak)
-            if self.voice_state != VoiceState.ASSISTANT_TTS:
-                if await asyncio.to_thread(self.rec.AcceptWaveform, frame):
-                    res = json.loads(self.rec.Result())
-                    text = res.get("text", "").strip()
-                    if text:
-                        await self.handle_final_text(text, "asr_final")
-                else:
-                    partial = json.loads(self.rec.PartialResult()).get("partial", "").strip()
-                    if partial:
-                        await self.send_event_cb({"type": "partial", "partial": partial})
-                        await self._handle_endpointing(partial, is_voice, now)
-
-    async def _handle_barge_in(self, is_voice: bool, now: int):
-        if not self.output_active:
-            self.barge_armed = False
-            self.silent_run_ms = 0
-            return
+    # ------------------------------------------------------------------
+    # жизненный цикл
+    # ------------------------------------------------------------------
 
-        if not is_voice:
-            self.silent_run_ms += 20
-            if self.silent_run_ms >= self.BARGE_IN_ARM_SILENCE_MS:
-                self.barge_armed = True
-        else:
-            if self.barge_armed and not self.tts_playing:
-                if now - self.last_tts_chunk_ms > self.BARGE_IN_IGNORE_AFTER_TTS_MS:
-                    if now - self.last_barge_in_ms > self.BARGE_IN_COOLDOWN_MS:
-                        self.voice_run_ms += 20
-                        if self.voice_run_ms >= self.BARGE_IN_MIN_VOICE_MS:
-                            await self.abort_output("barge_in")
-            else:
-                self.voice_run_ms = 0
+    async def start(self):
+        """Прогрев ACK, запуск TTS consumer и событие ready"""
+        log_tts.info("Начинаем warmup ACK фраз...")
+        await self.tts.warmup_ack()
+        log_tts.info("Warmup ACK завершен")
 
-    async def _handle_endpointing(self, partial: str, is_voice: bool, now: int):
-        if not is_voice and len(partial) > self.MIN_CHARS_EARLY:
-            if self.silence_start_ms == 0:
-                self.silence_start_ms = now
-            elif now - self.silence_start_ms > self.EARLY_PAUSE_MS:
-                await self.handle_final_text(partial, "endpoint_early")
-        else:
-            self.silence_start_ms = 0
+        if self.tts_task is None:
+            self.tts_task = asyncio.create_task(self._run_tts())
+            log_tts.info("Consumer запущен")
+
+        await self._send({
+            "event": "ready",
+            "sample_rate": self.sample_rate,
+            "frame_ms": FRAME_MS,
+            "vad_mode": VAD_MODE,
+            "early_pause_ms": EARLY_PAUSE_MS,
+            "final_pause_ms": FINAL_PAUSE_MS,
+            "stable_ms": STABLE_MS
+        })
+
+    def close(self):
+        """Отмена задач сессии и завершение незакрытых трасс"""
+        if self.current_llm_task and not self.current_llm_task.done():
+            self.current_llm_task.cancel()
+        if self.tts_task and not self.tts_task.done():
+            self.tts_task.cancel()
+            log_tts.info("TTS task отменен")
+        for trace in set(self.traces_by_u.values()):
+            trace.mark("connection_closed", lane="ws")
+            trace.finish()
+        self.traces_by_u.clear()
+
+    def _new_turn(self):
+        """Новая пользовательская реплика — сбрасываем состояния turn"""
+        self.turn_id += 1
+        self.ack_sent_for_turn = False
+        self.llm_started = False
+        self.current_llm_input = ""
+        self.pause_gate_open = True
+
+        # Сброс WPS состояний для новой реплики
+        self.wps_ema = 2.2
+        self.prev_wc = 0
+        self.prev_wc_ts_ms = 0
+
+    def _reset_endpoint(self):
+        self.endpoint_state = "listening"
+        self.endpoint_tentative_start_ms = 0
+        self.endpoint_confirmed_start_ms = 0
+
+    # ------------------------------------------------------------------
+    # final → LLM
+    # ------------------------------------------------------------------
 
     async def handle_final_text(self, final_text: str, reason: str):
-        final_text = final_text.strip()
-        if not final_text or self.current_llm_input == final_text:
+        final_text = (final_text or "").strip()
+        if not final_text:
             return
 
-        # Protection against echo
-        if self.tts_playing or (self.now_ms() - self.last_tts_chunk_ms < self.BARGE_IN_IGNORE_AFTER_TTS_MS):
+        session = self.session
+        # 1) анти-эхо: если сейчас шёл TTS или очень близко к последнему чанку — не принимаем final как user
+        if self.tts_playing or (now_ms() - self.last_tts_chunk_ms) < BARGE_IN_IGNORE_AFTER_TTS_MS:
+            log_echo.warn("drop final during/after tts: '%s...'", final_text[:80])
             return
 
-        print(f"[PIPELINE] Final text: '{final_text}' ({reason})")
-        self.current_llm_input = final_text
-        self.session.add_turn("user", final_text, utterance_id=self.utterance_id)
-        
-        # Start response generation
-        await self.start_or_restart_llm(final_text)
+        # 2) анти-эхо по содержанию
+        if is_echo_like(final_text, session):
+            log_echo.warn("drop echo-like final: '%s...'", final_text[:80])
+            return
 
-    async def start_or_restart_llm(self, text: str):
-        self.utterance_id += 1
-        u_id = self.utterance_id
-        
-        if self.current_llm_task:
-            self.current_llm_task.cancel()
-            
-        self.output_active = True
-        self.active_output_u = u_id
-        self.tts_allowed_u = u_id
-        self.tts_epoch += 1 # Invalidate previous TTS chunks
-        
-        # Clear queue
-        while not self.llm_to_tts_q.empty():
-            try: self.llm_to_tts_q.get_nowait()
-            except: break
-            
-        await self.send_event_cb({"type": "llm_start", "utterance_id": u_id, "text": text})
-        self.current_llm_task = asyncio.create_task(self._run_llm(u_id, text))
+        # 3) сохраняем user turn (ВАЖНО: делать именно тут)
+        session.add_turn("user", final_text)
+        if self.on_turn is not None:
+            self.on_turn("user", final_text)
+        log_session.debug("Added user turn, total turns: %s", len(session.turns), session=self.session_id)
+
+        # 4) запуск/рестарт LLM
+        trace = self.turn_trace
+        if trace.last_voice_ns:
+            trace.mark("last_voiced_frame", ts_ns=trace.last_voice_ns)
+        trace.mark("final_text", reason=reason, chars=len(final_text))
+        log_tts.debug("enqueue: '%s...'", final_text[:50])
+        if not self.llm_started:
+            play_ack = not self.ack_sent_for_turn
+            await self.start_or_restart_llm(final_text, reason=reason, play_ack=play_ack, allow_tts=True)
+            if play_ack:
+                self.ack_sent_for_turn = True
+        elif should_restart_llm(final_text, self.current_llm_input):
+            await self.start_or_restart_llm(final_text, reason=f"{reason}_restart", play_ack=False, allow_tts=True)
+        else:
+            # LLM уже идёт, просто разрешаем озвучку
+            if self.tts_allowed_u == 0 and self.active_output_u != 0:
+                self.tts_allowed_u = self.active_output_u
+
+        # следующая речь пользователя — уже новая реплика
+        if not trace.utterance_ids:
+            trace.finish()
+        self.turn_trace = TRACER.begin(self.session_id)
 
     async def _run_llm(self, u_id: int, prompt_text: str):
-        messages = self.session.build_llm_messages(self.preset["system_prompt"])
-        self.session.llm_buffers[u_id] = ""
-        
+        """Запуск LLM streaming для конкретного utterance_id"""
+        log_llm.info("run_llm started for utterance %s: '%s'", u_id, prompt_text)
+
         try:
-            # Inline Step 3 logic
-            payload = {
-                "model": self.preset["model"],
-                "messages": messages,
-                "stream": True,
-                "temperature": self.preset["temperature"],
-                "max_tokens": self.preset["max_tokens"],
-            }
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                headers = {"Authorization": f"Bearer {os.getenv('LLM_API_KEY')}"}
-                async with client.stream("POST", f"{os.getenv('LLM_BASE_URL')}/v1/chat/completions", json=payload, headers=headers) as r:
-                    r.raise_for_status()
-                    async for line in r.aiter_lines():
-                        if u_id != self.active_output_u: break
-                        if not line.startswith("data: "): continue
-                        
-                        data = line[6:]
-                        if data == "[DONE]": break
-                        
-                        try:
-                            chunk = json.loads(data)
-                            tok = chunk["choices"][0]["delta"].get("content")
-                            if tok:
-                                self.session.llm_buffers[u_id] += tok
-                                await self.send_event_cb({"type": "llm_delta", "utterance_id": u_id, "delta": tok})
-                                await self.llm_to_tts_q.put((u_id, tok))
-                        except: continue
-            
-            await self.llm_to_tts_q.put((u_id, "")) # End signal
-            await self.send_event_cb({"type": "llm_end", "utterance_id": u_id})
+            await self._send({"type": "nlu_start", "utterance_id": u_id, "text": prompt_text})
+        except Exception as e:
+            log_llm.warn("Failed to send nlu_start (connection may be closed): %s", e)
+            return  # Прерываем выполнение, если соединение закрыто
+
+        session = self.session
+        messages = session.build_llm_messages(self.system_prompt, max_turns=12)
+        log_session.debug("Building messages: %s messages, turns: %s", len(messages), len(session.turns), session=self.session_id)
+        # гарантируем буфер
+        session.llm_buffers[u_id] = ""
+
+        first = True
+        t_start = time.monotonic()
+        try:
+            stream = self.stream_llm(
+                None,
+                messages=messages,
+                model=self.llm_model,
+                system_prompt=self.system_prompt,
+                max_tokens=self.llm_max_tokens,
+                temperature=self.llm_temp,
+            )
+            # tok — склеенный фрагмент: одно llm_delta и один put в очередь на окно
+            async for tok in coalesce_deltas(stream, LLM_DELTA_COALESCE_MS, LLM_DELTA_MAX_CHARS):
+                if first:
+                    self.llm_first_token_at_ms = now_ms()
+                    first = False
+                    LLM_TTFT_MS.observe((time.monotonic() - t_start) * 1000.0)
+                    if u_id in self.traces_by_u:
+                        self.traces_by_u[u_id].mark("llm_first_token", lane="llm", u=u_id)
+                    await self._send({
+                        "type": "metric",
+                        "utterance_id": u_id,
+                        "llm_first_token_ms": self.llm_first_token_at_ms - self.llm_started_at_ms
+                    })
+
+                # копим ассистента
+                session.llm_buffers[u_id] += tok
+
+                await self._send({"type": "llm_delta", "utterance_id": u_id, "delta": tok})
+
+                # Кладём токен в очередь для TTS (только если TTS разрешен для этого utterance)
+                if self.tts_allowed_u == u_id:
+                    try:
+                        await self.llm_to_tts_q.put((u_id, tok))
+                    except asyncio.QueueFull:
+                        log_llm.warn("⚠️ Очередь TTS переполнена, пропускаем фрагмент (%s chars)", len(tok))
+
         except asyncio.CancelledError:
-            pass
+            raise
         except Exception as e:
-            await self.send_event_cb({"type": "llm_error", "error": str(e)})
+            log_llm.error("Error in run_llm: %s", e)
+            try:
+                await self._send({"type": "llm_error", "utterance_id": u_id, "error": str(e)})
+            except Exception as send_err:
+                log_llm.warn("Failed to send error (connection closed): %s", send_err)
+        finally:
+            LLM_TOTAL_MS.observe((time.monotonic() - t_start) * 1000.0)
+            if u_id in self.traces_by_u:
+                self.traces_by_u[u_id].mark("llm_end", lane="llm", u=u_id)
+            # Сигнал завершения для TTS
+            try:
+                await self.llm_to_tts_q.put((u_id, ""))
+            except asyncio.QueueFull:
+                log_llm.warn("Очередь TTS переполнена, не удалось отправить сигнал завершения")
+
+            try:
+                await self._send({"type": "llm_end", "utterance_id": u_id})
+            except Exception as send_err:
+                log_llm.warn("Failed to send llm_end (connection closed): %s", send_err)
+
+    def _drain_tts_queue(self):
+        while not self.llm_to_tts_q.empty():
+            try:
+                self.llm_to_tts_q.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+    async def start_or_restart_llm(self, new_text: str, reason: str, play_ack: bool = False, allow_tts: bool = False):
+        prev_u = self.active_output_u  # что сейчас играет
+
+        # новый ответ → barge-in не армим, пока не увидим тишину
+        self.barge_armed = False
+        self.silent_run_ms = 0
+        self.voice_run_ms = 0
+        self.tts_playing = False
+
+        self.utterance_id += 1
+        u_id = self.utterance_id
+
+        self.turn_trace.mark("llm_start", lane="llm", u=u_id, reason=reason)
+        self.turn_trace.bind(u_id)
+        if TRACER.enabled:
+            self.traces_by_u[u_id] = self.turn_trace
+
+        # устанавливаем разрешение на TTS
+        if allow_tts:
+            self.tts_allowed_u = u_id
+            log_llm.debug("TTS allowed for utterance %s", u_id)
+        else:
+            self.tts_allowed_u = 0
+            log_llm.debug("TTS NOT allowed for utterance %s", u_id)
+
+        # отменяем предыдущую LLM задачу
+        if self.current_llm_task and not self.current_llm_task.done():
+            self.current_llm_task.cancel()
+            if prev_u:
+                await self._send({"type": "abort", "scope": "llm", "reason": reason, "utterance_id": prev_u})
+
+        # останавливаем предыдущее аудио (ВАЖНО: prev_u)
+        if prev_u:
+            await self._send({"type": "abort", "scope": "tts", "reason": reason, "utterance_id": prev_u})
+
+        # обесцениваем текущие отправки TTS и чистим очередь
+        self.tts_epoch += 1
+        self._drain_tts_queue()
+
+        # активируем новый output
+        self.active_output_u = u_id
+        self.output_active = True
+
+        self.current_llm_input = new_text
+        self.llm_started = True
+        self.llm_started_at_ms = now_ms()
+        self.llm_first_token_at_ms = 0
+
+        await self._send({
+            "type": "llm_start",
+            "utterance_id": u_id,
+            "text": self.current_llm_input
+        })
+
+        # ACK звук только если нужно И разрешено озвучивание
+        if play_ack and allow_tts:
+            ack_text = ""
+            if self.tts_sending:
+                self._violation("Attempted ACK while TTS window is active")
+            elif self.voice_state == VoiceState.ASSISTANT_TTS:
+                self._violation("Attempted ACK while in ASSISTANT_TTS state")
+            else:
+                # State transition: start ACK TTS
+                self.voice_state = VoiceState.ASSISTANT_TTS
+                self.tts_sending = True
+
+                ack_text, ack_wav = self.tts.get_random_ack_wav()
+                if ack_wav is None:
+                    # Если кэш не готов, синтезируем на лету
+                    ack_text = self.tts.get_random_ack_text()
+                    ack_wav = await call_with_retry(
+                        lambda: self.tts.synthesize_wav(ack_text, settings=self.tts_settings), retries=1)
+
+                # Жёстко открываем окно TTS для ACK
+                log_ws.debug("→ JSON tts_start (ack)")
+                await self._send({
+                    "type": "tts_start",
+                    "utterance_id": u_id,
+                    "mime": "audio/wav",
+                    "note": "ack"
+                })
+
+                await self._send_audio(u_id, ack_wav)
+
+                # tts_end закрывает мини-сеанс ACK; основной ответ откроет свой tts_start в _run_tts.
+                # voice_state НЕ сбрасываем: _run_tts сам установит ASSISTANT_TTS (иначе гонка)
+                log_ws.debug("→ JSON tts_end (ack, u_id=%s)", u_id)
+                await self._send({
+                    "type": "tts_end",
+                    "utterance_id": u_id
+                })
+                self.tts_sending = False
+            self.tts_playing = True
+            self.last_tts_chunk_ms = now_ms()  # anti-echo окно
+            log_tts.info("Отправлен ACK '%s' для utterance %s", ack_text, u_id)
 
-    async def _run_tts_loop(self):
+        self.current_llm_task = asyncio.create_task(self._run_llm(u_id, self.current_llm_input))
+
+    async def abort_output(self, reason: str):
+        if not self.output_active or self.active_output_u == 0:
+            return
+
+        u = self.active_output_u
+        self.output_active = False
+        self.active_output_u = 0
+        self.tts_epoch += 1           # после этого _run_tts перестанет отправлять аудио
+
+        # сброс barge-in state, иначе состояние может "залипнуть"
+        self.tts_playing = False
+        self.tts_sending = False
+        self.barge_armed = False
+
+        # State transition: abort resets to idle/speaking
+        if self.voice_state == VoiceState.ASSISTANT_TTS:
+            self.voice_state = VoiceState.USER_SPEAKING
+        self.silent_run_ms = 0
+        self.voice_run_ms = 0
+        self.tts_allowed_u = 0  # сброс разрешения на TTS
+
+        # сброс LLM состояний при abort
+        self.llm_started = False
+        self.current_llm_input = ""
+
+        self.last_barge_in_ms = now_ms()
+
+        if self.current_llm_task and not self.current_llm_task.done():
+            self.current_llm_task.cancel()
+
+        # команда клиенту остановить проигрывание
+        log_ws.debug("→ JSON abort (llm)")
+        await self._send({"type": "abort", "scope": "llm", "reason": reason, "utterance_id": u})
+        log_ws.debug("→ JSON abort (tts)")
+        await self._send({"type": "abort", "scope": "tts", "reason": reason, "utterance_id": u})
+
+        # чистим очередь, чтобы хвосты не догоняли
+        self._drain_tts_queue()
+
+    # ------------------------------------------------------------------
+    # LLM → TTS
+    # ------------------------------------------------------------------
+
+    async def _run_tts(self):
+        """
+        Consumer для очереди LLM→TTS.
+        Читает токены, собирает в чанки и озвучивает.
+        """
+        log_tts.info("run_tts STARTED")
+        current_u = -1  # -1 вместо 0, чтобы избежать ложных cleanup
         buf = ""
-        current_u = 0
-        
+        local_epoch = self.tts_epoch
+        # Размер чанков подбирается по измеренной скорости Silero и длительности уже отправленного аудио
+        chunker = AdaptiveChunker()
+        # Токены → текст за O(len(token)): фильтр дублей слов без пересборки всего буфера
+        assembler = TokenAssembler()
+        first_audio_u = -1  # utterance, для которого уже измерена задержка первого аудио
+
+        async def speak(chunk: str):
+            """Синтез чанка и отправка, если ответ всё ещё актуален (guard'ы по utterance/epoch)"""
+            nonlocal first_audio_u
+            if not any(ch.isalnum() for ch in chunk):
+                chunker.on_chunk_dropped(len(chunk))
+                return
+            trace = self.traces_by_u.get(current_u)
+            span = trace.span_start() if trace else 0
+            # попадание в кеш TTSBackend (ACK-фразы) — ~0 мс: не портит гистограмму и RTF синтеза
+            cached = chunk in getattr(self.tts, "cache", ())
+            t0 = time.monotonic()
+            wav = await call_with_retry(
+                lambda: self.tts.synthesize_wav(chunk, settings=self.tts_settings, utterance_id=current_u), retries=1)
+            synth_ms = (time.monotonic() - t0) * 1000.0
+            if trace:
+                trace.span_end("tts_synth", span, chars=len(chunk), bytes=len(wav), cached=cached)
+            if not cached:
+                TTS_SYNTH_MS_PER_CHAR.observe(synth_ms / len(chunk))
+                ADMISSION.observe_tts(synth_ms / 1000.0, wav_duration_ms(wav) / 1000.0)
+            guard_active = not self.output_active
+            guard_u = current_u != self.active_output_u
+            guard_epoch = local_epoch != self.tts_epoch
+            guard_tts_allowed = (self.tts_allowed_u != current_u)
+            if guard_active or guard_u or guard_epoch or guard_tts_allowed:
+                # ответ уже прерван или устарел или TTS не разрешено
+                log_tts.debug("❌ Чанк пропущен: active=%s(%s), current_u=%s != active_u=%s(%s), local_epoch=%s != global_epoch=%s(%s), tts_allowed_u=%s(%s)", self.output_active, guard_active, current_u, self.active_output_u, guard_u, local_epoch, self.tts_epoch, guard_epoch, self.tts_allowed_u, guard_tts_allowed)
+                chunker.on_chunk_dropped(len(chunk))
+                return
+            await self._send({
+                "type": "tts_audio",
+                "utterance_id": current_u,
+                "mime": "audio/wav"
+            })
+            self.tts_playing = True
+            span = trace.span_start() if trace else 0
+            await self._send_audio(current_u, wav)
+            self.last_tts_chunk_ms = now_ms()
+            if trace:
+                trace.span_end("send_audio_binary", span, lane="ws", bytes=len(wav))
+            if first_audio_u != current_u:
+                first_audio_u = current_u
+                if trace:
+                    trace.mark("first_audio", lane="ws", u=current_u)
+                if self.llm_started_at_ms:
+                    FIRST_AUDIO_MS.observe(self.last_tts_chunk_ms - self.llm_started_at_ms)
+            chunker.on_audio_sent(len(chunk), synth_ms, wav)
+            log_tts.debug("✅ Чанк отправлен: '%s...' (%s bytes, synth %.0fms)", chunk[:30], len(wav), synth_ms)
+
+        log_tts.debug("Consumer started with initial epoch %s", local_epoch)
+
         while True:
+            log_tts.trace("Ожидание токена из очереди (epoch=%s, active=%s)...", local_epoch, self.active_output_u)
             u_id, tok = await self.llm_to_tts_q.get()
-            
+            log_tts.trace("Получен токен: utterance=%s, token='%s...', queue_size=%s", u_id, tok[:20], self.llm_to_tts_q.qsize())
+
+            # Новый utterance - закрываем незакрытое окно TTS предыдущего
+            if u_id != current_u and current_u != -1 and self.tts_sending:
+                log_ws.debug("→ JSON tts_end (overlap cleanup, current_u=%s)", current_u)
+                await self._send({"type": "tts_end", "utterance_id": current_u})
+                self.tts_sending = False
+
+            # Устанавливаем новый utterance (если это первый запуск или новый utterance)
             if u_id != current_u:
-                if self.tts_sending:
-                    await self.send_event_cb({"type": "tts_end", "utterance_id": current_u})
-                
                 current_u = u_id
                 buf = ""
+                local_epoch = self.tts_epoch
+                chunker.reset()
+                assembler.reset()
+
+                # ВСЕГДА посылаем tts_start для основного ответа, даже если был ACK:
+                # фронтенд готов принимать новые чанки основного ответа
                 self.voice_state = VoiceState.ASSISTANT_TTS
                 self.tts_sending = True
-                await self.send_event_cb({"type": "tts_start", "utterance_id": u_id})
+
+                log_ws.debug("→ JSON tts_start (main response, u_id=%s)", current_u)
+                await self._send({
+                    "type": "tts_start",
+                    "utterance_id": current_u,
+                    "mime": "audio/wav"
+                })
+
+                # HARD MUTE ASR во время TTS
                 self.asr_enabled = False
+                self.asr_warming_up = False
+                log_asr.debug("Muted during TTS utterance %s", current_u)
 
-            if tok == "": # EOF
-                if buf.strip():
-                    await self._synthesize_and_send(current_u, buf.strip())
-                
-                await self.send_event_cb({"type": "tts_end", "utterance_id": current_u})
-                self.voice_state = VoiceState.IDLE
-                self.tts_sending = False
-                self.tts_playing = False
-                self.output_active = False
-                self.asr_enabled = True
-                self.asr_warming_up = True
-                self.asr_warmup_deadline = time.time() + (self.ASR_WARMUP_MS / 1000.0)
-                
-                # Commit response to history
-                assistant_text = self.session.llm_buffers.pop(current_u, "").strip()
-                if assistant_text:
-                    self.session.add_turn("assistant", assistant_text, utterance_id=current_u)
+            # Маркер завершения LLM
+            if tok == "":
+                log_tts.debug("✅ EOF MARKER received for utterance %s, buf: '%s' (len=%s)", current_u, buf, len(buf))
+                log_tts.debug("Starting cleanup: tts_sending=%s, voice_state=%s", self.tts_sending, self.voice_state)
+
+                # Сначала озвучиваем весь остаток буфера
+                buf += assembler.flush()
+                chunks, buf = chunker.split(buf, final=True)
+                if chunks:
+                    log_tts.debug("Финальная обработка: %s чанков", len(chunks))
+                for chunk in chunks:
+                    try:
+                        await speak(chunk)
+                    except Exception as e:
+                        chunker.on_chunk_dropped(len(chunk))
+                        log_tts.error("Ошибка финального чанка: %s", e)
+
+                await self._finish_utterance(current_u)
                 continue
 
-            buf += tok
-            # Отправляем чанк размером ~10 символов для максимально быстрого старта
-            # Условия: минимум 10 символов И (пунктуация в текущем токене ИЛИ пробел в буфере ИЛИ превышение 50 символов)
-            has_punctuation = any(p in tok for p in ".!?\n")
-            has_space = " " in buf
-            should_send = len(buf) >= 10 and (has_punctuation or has_space or len(buf) > 50)
-            if should_send:
-                chunk_text = buf.strip()
-                # Пропускаем слишком короткие или пустые чанки
-                if chunk_text and len(chunk_text) >= 3:
-                    await self._synthesize_and_send(current_u, chunk_text)
-                buf = ""
+            # Нормальный токен - добавляем в буфер с фильтром дублирования слов
+            buf += assembler.feed(tok)
 
-    async def _synthesize_and_send(self, u_id: int, text: str):
-        if not text or u_id != self.active_output_u: return
-        
-        try:
-            # Конвертируем цифры в слова перед TTS (с таймаутом и обработкой ошибок)
-            converted_text = text
-            try:
-                converted_text = await asyncio.wait_for(convert_numbers_to_words(text), timeout=1.5)
-            except asyncio.TimeoutError:
-                logger.warning(f"Number conversion timeout for text: {text[:50]}..., using original")
-                converted_text = text
-            except Exception as conv_error:
-                logger.warning(f"Number conversion failed: {conv_error}, using original text")
-                converted_text = text
-            
-            # Проверяем, что текст не пустой после конвертации
-            if not converted_text or not converted_text.strip():
-                logger.warning(f"Empty text after conversion, skipping TTS")
-                return
-            
-            self.tts_playing = True
-            wav = await tts_silero.synthesize_wav(
-                converted_text,
-                model_name=self.preset["tts"]["model"],
-                voice=self.preset["tts"]["voice"]
-            )
-            self.last_tts_chunk_ms = self.now_ms()
-            await self.send_audio_cb(u_id, wav)
-        except Exception as e:
-            logger.error(f"TTS Error: {e}")
-            # Отправляем ошибку клиенту
-            await self.send_event_cb({"type": "tts_error", "utterance_id": u_id, "error": str(e)})
+            # Чанкер сканирует буфер только при новой границе предложения/клаузы или достижении целевого размера
+            if not (assembler.take_boundary() or chunker.worth_splitting(len(buf))):
+                continue
+            chunks, buf = chunker.split(buf)
+            if chunks:
+                log_tts.debug("Разбито на %s чанков, остаток: '%s'", len(chunks), buf)
+            for chunk in chunks:
+                try:
+                    await speak(chunk)
+                except Exception as e:
+                    chunker.on_chunk_dropped(len(chunk))
+                    log_tts.error("Ошибка чанка '%s...': %s", chunk[:30], e)
+                    await self._send({
+                        "type": "tts_error",
+                        "utterance_id": current_u,
+                        "error": f"Chunk failed: {str(e)}"
+                    })
 
-    async def abort_output(self, reason: str):
-        print(f"[PIPELINE] Aborting output: {reason}")
-        self.tts_epoch += 1
-        self.output_active = False
-        self.active_output_u = 0
+    async def _finish_utterance(self, u_id: int):
+        """tts_end ответа: возврат к слушанию, прогрев ASR, ответ ассистента — в историю"""
+        if u_id == self.active_output_u:
+            self.output_active = False
+            self.active_output_u = 0
+
+        log_ws.debug("→ JSON tts_end")
+
+        # Флаги сбрасываются ДО отправки tts_end: к моменту получения tts_end клиентом состояние уже обновлено
         self.tts_playing = False
         self.tts_sending = False
-        self.barge_armed = False
+
+        if self.voice_state != VoiceState.ASSISTANT_TTS:
+            self._violation("tts_end received while not in TTS state")
+
+        # Возвращаемся в IDLE, чтобы начать ждать новую реплику пользователя
         self.voice_state = VoiceState.IDLE
+        log_state.debug("ASSISTANT_TTS → IDLE (TTS finished for utterance %s)", u_id)
+
+        await self._send({"type": "tts_end", "utterance_id": u_id})
+
+        # Сбрасываем распознаватель Vosk, чтобы он не учитывал старый шум/эхо
+        try:
+            self.rec.Reset()
+            log_asr.debug("Vosk recognizer reset after TTS")
+        except Exception as e:
+            log_asr.warn("Failed to reset Vosk: %s", e)
+
+        # СБРОС ТАЙМЕРОВ ТИШИНЫ: крайне важно для продолжения диалога
+        now_after_tts = now_ms()
+        self.last_voice_ms = now_after_tts
+        self.last_partial_change_ms = now_after_tts
+        self.last_tts_chunk_ms = 0  # иначе анти-эхо окно блокирует обработку
+        self.last_partial = ""
+        self.endpoint_state = "listening"
+        self.ack_sent_for_turn = False  # Разрешаем ACK для следующей фразы
+        log_asr.debug("Silence timers, TTS timer, and endpoint state reset after TTS")
+
+        # ASR WARMUP: мягкая реинициализация после TTS
         self.asr_enabled = True
-        self.last_barge_in_ms = self.now_ms()
-        
-        if self.current_llm_task:
-            self.current_llm_task.cancel()
-            
-        while not self.llm_to_tts_q.empty():
-            try: self.llm_to_tts_q.get_nowait()
-            except: break
-            
-        await self.send_event_cb({"type": "abort", "reason": reason})
+        self.asr_warming_up = True
+        self.asr_warmup_deadline = time.time() + (ASR_WARMUP_MS / 1000.0)
+        log_asr.debug("Warmup mode after TTS utterance %s (deadline: %.3f)", u_id, self.asr_warmup_deadline)
 
-    def close(self):
-        if self.tts_task: self.tts_task.cancel()
-        if self.current_llm_task: self.current_llm_task.cancel()
+        # СОХРАНИТЬ ПОЛНЫЙ ОТВЕТ АССИСТЕНТА В ИСТОРИЮ СЕССИИ (СТРОГО ОДИН РАЗ)
+        session = self.session
+        assistant_text = session.llm_buffers.pop(u_id, "").strip()
+        if assistant_text:
+            session.add_turn("assistant", assistant_text, utterance_id=u_id)
+            if self.on_turn is not None:
+                self.on_turn("assistant", assistant_text)
+            log_session.debug("Saved assistant response: '%s...'", assistant_text[:50], session=self.session_id)
+            log_session.debug("Session now has %s turns total", len(session.turns), session=self.session_id)
+
+        # трасса ответа завершена (рестарты LLM той же реплики делят одну трассу)
+        trace = self.traces_by_u.pop(u_id, None)
+        if trace is not None and trace.utterance_ids[-1] == u_id:
+            trace.mark("tts_end", lane="tts", u=u_id)
+            trace.finish()
+
+        # СБРОС состояний после завершения utterance
+        self.llm_started = False
+        self.current_llm_input = ""
+        self.tts_allowed_u = 0
+
+    # ------------------------------------------------------------------
+    # входящие сообщения
+    # ------------------------------------------------------------------
+
+    async def handle_control(self, data: dict) -> bool:
+        """JSON-сообщение клиента. False — сессия закрыта (eof, ошибка config)"""
+
+        # === CONFIG HANDLER (HANDSHAKE) ===
+        if "config" in data:
+            try:
+                await self._apply_config(data.get("config") or {})
+            except Exception as e:
+                log_handshake.exception("FATAL: %s", e)
+                await self.close_transport(1011, "config handler failed")
+                return False
+            return True
+
+        # reset: финализировать текущую фразу и продолжить
+        if data.get("reset") == 1:
+            final_json = recognizer_final(self.rec)
+            final_text = (final_json.get("text") or "").strip()
+            if final_text:  # НЕ отправляем пустые final
+                await self._send({"type": "final", **final_json})
+                if self.voice_state == VoiceState.USER_SPEAKING:
+                    self.voice_state = VoiceState.IDLE  # User input complete, waiting for LLM
+
+            await self.handle_final_text(final_json.get("text"), reason="final_reset")
+
+            self._new_turn()
+            self.rec = self.recognizer_factory(self.sample_rate, phrase_list=self.phrase_list, words=self.words)
+            self.last_partial = ""
+            return True
+
+        # partial: имитация ASR partial для тестирования
+        if data.get("type") == "partial":
+            partial_text = data.get("partial", "").strip()
+            if partial_text:
+                self.last_partial = partial_text
+                self.last_partial_change_ms = now_ms()
+                self.part_json = {"partial": partial_text, "result": []}
+                await self._send({"type": "partial", **self.part_json})
+                log_asr.debug("Имитирован ASR partial: '%s'", partial_text)
+            return True
+
+        # final: имитация ASR final для тестирования - ВЫЗЫВАЕМ FINAL ENDPOINT ЛОГИКУ
+        if data.get("type") == "final":
+            final_text = data.get("text", "").strip()
+            if final_text:
+                await self.handle_final_text(final_text, reason="final_json")
+
+                await self._send({"type": "final", "text": final_text, "result": []})
+
+                if self.voice_state == VoiceState.USER_SPEAKING:
+                    self.voice_state = VoiceState.IDLE
+                log_asr.debug("Имитирован ASR final: '%s'", final_text)
+
+                self._new_turn()
+                self._reset_endpoint()
+            return True
+
+        # ping: keep-alive от клиента
+        if "ping" in data:
+            await self._send({"pong": data["ping"]})
+            return True
+
+        # eof: финализировать и закрыть
+        if data.get("eof") == 1:
+            final_json = recognizer_final(self.rec)
+            final_text = (final_json.get("text") or "").strip()
+            if final_text:  # НЕ отправляем пустые final
+                await self._send({"type": "final", **final_json})
+            self._new_turn()
+            await self.close_transport(1000, "eof")
+            return False
+
+        # chat: отправить вопрос в LLM с streaming (legacy, без ASR)
+        if "chat" in data:
+            question = data["chat"].strip()
+            log_chat.info("Получен вопрос: '%s'", question)
+            if question:
+                # Отменяем предыдущий LLM запрос если он еще выполняется
+                if self.current_llm_task and not self.current_llm_task.done():
+                    log_chat.debug("Отменяем предыдущий LLM task")
+                    self.current_llm_task.cancel()
+                    await self._send({"type": "abort", "scope": "llm", "reason": "new_chat"})
+                log_chat.info("Запускаем новый LLM task для вопроса: '%s'", question)
+                self.current_llm_task = asyncio.create_task(self._run_chat(question))
+            else:
+                log_chat.warn("Пустой вопрос, пропускаем")
+        return True
+
+    async def _apply_config(self, cfg: dict):
+        if self.handshake_done:
+            # Повторный config — протокольное нарушение, но не рвём соединение
+            log_proto.warn("Duplicate config received, ignored")
+            await self._send({
+                "event": "warning",
+                "reason": "config_already_applied"
+            })
+            return
+
+        log_handshake.debug("Received config: %s", cfg)
+
+        # --- sample_rate ---
+        requested_sr = cfg.get("sample_rate")
+        try:
+            requested_sr = int(requested_sr) if requested_sr is not None else None
+        except Exception:
+            requested_sr = None
+
+        # --- encoding: pcm16 16 kHz или G.711 (mulaw/alaw) 8 kHz ---
+        requested_enc = cfg.get("encoding")
+        encoding = normalize_encoding(requested_enc)
+        if encoding in (None, ENCODING_PCM16):
+            new_sr = normalize_sample_rate(requested_sr)
+            input_sr = new_sr
+            in_fb = int(new_sr * 0.02) * 2
+            if encoding is None:
+                log_config.warn("Client requested encoding=%s, forcing to %s", requested_enc, ENCODING_PCM16)
+            if encoding is None or (requested_sr and requested_sr != new_sr):
+                await self._send({
+                    "event": "reconfigured",
+                    "encoding": ENCODING_PCM16,
+                    "sample_rate": new_sr,
+                    "note": "server supports pcm16 mono 16000 or mulaw/alaw 8000 only"
+                })
+            encoding = ENCODING_PCM16
+        else:
+            # G.711 — всегда 8 kHz, 1 байт на отсчёт; VAD и Vosk получают PCM16 16 kHz
+            new_sr = ALLOWED_SAMPLE_RATE
+            input_sr = G711_SAMPLE_RATE
+            in_fb = g711_frame_bytes(20)
+            if requested_sr and requested_sr != G711_SAMPLE_RATE:
+                log_config.warn("Client requested %s at sample_rate=%s, forcing to %s",
+                                encoding, requested_sr, G711_SAMPLE_RATE)
+                await self._send({
+                    "event": "reconfigured",
+                    "encoding": encoding,
+                    "sample_rate": G711_SAMPLE_RATE,
+                    "note": "G.711 input is 8000 Hz only"
+                })
+
+        # --- ASR options ---
+        self.words = bool(cfg.get("words", False))
+        self.phrase_list = cfg.get("phrase_list")
+
+        # --- apply settings ---
+        self.sample_rate = new_sr
+        self.input_encoding = encoding
+        self.ingest = G711Decoder(encoding) if encoding != ENCODING_PCM16 else None
+        self.in_fb = in_fb
+        self.fb = frame_bytes(self.sample_rate, FRAME_MS)
+        self.audio_buf.clear()
+        # у webrtcvad.Vad нет reset(); состояние VAD для handshake не критично
+        self.rec = self.recognizer_factory(self.sample_rate, phrase_list=self.phrase_list, words=self.words)
+
+        # --- handshake completed ---
+        self.handshake_done = True
+        self.asr_enabled = True
+
+        log_handshake.debug("Config applied, sending READY")
+        await self._send({
+            "event": "ready",
+            "encoding": encoding,
+            "sample_rate": input_sr,
+            "frame_ms": FRAME_MS,
+            "vad_mode": VAD_MODE,
+            "early_pause_ms": EARLY_PAUSE_MS,
+        })
+        log_handshake.debug("READY sent")
+
+    async def _run_chat(self, q: str):
+        """LLM streaming для chat-запроса (фиксированный utterance_id=1)"""
+        utterance_id = 1
+        await self._send({"type": "nlu_start", "utterance_id": utterance_id, "text": q})
+        await self._send({"type": "chat_start", "question": q})
+
+        first = True
+        acc = []  # Собираем полный ответ
+        t_start = time.monotonic()
+        try:
+            stream = self.stream_llm(q, model=self.llm_model, system_prompt=self.system_prompt,
+                                     max_tokens=self.llm_max_tokens, temperature=self.llm_temp)
+            async for tok in coalesce_deltas(stream, LLM_DELTA_COALESCE_MS, LLM_DELTA_MAX_CHARS):
+                if first:
+                    self.llm_first_token_at_ms = now_ms()
+                    first = False
+                    LLM_TTFT_MS.observe((time.monotonic() - t_start) * 1000.0)
+                    await self._send({
+                        "type": "metric",
+                        "utterance_id": utterance_id,
+                        "llm_first_token_ms": self.llm_first_token_at_ms - self.llm_started_at_ms
+                    })
+
+                acc.append(tok)
+                await self._send({"type": "llm_delta", "utterance_id": utterance_id, "delta": tok})
+
+                # Кладём токен в очередь для TTS
+                try:
+                    await self.llm_to_tts_q.put((utterance_id, tok))
+                except asyncio.QueueFull:
+                    log_llm.warn("Очередь TTS переполнена, пропускаем токен")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._send({"type": "llm_error", "utterance_id": utterance_id, "error": str(e)})
+        finally:
+            LLM_TOTAL_MS.observe((time.monotonic() - t_start) * 1000.0)
+            # Сигнал завершения для TTS
+            try:
+                await self.llm_to_tts_q.put((utterance_id, ""))
+            except asyncio.QueueFull:
+                log_llm.warn("Очередь TTS переполнена, не удалось отправить сигнал завершения")
+
+            await self._send({"type": "chat_response", "question": q, "answer": "".join(acc)})
+            await self._send({"type": "llm_end", "utterance_id": utterance_id})
+
+    async def feed_pcm(self, pcm_data: bytes):
+        """
+        Бинарный аудио-чанк, ровно 20 мс в согласованном формате: 16-bit mono PCM
+        little-endian или G.711 8 kHz (160 байт, декодируется в PCM16 16 kHz)
+        """
+        if not self.handshake_done:
+            self._violation("PCM received before READY")
+            return
+
+        if self.voice_state == VoiceState.ASSISTANT_TTS:
+            self._violation("User PCM received during ASSISTANT_TTS state - dropped")
+            return
+
+        log_audio.trace("Получены бинарные данные: %s bytes", len(pcm_data))
+
+        if self.ingest is not None:
+            if len(pcm_data) != self.in_fb:
+                self._violation(f"Bad G.711 frame size: {len(pcm_data)} bytes, expected {self.in_fb} bytes (20ms @ {G711_SAMPLE_RATE}Hz {self.input_encoding})")
+                return
+        else:
+            if len(pcm_data) % 2 != 0:
+                self._violation(f"PCM data size {len(pcm_data)} not divisible by 2 (expected int16)")
+                return
+
+            if len(pcm_data) != self.in_fb:
+                self._violation(f"Bad PCM frame size: {len(pcm_data)} bytes, expected {self.in_fb} bytes (20ms @ {self.sample_rate}Hz int16 mono)")
+                return
+
+        # ПРОВЕРКА ASR MUTE
+        if not self.asr_enabled:
+            return
+
+        if self.ingest is not None:
+            pcm_data = self.ingest.decode(pcm_data)
+        self.audio_buf.extend(pcm_data)
+        # ASR WARMUP: копим буфер ASR_WARMUP_MS, затем обрабатываем накопленное сразу
+        if self.asr_warming_up:
+            if time.time() < self.asr_warmup_deadline:
+                return
+            self.asr_warming_up = False
+            log_asr.debug("Warmup completed, ASR fully active, processing buffered audio")
+
+        frames_processed = 0
+        while len(self.audio_buf) >= self.fb:
+            frame = bytes(self.audio_buf[:self.fb])
+            del self.audio_buf[:self.fb]
+            frames_processed += 1
+            await self._on_frame(frame, frames_processed)
+
+    async def _on_frame(self, frame: bytes, frame_no: int):
+        # 1) VAD: определяем речь/тишину
+        try:
+            is_voice = self.vad.is_speech(frame, self.sample_rate)
+        except ValueError as e:
+            # Защита от некорректного фрейма / несостыковки sample_rate: сбрасываем буфер, не рвём сессию
+            log_vad.warn("Frame mismatch error: %s (frame_len=%s, sample_rate=%s)", e, len(frame), self.sample_rate)
+            self.audio_buf.clear()
+            return
+        if is_voice:
+            self.last_voice_ms = now_ms()
+            self.turn_trace.last_voice_ns = time.perf_counter_ns()
+            log_vad.trace("Речь обнаружена в фрейме %s", frame_no)
+            if self.voice_state == VoiceState.IDLE:
+                self.voice_state = VoiceState.USER_SPEAKING
+                log_state.debug("IDLE → USER_SPEAKING")
+        else:
+            log_vad.trace("Тишина в фрейме %s", frame_no)
+
+        # ---------- Обновление статистики пауз для адаптивности ----------
+        if self.was_voice_prev and (not is_voice):
+            self.silence_start_ms = now_ms()
+        if (not self.was_voice_prev) and is_voice and self.silence_start_ms:
+            pause_ms = now_ms() - self.silence_start_ms
+            self.pause_ema_ms = update_pause_ema(self.pause_ema_ms, pause_ms, PAUSE_EMA_ALPHA)
+            self.silence_start_ms = 0
+        self.was_voice_prev = is_voice
+
+        await self._barge_in(is_voice)
+
+        # 2) ASR: скармливаем Vosk тот же фрейм
+        # Если идёт озвучка — не пускаем аудио в ASR, иначе ловим эхо TTS
+        if self.output_active and self.tts_playing:
+            return
+        # Доп. окно после чанка TTS
+        if self.output_active and (now_ms() - self.last_tts_chunk_ms) < BARGE_IN_IGNORE_AFTER_TTS_MS:
+            return
+        if await decode_accept(self.rec, frame):
+            # Vosk решил, что фраза завершилась (по своей логике)
+            final_json = json.loads(self.rec.Result())
+            final_text = (final_json.get("text") or "").strip()
+            if final_text:  # НЕ отправляем пустые final
+                await self._send({"type": "final", **final_json})
+                if self.voice_state == VoiceState.USER_SPEAKING:
+                    self.voice_state = VoiceState.IDLE
+                    log_state.debug("USER_SPEAKING → IDLE (final received)")
+
+            await self.handle_final_text(final_json.get("text"), reason="final_vosk_result")
+
+            # сброс состояний под новую фразу
+            self.last_partial = ""
+            self.last_partial_change_ms = now_ms()
+            self.early_endpoint_fired = False
+            self.llm_started = False
+            self.current_llm_input = ""
+            return
+
+        now = now_ms()
+        await self._maybe_send_partial(now)
+        await self._endpoint(is_voice, now)
+
+    async def _barge_in(self, is_voice: bool):
+        # ---------- BARGE-IN ARMING (только после тишины) ----------
+        if self.output_active:
+            if not is_voice:
+                self.silent_run_ms += FRAME_MS
+                if self.silent_run_ms >= BARGE_IN_ARM_SILENCE_MS:
+                    self.barge_armed = True
+            else:
+                self.silent_run_ms = 0
+        else:
+            # если нет активного ответа — сбрасываем
+            self.barge_armed = False
+            self.silent_run_ms = 0
+            self.voice_run_ms = 0
+
+        # ---------- BARGE-IN (прерывание ответа) ----------
+        if BARGE_IN_ENABLED and self.output_active and is_voice:
+            now_bi = now_ms()
+
+            # 1) пока озвучка "идёт" — barge-in запрещён (иначе эхо рубит)
+            if self.tts_playing:
+                self.voice_run_ms = 0
+            # 2) ещё не было тишины во время ответа → это хвост пользовательской реплики, НЕ barge-in
+            elif not self.barge_armed:
+                self.voice_run_ms = 0
+            # 3) cooldown
+            elif now_bi - self.last_barge_in_ms < BARGE_IN_COOLDOWN_MS:
+                pass
+            # 4) анти-эхо окно после последнего отправленного аудио
+            elif now_bi - self.last_tts_chunk_ms < BARGE_IN_IGNORE_AFTER_TTS_MS:
+                self.voice_run_ms = 0
+            else:
+                self.voice_run_ms += FRAME_MS
+                if self.voice_run_ms >= BARGE_IN_MIN_VOICE_MS:
+                    await self.abort_output("barge_in_user_speaking")
+        elif not is_voice:
+            self.voice_run_ms = 0
+
+    async def _maybe_send_partial(self, now: int):
+        # 3) partial: ограничиваем частоту + отслеживаем стабильность
+        if now - self.last_partial_sent_ms < PARTIAL_RATE_LIMIT_MS:
+            return
+        self.part_json = part_json = json.loads(self.rec.PartialResult())
+        partial = (part_json.get("partial") or "").strip()
+        if not partial or partial == self.last_partial:
+            return
+
+        # Если мы получили текст, а состояние всё еще IDLE - значит пользователь начал говорить
+        if self.voice_state == VoiceState.IDLE:
+            self.voice_state = VoiceState.USER_SPEAKING
+            log_state.debug("IDLE → USER_SPEAKING (detected by partial: '%s')", partial[:30])
+
+        # Фильтр tail jitter: не сбрасываем стабильность на мелкие изменения хвоста
+        if not is_tail_jitter(partial, self.last_partial):
+            self.last_partial_change_ms = now
+
+            # Обновляем скорость речи
+            curr_wc = word_count(partial)
+            if self.prev_wc_ts_ms > 0 and curr_wc > self.prev_wc:
+                dt = now - self.prev_wc_ts_ms
+                self.wps_ema = update_wps_ema(self.wps_ema, self.prev_wc, curr_wc, dt)
+            self.prev_wc = curr_wc
+            self.prev_wc_ts_ms = now
+
+        self.last_partial = partial
+        await self._send({"type": "partial", **part_json})
+        self.last_partial_sent_ms = now
+
+    async def _endpoint(self, is_voice: bool, now: int):
+        # 4) FSM Endpointing логика: listening -> tentative -> confirmed -> final
+        last_partial = self.last_partial
+        silent_ms = now - self.last_voice_ms
+        stable_ms = now - self.last_partial_change_ms
+        partial_changed = last_partial != self.part_json.get("partial", "")
+        trace = self.turn_trace
+
+        # Рассчитываем адаптивные пороги для текущего текста
+        if last_partial:
+            tent_ms, conf_ms, fin_ms = compute_adaptive_thresholds(last_partial, self.wps_ema, self.pause_ema_ms)
+        else:
+            tent_ms, conf_ms, fin_ms = 350, 1100, 1600  # дефолтные значения
+
+        log_endpoint.trace("state=%s | silence=%sms | stable=%sms | text='%s...'", self.endpoint_state, silent_ms, stable_ms, last_partial[:50])
+
+        if self.endpoint_state == "listening":
+            # Переход в tentative при достаточной паузе и стабильности
+            if (last_partial and is_meaningful(last_partial) and
+                    stable_ms >= 300 and silent_ms >= tent_ms):
+                self.endpoint_state = "tentative"
+                self.endpoint_tentative_start_ms = now
+                log_endpoint.debug("→ tentative (tent_ms=%s)", tent_ms)
+                trace.mark("endpoint_tentative", silent_ms=silent_ms)
+
+                await self._send({
+                    "type": "asr_tentative_pause",
+                    "text": last_partial,
+                    "silent_ms": silent_ms,
+                    "stable_ms": stable_ms,
+                    "tentative_ms": tent_ms,
+                    "confirm_ms": conf_ms
+                })
+                # LLM стартует ТОЛЬКО из final
+
+        elif self.endpoint_state == "tentative":
+            # Возврат в listening если partial изменился
+            if last_partial and partial_changed:
+                self.endpoint_state = "listening"
+                log_endpoint.debug("← listening (partial changed)")
+                trace.mark("endpoint_listening", cause="partial_changed")
+            # Переход в confirmed при достаточной паузе и хорошем конце
+            elif (silent_ms >= conf_ms and stable_ms >= 500 and
+                  last_partial and is_good_end(last_partial)):
+                self.endpoint_state = "confirmed"
+                self.endpoint_confirmed_start_ms = now
+                log_endpoint.debug("→ confirmed (conf_ms=%s)", conf_ms)
+                trace.mark("endpoint_confirmed", silent_ms=silent_ms)
+
+                await self._send({
+                    "type": "asr_confirmed_end",
+                    "text": last_partial,
+                    "silent_ms": silent_ms,
+                    "stable_ms": stable_ms,
+                    "confirm_ms": conf_ms,
+                    "tentative_ms": tent_ms,
+                    "final_ms": fin_ms,
+                    "pause_ema_ms": self.pause_ema_ms,
+                    "wps_ema": self.wps_ema,
+                    "word_count": len(last_partial.strip().split()),
+                    "is_good_end": is_good_end(last_partial)
+                })
+
+        elif self.endpoint_state == "confirmed":
+            # Возврат в listening если partial изменился
+            if last_partial and partial_changed:
+                self.endpoint_state = "listening"
+                log_endpoint.debug("← listening (partial changed in confirmed)")
+                trace.mark("endpoint_listening", cause="partial_changed")
+            # Переход в final при максимальной паузе
+            elif silent_ms >= fin_ms:
+                self.endpoint_state = "final"
+                log_endpoint.debug("→ final (fin_ms=%s)", fin_ms)
+                trace.mark("endpoint_final", silent_ms=silent_ms)
+
+        # Сброс FSM при начале новой речи
+        if is_voice and self.endpoint_state != "listening":
+            self.endpoint_state = "listening"
+            log_endpoint.debug("← listening (voice detected)")
+            trace.mark("endpoint_listening", cause="voice")
+
+        # FINAL ENDPOINT: длинная пауза -> финализируем принудительно (только по аудио)
+        if last_partial and silent_ms >= fin_ms:
+            ENDPOINT_DECISION_MS.observe(silent_ms)
+            final_json = recognizer_final(self.rec)
+            final_text = (final_json.get("text") or "").strip()
+            if final_text:  # НЕ отправляем пустые final
+                await self._send({"type": "final", **final_json})
+                if self.voice_state == VoiceState.USER_SPEAKING:
+                    self.voice_state = VoiceState.IDLE
+
+            await self.handle_final_text(final_json.get("text"), reason="final_pause")
+
+            self._new_turn()
+            self._reset_endpoint()
+
+            # пересоздаём recognizer под следующую фразу
+            self.rec = self.recognizer_factory(self.sample_rate, phrase_list=self.phrase_list, words=self.words)
+
+            self.last_partial = ""
+            self.last_partial_change_ms = now_ms()
+            self.early_endpoint_fired = False
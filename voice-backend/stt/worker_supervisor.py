@@ -0,0 +1,471 @@
+"""
+Супервизор воркеров: N процессов на одном порту через SO_REUSEPORT.
+
+Родитель делает fork() N раз; каждый воркер запускает свой event loop
+(target(worker_id)) и слушает тот же PORT с reuse_port=True — ядро само
+раскладывает новые соединения по воркерам. У воркера свой health-порт
+(worker_health_port(i)) с /health и /metrics.
+
+Сам супервизор однопоточный и без asyncio (fork из процесса с потоками или
+работающим loop небезопасен): selectors по health-сокету и self-pipe сигналов.
+Он:
+  - перезапускает упавших воркеров (с нарастающей задержкой при crash-loop);
+  - раз в check_s опрашивает /health воркеров (и /ready, пока воркер не готов),
+    у здоровых — /health/capacity; вся проверка укладывается в CHECK_FANOUT_S,
+    не успевшие воркеры проверяются первыми в следующий раз;
+  - отдаёт на health_port сводный /health (JSON; 503, если живых воркеров нет),
+    /ready (503, пока ни один воркер не прогрел модели),
+    /health/capacity — сумму свободных слотов воркеров из последнего опроса,
+    /metrics здоровых воркеров с меткой worker="i" (сбор укладывается в
+    METRICS_FANOUT_S, чтобы зависший воркер не держал цикл) и /memory — уникальная и общая
+    память каждого процесса (smaps_rollup), чтобы видеть эффект preload-then-fork;
+  - по SIGTERM/SIGINT рассылает SIGTERM воркерам и ждёт shutdown_timeout_s,
+    затем SIGKILL.
+"""
+import http.client
+import json
+import os
+import selectors
+import signal
+import socket
+import time
+from typing import Callable
+
+from voice_log import get_logger
+
+log = get_logger("SUPERVISOR")
+
+CRASH_WINDOW_S = 10.0     # смерть раньше этого срока после старта считается crash-loop
+RESTART_DELAY_MAX_S = 30.0
+METRICS_FANOUT_S = 1.0    # общий бюджет на сбор /metrics воркеров за один scrape
+CHECK_FANOUT_S = 1.0      # общий бюджет периодической проверки всех воркеров
+PROBE_TIMEOUT_S = 0.5
+
+
+def process_memory(pid: int) -> dict | None:
+    """RSS процесса по /proc/<pid>/smaps_rollup, МБ: unique (private) и shared страницы, PSS"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                parts = rest.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    fields[name] = int(parts[0])
+    except OSError:
+        return None
+    mb = lambda kb: round(kb / 1024.0, 1)
+    return {
+        "rss_mb": mb(fields.get("Rss", 0)),
+        "pss_mb": mb(fields.get("Pss", 0)),
+        "unique_mb": mb(fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)),
+        "shared_mb": mb(fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)),
+    }
+
+
+class _Worker:
+    __slots__ = ("worker_id", "pid", "started", "restarts", "fast_crashes", "restart_at", "healthy", "ready",
+                 "last_ok", "capacity")
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.pid = 0
+        self.started = 0.0
+        self.restarts = 0
+        self.fast_crashes = 0
+        self.restart_at = 0.0     # 0 — не ждёт перезапуска
+        self.healthy = False
+        self.ready = False        # /ready воркера: модели прогреты, WS-порт слушает
+        self.last_ok = 0.0
+        self.capacity: dict | None = None   # /health/capacity с последней проверки
+
+
+class Supervisor:
+    def __init__(
+        self,
+        workers: int,
+        target: Callable[[int], None],
+        *,
+        health_port: int,
+        worker_health_port: Callable[[int], int],
+        health_host: str = "0.0.0.0",
+        check_s: float = 2.0,
+        shutdown_timeout_s: float = 15.0,
+        before_fork: Callable[[], None] | None = None,
+    ):
+        self.target = target
+        self.health_host = health_host
+        self.health_port = health_port
+        self.worker_health_port = worker_health_port
+        self.check_s = check_s
+        self.shutdown_timeout_s = shutdown_timeout_s
+        self.before_fork = before_fork
+        self.workers = [_Worker(i) for i in range(workers)]
+        self._stopping = False
+        self._memory_logged = False
+        self._check_from = 0      # с какого воркера начинать следующую проверку
+        self._sel: selectors.BaseSelector | None = None
+        self._listen: socket.socket | None = None
+        self._wake_r: socket.socket | None = None
+        self._wake_w: socket.socket | None = None
+
+    # ------------------------------------------------------------------
+    # процессы
+    # ------------------------------------------------------------------
+
+    def _spawn(self, w: _Worker):
+        if self.before_fork is not None:
+            self.before_fork()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._in_child()
+                self.target(w.worker_id)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                log.exception("Воркер %s упал", w.worker_id)
+                code = 1
+            finally:
+                os._exit(code)
+        w.pid = pid
+        w.started = time.monotonic()
+        w.restart_at = 0.0
+        w.healthy = w.ready = False
+        w.capacity = None
+        log.info("Воркер %s запущен: pid=%s", w.worker_id, pid)
+
+    def _in_child(self):
+        """Сбрасываем всё, что принадлежит супервизору"""
+        signal.set_wakeup_fd(-1)
+        for s in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(s, signal.SIG_DFL)
+        if self._sel is not None:
+            self._sel.close()
+        for sock in (self._listen, self._wake_r, self._wake_w):
+            if sock is not None:
+                sock.close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            w = next((w for w in self.workers if w.pid == pid), None)
+            if w is None:
+                continue
+            w.pid = 0
+            w.healthy = w.ready = False
+            w.capacity = None
+            code = os.waitstatus_to_exitcode(status)
+            if self._stopping:
+                log.info("Воркер %s завершился (code=%s)", w.worker_id, code)
+                continue
+            lived = time.monotonic() - w.started
+            w.fast_crashes = w.fast_crashes + 1 if lived < CRASH_WINDOW_S else 0
+            delay = min(RESTART_DELAY_MAX_S, 0.5 * (2 ** w.fast_crashes)) if w.fast_crashes else 0.5
+            w.restart_at = time.monotonic() + delay
+            log.error("Воркер %s (pid=%s) умер: code=%s после %.1fs, перезапуск через %.1fs",
+                      w.worker_id, pid, code, lived, delay)
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for w in self.workers:
+            if w.pid == 0 and w.restart_at and now >= w.restart_at:
+                w.restarts += 1
+                self._spawn(w)
+
+    # ------------------------------------------------------------------
+    # health воркеров
+    # ------------------------------------------------------------------
+
+    def _http_get(self, port: int, path: str, timeout: float = 1.0) -> tuple[int, bytes]:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+        try:
+            conn.request("GET", path, headers={"Connection": "close"})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        finally:
+            conn.close()
+
+    def _check_workers(self):
+        """
+        Опрос воркеров с общим дедлайном: зависшие не держат reap/рестарты и /health
+        супервизора дольше CHECK_FANOUT_S. Не успевшие сохраняют прежнее состояние.
+        """
+        deadline = time.monotonic() + CHECK_FANOUT_S
+        n = len(self.workers)
+        order = [self.workers[(self._check_from + i) % n] for i in range(n)]
+
+        def probe_timeout() -> float:
+            return max(0.05, min(PROBE_TIMEOUT_S, deadline - time.monotonic()))
+
+        for w in order:
+            if w.pid == 0:
+                continue
+            if deadline - time.monotonic() <= 0.05:
+                self._check_from = w.worker_id
+                log.warn("Проверка воркеров не уложилась в %ss, с воркера %s — в следующий раз",
+                         CHECK_FANOUT_S, w.worker_id)
+                return
+            port = self.worker_health_port(w.worker_id)
+            try:
+                status, _ = self._http_get(port, "/health", timeout=probe_timeout())
+                w.healthy = status == 200
+                if w.healthy and not w.ready:
+                    status, _ = self._http_get(port, "/ready", timeout=probe_timeout())
+                    w.ready = status == 200
+            except OSError:
+                w.healthy = w.ready = False
+            if not w.healthy:
+                w.capacity = None   # после таймаута /health capacity не запрашиваем
+                continue
+            w.last_ok = time.monotonic()
+            try:
+                _, body = self._http_get(port, "/health/capacity", timeout=probe_timeout())
+                w.capacity = json.loads(body)
+            except (OSError, ValueError):
+                w.capacity = None
+        self._check_from = 0
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        healthy = sum(1 for w in self.workers if w.healthy)
+        return {
+            "status": "ok" if healthy == len(self.workers) else ("degraded" if healthy else "down"),
+            "healthy": healthy,
+            "ready": sum(1 for w in self.workers if w.healthy and w.ready),
+            "workers": [
+                {
+                    "worker": w.worker_id,
+                    "pid": w.pid or None,
+                    "healthy": w.healthy,
+                    "ready": w.ready,
+                    "health_port": self.worker_health_port(w.worker_id),
+                    "uptime_s": round(now - w.started, 1) if w.pid else 0,
+                    "restarts": w.restarts,
+                }
+                for w in self.workers
+            ],
+        }
+
+    def capacity(self) -> dict:
+        """Сумма свободных слотов воркеров по их /health/capacity с последней проверки (без HTTP)"""
+        workers = {str(w.worker_id): w.capacity for w in self.workers if w.pid and w.capacity is not None}
+        return {
+            "slots": sum(c.get("slots", 0) for c in workers.values()),
+            "active": sum(c.get("active", 0) for c in workers.values()),
+            "workers": workers,
+        }
+
+    def memory(self) -> dict:
+        procs = [("supervisor", os.getpid())] + [(f"worker{w.worker_id}", w.pid) for w in self.workers if w.pid]
+        report = {name: process_memory(pid) for name, pid in procs}
+        known = [m for m in report.values() if m]
+        # фактически занято ≈ сумма PSS (общие страницы поделены между процессами)
+        report["total"] = {
+            "rss_mb": round(sum(m["rss_mb"] for m in known), 1),
+            "pss_mb": round(sum(m["pss_mb"] for m in known), 1),
+            "unique_mb": round(sum(m["unique_mb"] for m in known), 1),
+        }
+        return report
+
+    def _log_memory(self):
+        report = self.memory()
+        for name, m in report.items():
+            if name != "total" and m:
+                log.info("Память %s: unique=%sMB shared=%sMB rss=%sMB pss=%sMB",
+                         name, m["unique_mb"], m["shared_mb"], m["rss_mb"], m["pss_mb"])
+        log.info("Память всего: pss=%sMB (сумма rss=%sMB)", report["total"]["pss_mb"], report["total"]["rss_mb"])
+
+    def metrics(self) -> bytes:
+        texts = []
+        deadline = time.monotonic() + METRICS_FANOUT_S
+        for w in self.workers:
+            if w.pid == 0 or not w.healthy:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.05:
+                log.warn("Сбор /metrics не уложился в %ss, воркер %s пропущен", METRICS_FANOUT_S, w.worker_id)
+                continue
+            try:
+                status, body = self._http_get(self.worker_health_port(w.worker_id), "/metrics", timeout=remaining)
+            except OSError:
+                continue
+            if status == 200:
+                texts.append((w.worker_id, body.decode("utf-8")))
+        own = [
+            "# HELP voice_worker_restarts_total Worker processes restarted by the supervisor",
+            "# TYPE voice_worker_restarts_total counter",
+            *(f'voice_worker_restarts_total{{worker="{w.worker_id}"}} {w.restarts}' for w in self.workers),
+            "# HELP voice_worker_up Worker answered its /health on the last check",
+            "# TYPE voice_worker_up gauge",
+            *(f'voice_worker_up{{worker="{w.worker_id}"}} {int(w.healthy)}' for w in self.workers),
+        ]
+        return (merge_prometheus(texts) + "\n".join(own) + "\n").encode("utf-8")
+
+    # ------------------------------------------------------------------
+    # HTTP супервизора
+    # ------------------------------------------------------------------
+
+    def _serve_http(self, conn: socket.socket):
+        conn.settimeout(1.0)
+        try:
+            head = b""
+            while b"\r\n\r\n" not in head and len(head) < 8192:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                head += chunk
+            parts = head.split(b"\r\n", 1)[0].decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+            if path.startswith("/health/capacity"):
+                cap = self.capacity()
+                code = "200 OK" if cap["slots"] else "503 Service Unavailable"
+                ctype, body = "application/json", json.dumps(cap).encode("utf-8")
+            elif path.startswith("/health"):
+                st = self.status()
+                code = "200 OK" if st["healthy"] else "503 Service Unavailable"
+                ctype, body = "application/json", json.dumps(st).encode("utf-8")
+            elif path.startswith("/ready"):
+                st = self.status()
+                code = "200 OK" if st["ready"] else "503 Service Unavailable"
+                ctype, body = "application/json", json.dumps(st).encode("utf-8")
+            elif path.startswith("/memory"):
+                code, ctype, body = "200 OK", "application/json", json.dumps(self.memory()).encode("utf-8")
+            elif path.startswith("/metrics"):
+                code, ctype, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.metrics()
+            else:
+                code, ctype, body = "404 Not Found", "text/plain", b"not found"
+            conn.sendall(
+                f"HTTP/1.1 {code}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # основной цикл
+    # ------------------------------------------------------------------
+
+    def run(self) -> int:
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        signal.set_wakeup_fd(self._wake_w.fileno())
+
+        def _on_stop(signum, _frame):
+            if not self._stopping:
+                log.info("Сигнал %s: останавливаем воркеры", signum)
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, _on_stop)
+        signal.signal(signal.SIGINT, _on_stop)
+        signal.signal(signal.SIGCHLD, lambda *_: None)  # только будит select через wakeup fd
+
+        self._listen = socket.create_server((self.health_host, self.health_port))
+        self._listen.setblocking(False)
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._listen, selectors.EVENT_READ, "http")
+        self._sel.register(self._wake_r, selectors.EVENT_READ, "wake")
+        log.info("Супервизор: %s воркеров, health :%s", len(self.workers), self.health_port)
+
+        for w in self.workers:
+            self._spawn(w)
+
+        next_check = time.monotonic() + self.check_s
+        while not self._stopping:
+            timeout = max(0.0, min(
+                [next_check - time.monotonic()]
+                + [w.restart_at - time.monotonic() for w in self.workers if w.restart_at]
+            ))
+            for key, _ in self._sel.select(timeout):
+                if key.data == "wake":
+                    try:
+                        while self._wake_r.recv(512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.data == "http":
+                    try:
+                        conn, _ = self._listen.accept()
+                    except BlockingIOError:
+                        continue
+                    self._serve_http(conn)
+            self._reap()
+            if self._stopping:
+                break
+            self._restart_due()
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + self.check_s
+                if not self._memory_logged and all(w.ready for w in self.workers):
+                    self._memory_logged = True
+                    self._log_memory()
+
+        return self._shutdown()
+
+    def _shutdown(self) -> int:
+        for w in self.workers:
+            if w.pid:
+                try:
+                    os.kill(w.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        deadline = time.monotonic() + self.shutdown_timeout_s
+        while any(w.pid for w in self.workers) and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for w in self.workers:
+            if w.pid:
+                log.warn("Воркер %s не завершился за %ss — SIGKILL", w.worker_id, self.shutdown_timeout_s)
+                try:
+                    os.kill(w.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        while any(w.pid for w in self.workers):
+            self._reap()
+            time.sleep(0.05)
+        self._sel.close()
+        self._listen.close()
+        log.info("Супервизор остановлен")
+        return 0
+
+
+def merge_prometheus(texts: list[tuple[int, str]]) -> str:
+    """Склеивает вывод /metrics воркеров: одна HELP/TYPE на семейство, у сэмплов метка worker"""
+    families: dict[str, list[str]] = {}   # имя семейства → HELP/TYPE
+    samples: dict[str, list[str]] = {}
+    for worker_id, text in texts:
+        family = ""
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = line.split()[2]
+                meta = families.setdefault(family, [])
+                if len(meta) < 2 and line not in meta:
+                    meta.append(line)
+                samples.setdefault(family, [])
+                continue
+            if line.startswith("#"):
+                continue
+            name, _, rest = line.partition(" ")
+            label = f'worker="{worker_id}"'
+            if "{" in name:
+                metric, _, labels = name.partition("{")
+                name = f"{metric}{{{label},{labels}"
+            else:
+                name = f"{name}{{{label}}}"
+            samples.setdefault(family or name, []).append(f"{name} {rest}")
+    out = []
+    for family, lines in samples.items():
+        out.extend(families.get(family, ()))
+        out.extend(lines)
+    return "\n".join(out) + ("\n" if out else "")